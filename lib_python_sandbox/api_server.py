@@ -1,14 +1,38 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import cv2
-import pickle
 import numpy as np
 import base64
 from io import BytesIO
 from PIL import Image
+import contextvars
+import hmac
 import os
 import requests
 import gdown
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from brute_force_index import BruteForceIndex
+from catalog import CATALOG_FILE, Catalog
+from descriptor_store import HEADER_FILE, DescriptorStore, convert_pickle, store_exists
+from geometric_verification import verify_candidates
+from lsh_index import LSH_PARAMS, LshIndex
+from matching import count_votes, good_pairs, top_cards
+from metrics import CONTENT_TYPE, Registry
+from micro_batcher import MicroBatcher
+from mih_index import MihIndex
+from perceptual_hash import PHASH_BITS, PhashIndex, phash
+from progressive_matching import progressive_knn
+from rectification import rectify_card
+from result_cache import ResultCache, content_key
+from segments import MANIFEST_FILE, SegmentedIndex, SegmentedStore, compact, is_segmented
+from sharded_index import ProcessShardedIndex
+from shards import ShardMap
+from vocab_tree import VOCAB_PARAMS, CoarseToFineIndex, VocabTree
 
 app = Flask(__name__)
 CORS(app)  # Permettre requêtes depuis Flutter
@@ -40,42 +64,188 @@ def download_database():
         print(f"❌ Erreur téléchargement: {e}")
         raise
 
-# Télécharger la base (ou utiliser celle en local)
-db_file = download_database()
+# ========== STORE DE DESCRIPTEURS (memmap) ==========
+STORE_DIR = os.environ.get('ORB_STORE_DIR', 'orb_store')
+
+def prepare_store():
+    """Retourne le dossier du store, en le créant depuis orb_db.pkl si besoin"""
+    if store_exists(STORE_DIR) or is_segmented(STORE_DIR):
+        return STORE_DIR
+
+    # Ancien format : on télécharge le pickle puis on le convertit une seule fois
+    db_file = download_database()
+    print(f"🔄 Conversion de {db_file} vers le store '{STORE_DIR}'...")
+    convert_pickle(db_file, STORE_DIR)
+    return STORE_DIR
+
+# Configuration ORB (80 features, 300px : réglages validés sans vérification géométrique ;
+# avec la vérification on peut descendre, ex. ORB_NFEATURES=50 MAX_DIMENSION=240)
+ORB_NFEATURES = int(os.environ.get('ORB_NFEATURES', '80'))
+MAX_DIMENSION = int(os.environ.get('MAX_DIMENSION', '300'))
+
+# Redressement : la carte est localisée dans la photo puis remise à plat (format 63:88,
+# MAX_DIMENSION de haut) avant ORB, pour que les features ne partent pas sur le fond ;
+# sans carte trouvée, simple redimensionnement. Décodage à RECTIFY_DECODE_FACTOR x
+# MAX_DIMENSION pour garder assez de pixels sur la carte. RECTIFY=0 pour le désactiver
+RECTIFY = os.environ.get('RECTIFY', '1') == '1'
+RECTIFY_DECODE_FACTOR = 2
+DECODE_DIMENSION = MAX_DIMENSION * RECTIFY_DECODE_FACTOR if RECTIFY else MAX_DIMENSION
+
+# Vérification géométrique (RANSAC) des VERIFY_TOP meilleures cartes, si le store
+# contient les keypoints ; 0 pour revenir au simple comptage des votes
+VERIFY_TOP = int(os.environ.get('VERIFY_TOP', '5'))
+INLIERS_MINIMUM = 6  # au moins 6 correspondances cohérentes avec une homographie
+
+# Moteur de recherche kNN : 'lsh' (approché, défaut), 'brute' ou 'mih' (exacts),
+# 'vocab' (arbre de vocabulaire puis kNN exact sur les COARSE_TOP_N meilleures cartes),
+# 'processes' (force brute exacte répartie sur SEARCH_PROCESSES process, un shard chacun)
+SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE', 'lsh')
+COARSE_TOP_N = int(os.environ.get('COARSE_TOP_N', '50'))
+SEARCH_PROCESSES = int(os.environ.get('SEARCH_PROCESSES', str(os.cpu_count())))
+
+def load_search_index(store):
+    """Index de recherche choisi par SEARCH_ENGINE (même interface knn_search) d'un store simple"""
+    if SEARCH_ENGINE == 'brute':
+        # Force brute exacte sur mots uint64, blocs répartis sur un pool de threads
+        return BruteForceIndex(store.descriptors)
+    if SEARCH_ENGINE == 'mih':
+        # Multi-index hashing : mêmes voisins que la force brute, bien moins de distances
+        return MihIndex.load_or_build(store)
+    if SEARCH_ENGINE == 'vocab':
+        # Coût par requête proportionnel à COARSE_TOP_N, pas à la taille du catalogue
+        return CoarseToFineIndex(store, VocabTree.load_or_build(store, **VOCAB_PARAMS), COARSE_TOP_N)
+    if SEARCH_ENGINE == 'processes':
+        # Un process par shard de lignes : la latence baisse avec le nombre de coeurs
+        return ProcessShardedIndex(store, SEARCH_PROCESSES)
+    if SEARCH_ENGINE == 'lsh':
+        # Tables LSH construites par l'indexeur : rechargées telles quelles,
+        # reconstruites seulement si les paramètres ont changé
+        # (table_number=1, key_size=6, multi_probe_level=0 pour économiser la RAM)
+        return LshIndex.load_or_build(store, **LSH_PARAMS)
+    raise ValueError(f"SEARCH_ENGINE inconnu: {SEARCH_ENGINE}")
+
+# Micro-batching : les kNN des requêtes concurrentes arrivées pendant MICRO_BATCH_WINDOW_MS
+# (ou jusqu'à MICRO_BATCH_MAX requêtes) passent en un seul appel ; 0 = désactivé
+MICRO_BATCH_WINDOW_MS = float(os.environ.get('MICRO_BATCH_WINDOW_MS', '0'))
+MICRO_BATCH_MAX = int(os.environ.get('MICRO_BATCH_MAX', '32'))
+
+# Chemin rapide pHash : une seule carte à moins de PHASH_RADIUS bits => réponse
+# sans ORB ni kNN (photos propres, captures d'écran) ; 0 pour le désactiver
+PHASH_RADIUS = int(os.environ.get('PHASH_RADIUS', '8'))
+
+# Matching progressif : descripteurs cherchés par lots de PROGRESSIVE_BATCH (keypoints les
+# plus forts d'abord), arrêt dès que l'écart 1re - 2e carte dépasse PROGRESSIVE_Z·√(a+b)
+# ou après PROGRESSIVE_BUDGET_MS (0 = sans limite) ; PROGRESSIVE_BATCH=0 = tout chercher d'un coup
+PROGRESSIVE_BATCH = int(os.environ.get('PROGRESSIVE_BATCH', '0'))
+PROGRESSIVE_Z = float(os.environ.get('PROGRESSIVE_Z', '3'))
+PROGRESSIVE_BUDGET_MS = float(os.environ.get('PROGRESSIVE_BUDGET_MS', '0'))
+if PROGRESSIVE_BATCH > 0:
+    print(f"✅ Matching progressif (lots de {PROGRESSIVE_BATCH}, z={PROGRESSIVE_Z:g})")
+
+# Shards par set : avec des filtres (sets, series, date_min, date_max), /search
+# ne cherche que dans les lignes des sets retenus, en force brute exacte
+FILTER_KEYS = ('sets', 'series', 'date_min', 'date_max')
+
+# Catalogue SQLite (catalog.py) : URL Cardmarket des cartes reconnues (cm_url) ;
+# absent = réponses sans cm_url
+CATALOG_DB = os.environ.get('CATALOG_DB', CATALOG_FILE)
+
+def ouvrir_catalogue():
+    """Catalogue en lecture seule, ou None s'il est absent / illisible"""
+    if not os.path.exists(CATALOG_DB):
+        return None
+    try:
+        catalogue = Catalog(CATALOG_DB)
+        print(f"✅ Catalogue chargé ({catalogue.meta.get('cards')} cartes, {catalogue.meta.get('built_at')})")
+        return catalogue
+    except sqlite3.Error as e:
+        print(f"⚠️ Catalogue {CATALOG_DB} illisible, réponses sans cm_url: {e}")
+        return None
+
+class Vue:
+    """
+    Tout ce qu'une requête lit de l'index : store, index kNN, pHash, shards.
+    Un rechargement construit une nouvelle Vue à côté puis remplace la référence
+    globale `vue` d'un coup ; une requête en cours garde la vue prise au début.
+    """
+
+    def __init__(self, version=0, precedente=None):
+        self.version = version
+        if is_segmented(STORE_DIR):
+            # Store segmenté : un index par segment, les segments déjà chargés
+            # par la vue précédente sont repris tels quels (rien à reconstruire)
+            deja = precedente.segments if precedente is not None else {}
+            self.store = SegmentedStore(STORE_DIR, opened={nom: seg[0] for nom, seg in deja.items()})
+            self.segments = {}
+            for nom, segment in zip(self.store.segment_names, self.store.segments):
+                self.segments[nom] = deja.get(nom) or self._indexer_segment(segment)
+            self.generation = self.store.generation
+            indexes = [self.segments[nom] for nom in self.store.segment_names]
+            if len(indexes) == 1:
+                self.search_index, self.filtered_index = indexes[0][1], indexes[0][2]
+            else:
+                self.search_index = SegmentedIndex([seg[1] for seg in indexes], self.store.row_bases)
+                self.filtered_index = SegmentedIndex([seg[2] for seg in indexes], self.store.row_bases)
+        else:
+            self.store = DescriptorStore(STORE_DIR)
+            self.segments = {}
+            self.generation = 0
+            _, self.search_index, self.filtered_index = self._indexer_segment(self.store)
+        print(f"✅ {self.store.n_cards} cartes chargées ({self.store.n_rows} descripteurs, memmap, "
+              f"{max(1, len(self.segments))} segment(s)) ; index '{SEARCH_ENGINE}' prêt")
+
+        # Index (int32) de la carte de chaque ligne du store
+        self.card_of_row = self.store.card_of_row
+        self.geometric_verification = VERIFY_TOP > 0 and self.store.keypoints is not None
+        if VERIFY_TOP > 0 and not self.geometric_verification:
+            print("⚠️ Pas de keypoints dans le store : vérification géométrique désactivée")
+
+        self.micro_batcher = None
+        if MICRO_BATCH_WINDOW_MS > 0:
+            self.micro_batcher = MicroBatcher(self.search_index, MICRO_BATCH_WINDOW_MS, MICRO_BATCH_MAX)
+            print(f"✅ Micro-batching actif ({MICRO_BATCH_WINDOW_MS:g} ms, {MICRO_BATCH_MAX} requêtes max)")
+
+        self.phash_index = None
+        if PHASH_RADIUS > 0 and self.store.phashes is not None:
+            self.phash_index = PhashIndex(self.store.phashes, PHASH_RADIUS)
+            print(f"✅ Index pHash prêt (rayon {PHASH_RADIUS} bits)")
+        elif PHASH_RADIUS > 0:
+            print("⚠️ Pas de pHash dans le store : chemin rapide désactivé")
+
+        self.shard_map = ShardMap(self.store)
+        if self.shard_map.available:
+            print(f"✅ {self.shard_map.n_shards} shards (sets) disponibles pour les filtres")
+        else:
+            print("⚠️ Pas de métadonnées de set dans le store : filtres désactivés")
+
+        # Rouvert à chaque rechargement : un catalogue reconstruit (os.replace) est pris en compte
+        self.catalogue = ouvrir_catalogue()
+
+    @staticmethod
+    def _indexer_segment(store):
+        """(store, index SEARCH_ENGINE, force brute pour les filtres) d'un store simple"""
+        search_index = load_search_index(store)
+        filtered_index = search_index if isinstance(search_index, BruteForceIndex) else BruteForceIndex(store.descriptors)
+        return store, search_index, filtered_index
+
+    def fermer(self, suivante=None):
+        """Appelée après la bascule vers suivante : libère les index qu'elle ne reprend pas"""
+        if self.micro_batcher is not None:
+            self.micro_batcher.close()
+        repris = {id(seg[1]) for seg in suivante.segments.values()} if suivante is not None else set()
+        for index in [seg[1] for seg in self.segments.values()] or [self.search_index]:
+            # ProcessShardedIndex : rend son pool de process
+            if id(index) not in repris and hasattr(index, 'close'):
+                index.close()
 
 # ========== CHARGEMENT DE LA BASE (Au démarrage du serveur) ==========
-print("🔄 Chargement de la base de données...")
-with open(db_file, 'rb') as f:
-    DB_CARTES = pickle.load(f)
-print(f"✅ {len(DB_CARTES)} cartes chargées")
-
-# Configuration ORB et FLANN (optimisé pour précision)
-orb = cv2.ORB_create(nfeatures=80)  # Augmenté de 50 à 80 pour meilleure précision
-
-FLANN_INDEX_LSH = 6
-index_params = dict(
-    algorithm=FLANN_INDEX_LSH,
-    table_number=1,  # Réduit de 2 à 1 pour économiser RAM
-    key_size=6,      # Réduit de 8 à 6
-    multi_probe_level=0  # 0 au lieu de 1
-)
-search_params = dict(checks=1)
-matcher = cv2.FlannBasedMatcher(index_params, search_params)
-
-# Construction super_matrix
-all_descriptors = []
-map_descriptor_to_card_id = []
-
-for carte in DB_CARTES:
-    desc = carte['descriptors']
-    if desc is not None:
-        all_descriptors.append(desc)
-        map_descriptor_to_card_id.extend([carte['id']] * len(desc))
-
-super_matrix = np.vstack(all_descriptors)
-matcher.add([super_matrix])
-matcher.train()
-print("✅ Matcher FLANN prêt !")
+# Process du pool SEARCH_ENGINE=processes (forkserver) d'un serveur lancé par
+# `python api_server.py` : ce fichier y est réimporté sous le nom __mp_main__, rien n'y est chargé
+PROCESS_DU_POOL = __name__ == '__mp_main__'
+if not PROCESS_DU_POOL:
+    print("🔄 Chargement de la base de données...")
+    prepare_store()
+    vue = Vue()
 
 def extraire_infos_carte(card_id):
     """Extrait nom, numéro, set depuis l'ID"""
@@ -95,107 +265,593 @@ def extraire_infos_carte(card_id):
     carte_texte = f"{numero} - {nom} - {set_name}".strip()
     return {"numero": numero, "nom": nom, "set_name": set_name, "carte_texte": carte_texte}
 
+def infos_sante():
+    """Contenu de /health (partagé avec le mode ASGI)"""
+    v = vue
+    infos = {"status": "ok", "cartes_loaded": v.store.n_cards, "engine": SEARCH_ENGINE}
+    if hasattr(v.search_index, 'stats'):
+        infos["engine_stats"] = v.search_index.stats
+    infos["index"] = {"generation": v.generation, "segments": list(v.segments), **rechargement}
+    infos["cache"] = {"octets": cache_octets.stats(), "descripteurs": cache_descripteurs.stats()}
+    if v.micro_batcher is not None:
+        infos["micro_batch"] = v.micro_batcher.metrics()
+    return infos
+
 @app.route('/health', methods=['GET'])
 def health():
     """Endpoint de santé pour vérifier que le serveur tourne"""
-    return jsonify({"status": "ok", "cartes_loaded": len(DB_CARTES)})
+    return jsonify(infos_sante())
 
-@app.route('/search', methods=['POST'])
-def search_card():
-    """Endpoint principal : reçoit image en base64, retourne carte trouvée"""
-    print("🔍 Requête /search reçue")
+@app.route('/sets', methods=['GET'])
+def list_sets():
+    """Sets (shards) utilisables dans les filtres de /search"""
+    return jsonify(vue.shard_map.describe())
+
+# Cache des réponses de /search (LRU + TTL) : niveau 1 sur les octets reçus,
+# niveau 2 sur l'empreinte des descripteurs ORB ; RESULT_CACHE_SIZE=0 pour le désactiver
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '1024'))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', '300'))
+cache_octets = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+cache_descripteurs = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+# ========== MÉTRIQUES (/metrics, format texte Prometheus) ==========
+# Remplacent les print() de timing du chemin de requête : durée par étape,
+# issue des requêtes, nombre de descripteurs et de good matches, taille de l'index
+metriques = Registry()
+STAGE_SECONDS = metriques.histogram(
+    'cardscan_stage_seconds', "Durée de chaque étape du pipeline de reconnaissance", labels=('stage',))
+REQUESTS = metriques.counter(
+    'cardscan_requests_total', "Réponses par endpoint et par issue (une par image pour /search/batch)",
+    labels=('endpoint', 'outcome'))
+QUERY_DESCRIPTORS = metriques.histogram(
+    'cardscan_query_descriptors', "Descripteurs ORB extraits de la photo",
+    buckets=(0, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500))
+DESCRIPTORS_USED = metriques.histogram(
+    'cardscan_descriptors_used', "Descripteurs réellement cherchés (moins que extraits si arrêt anticipé)",
+    buckets=(0, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500))
+EARLY_EXIT = metriques.counter(
+    'cardscan_progressive_stops_total', "Fins du matching progressif (margin, budget, complete)", labels=('reason',))
+RECTIFICATIONS = metriques.counter(
+    'cardscan_rectifications_total', "Redressements : carte trouvée (card) ou image entière (fallback)",
+    labels=('result',))
+# Durées par étape de la requête /search en cours, renvoyées dans l'en-tête Server-Timing
+# (le pipeline d'une requête tourne dans un seul thread : un ContextVar suffit)
+_etapes_requete = contextvars.ContextVar('etapes_requete', default=None)
+
+@contextmanager
+def etape(nom):
+    """Chronomètre une étape : histogramme /metrics et Server-Timing de la requête"""
+    debut = time.perf_counter()
     try:
-        # Récupérer l'image base64 depuis la requête
-        data = request.get_json()
-        image_base64 = data.get('image')
-        print(f"📦 Image reçue: {len(image_base64) if image_base64 else 0} caractères")
-        
-        if not image_base64:
-            return jsonify({"error": "Image manquante"}), 400
-        
-        # Décoder l'image base64
-        print("🔄 Décodage image...")
-        image_bytes = base64.b64decode(image_base64)
-        image = Image.open(BytesIO(image_bytes)).convert('L')  # Convertir en grayscale
-        img_array = np.array(image)
-        
-        # Redimensionner si trop grande
-        max_dimension = 300
-        height, width = img_array.shape
-        print(f"📐 Taille image: {width}x{height}")
-        if max(height, width) > max_dimension:
-            scale = max_dimension / max(height, width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img_array = cv2.resize(img_array, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        
-        # Extraction ORB
-        print("🔍 Extraction features ORB...")
-        kp_user, des_user = orb.detectAndCompute(img_array, None)
-        if des_user is None:
-            return jsonify({"error": "Aucun détail détecté dans l'image"}), 400
-        print(f"✅ {len(des_user)} features extraites")
-        
-        # Recherche FLANN
-        print("🔎 Recherche FLANN en cours... (peut prendre 10-30s)")
-        matches = matcher.knnMatch(des_user, k=2)
-        print(f"✅ FLANN terminé: {len(matches)} matches")
-        
-        # Filtrage ratio test
-        print("🔄 Filtrage ratio test...")
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) < 2:
-                continue
-            m, n = match_pair
-            # Ratio 0.80 = bon compromis entre précision et rappel
-            if m.distance < 0.80 * n.distance:
-                good_matches.append(m)
-        
-        print(f"✅ {len(good_matches)} good matches après ratio test")
-        
-        # Comptage votes
-        votes = {}
-        for match in good_matches:
-            idx_in_super_matrix = match.trainIdx
-            card_id = map_descriptor_to_card_id[idx_in_super_matrix]
-            votes[card_id] = votes.get(card_id, 0) + 1
-        
-        print(f"📊 Votes: {len(votes)} cartes candidates")
-        if votes:
-            top_3 = sorted(votes.items(), key=lambda x: x[1], reverse=True)[:3]
-            print(f"🏆 Top 3: {top_3}")
-        
-        if not votes:
-            return jsonify({"error": "Aucune correspondance trouvée"}), 404
-        
-        # Meilleur match
-        meilleur_id = max(votes, key=votes.get)
-        score = votes[meilleur_id]
-        
+        yield
+    finally:
+        duree = time.perf_counter() - debut
+        STAGE_SECONDS.observe(duree, stage=nom)
+        etapes = _etapes_requete.get()
+        if etapes is not None:
+            etapes[nom] = etapes.get(nom, 0.0) + duree
+
+def server_timing(etapes):
+    """Valeur de l'en-tête Server-Timing (durées en ms), ex. 'decode;dur=3.1, orb;dur=8.4, total;dur=25.0'"""
+    return ", ".join(f"{nom};dur={duree * 1000:.2f}" for nom, duree in etapes.items())
+
+GOOD_MATCHES = metriques.histogram(
+    'cardscan_good_matches', "Good matches après ratio test",
+    buckets=(0, 2, 4, 6, 8, 10, 15, 20, 30, 50, 80))
+metriques.callback('cardscan_index_cards', "Cartes dans le store", lambda: vue.store.n_cards)
+metriques.callback('cardscan_index_descriptors', "Descripteurs (lignes) dans le store", lambda: vue.store.n_rows)
+metriques.callback('cardscan_index_shards', "Shards (sets) utilisables dans les filtres", lambda: vue.shard_map.n_shards)
+metriques.callback('cardscan_index_segments', "Segments du store chargés", lambda: max(1, len(vue.segments)))
+metriques.callback('cardscan_index_reloads_total', "Rechargements réussis de l'index",
+                   lambda: rechargement["rechargements"], kind='counter')
+metriques.callback('cardscan_cache_entries', "Entrées des caches de réponses",
+                   lambda: {'octets': cache_octets.stats()['size'], 'descripteurs': cache_descripteurs.stats()['size']},
+                   labels=('cache',))
+metriques.callback('cardscan_cache_hits_total', "Réponses trouvées en cache",
+                   lambda: {'octets': cache_octets.hits, 'descripteurs': cache_descripteurs.hits},
+                   kind='counter', labels=('cache',))
+metriques.callback('cardscan_cache_misses_total', "Recherches absentes du cache",
+                   lambda: {'octets': cache_octets.misses, 'descripteurs': cache_descripteurs.misses},
+                   kind='counter', labels=('cache',))
+
+def issue_erreur(status):
+    """Issue (label outcome) d'une réponse d'erreur du pipeline"""
+    return 'not_found' if status == 404 else 'bad_request'
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métriques au format texte Prometheus"""
+    return metriques.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+# ========== RECHARGEMENT À CHAUD (segments) ==========
+# Un nouveau segment (ou un store reconstruit) est chargé en arrière-plan, puis la vue
+# est basculée d'un coup : pas de redémarrage ni de requête interrompue.
+# POST /admin/reload (en-tête X-Admin-Token = ADMIN_TOKEN ; désactivé sans ADMIN_TOKEN),
+# ou surveillance du manifest toutes les STORE_WATCH_SECONDS (0 = désactivée).
+# Au-delà de SEGMENT_COMPACT_AT segments, compaction puis nouveau rechargement (0 = jamais)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+STORE_WATCH_SECONDS = float(os.environ.get('STORE_WATCH_SECONDS', '0'))
+SEGMENT_COMPACT_AT = int(os.environ.get('SEGMENT_COMPACT_AT', '8'))
+rechargement = {"en_cours": False, "rechargements": 0, "compactions": 0, "dernier": None, "erreur": None}
+_rechargement_lock = threading.Lock()
+
+def recharger():
+    """Construit la vue des segments actuels, bascule, compacte si besoin ; False si déjà en cours"""
+    global vue
+    if not _rechargement_lock.acquire(blocking=False):
+        return False
+    rechargement["en_cours"] = True
+    try:
+        while True:
+            precedente = vue
+            nouvelle = Vue(precedente.version + 1, precedente)
+            vue = nouvelle  # bascule atomique : les requêtes en cours finissent sur l'ancienne vue
+            precedente.fermer(nouvelle)
+            cache_octets.clear()
+            cache_descripteurs.clear()
+            rechargement.update(rechargements=rechargement["rechargements"] + 1, dernier=time.time(), erreur=None)
+            if not (SEGMENT_COMPACT_AT > 0 and len(nouvelle.segments) >= SEGMENT_COMPACT_AT):
+                break
+            print(f"🔄 Compaction de {len(nouvelle.segments)} segments...")
+            compact(STORE_DIR)
+            rechargement["compactions"] += 1
+    except Exception as e:
+        print(f"❌ Rechargement impossible, l'ancienne vue reste active: {e}")
+        rechargement["erreur"] = str(e)
+    finally:
+        rechargement["en_cours"] = False
+        _rechargement_lock.release()
+    return True
+
+def demander_rechargement(token):
+    """Rechargement en arrière-plan demandé par l'admin -> (payload, status) (partagé avec le mode ASGI)"""
+    if not ADMIN_TOKEN:
+        return {"error": "Rechargement désactivé (ADMIN_TOKEN non défini)"}, 403
+    if not hmac.compare_digest(token or '', ADMIN_TOKEN):
+        return {"error": "Token admin invalide"}, 401
+    if rechargement["en_cours"]:
+        return {"status": "rechargement déjà en cours", "generation": vue.generation}, 409
+    threading.Thread(target=recharger, name="rechargement", daemon=True).start()
+    return {"status": "rechargement lancé", "generation": vue.generation}, 202
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Charge les nouveaux segments en arrière-plan puis bascule ; suivi dans /health (index)"""
+    payload, status = demander_rechargement(request.headers.get('X-Admin-Token'))
+    return jsonify(payload), status
+
+def signature_store():
+    """Date de modification du manifest (ou du header d'un store simple), None s'il n'existe pas"""
+    chemin = os.path.join(STORE_DIR, MANIFEST_FILE if is_segmented(STORE_DIR) else HEADER_FILE)
+    try:
+        return os.stat(chemin).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def surveiller_store():
+    derniere = signature_store()
+    while True:
+        time.sleep(STORE_WATCH_SECONDS)
+        signature = signature_store()
+        if signature is not None and signature != derniere:
+            recharger()
+            derniere = signature_store()
+
+if STORE_WATCH_SECONDS > 0 and not PROCESS_DU_POOL:
+    threading.Thread(target=surveiller_store, name="surveillance-store", daemon=True).start()
+    print(f"✅ Surveillance du store '{STORE_DIR}' (toutes les {STORE_WATCH_SECONDS:g} s)")
+
+# ========== PIPELINE DE RECONNAISSANCE (partagé par /search et /search/batch) ==========
+def resoudre_filtres(v, data):
+    """(lignes, masque des cartes) des shards retenus, ou (None, None) sans filtre ; erreur -> (payload, status)"""
+    filtres = {key: data[key] for key in FILTER_KEYS if data.get(key)}
+    if not filtres:
+        return None, None, None
+    if not v.shard_map.available:
+        return None, None, ({"error": "Filtres indisponibles : base sans métadonnées de set"}, 400)
+    try:
+        shards = v.shard_map.select(**filtres)
+    except ValueError as e:
+        return None, None, ({"error": f"Filtres invalides : {e}", "filtres": filtres}, 400)
+    if not shards.any():
+        return None, None, ({"error": "Aucun set ne correspond aux filtres", "filtres": filtres}, 404)
+    rows = v.shard_map.rows(shards)
+    return rows, v.shard_map.card_mask(shards), None
+
+def lire_requete(req, cle_image):
+    """
+    (octets de l'image, paramètres) selon le format d'envoi :
+    - corps brut image/jpeg, image/png ou application/octet-stream (filtres en query string)
+    - multipart/form-data, fichier dans le champ cle_image (filtres en champs de formulaire)
+    - JSON {"image": base64, ...} (ancien format)
+    """
+    if req.mimetype.startswith('image/') or req.mimetype == 'application/octet-stream':
+        return req.get_data(cache=False), parametres_formulaire(req.args)
+    if req.mimetype == 'multipart/form-data':
+        fichier = req.files.get(cle_image)
+        return (fichier.read() if fichier else None), parametres_formulaire(req.form)
+    data = req.get_json(silent=True) or {}
+    image_base64 = data.get(cle_image)
+    return (base64.b64decode(image_base64) if image_base64 else None), data
+
+def parametres_formulaire(valeurs):
+    """Filtres depuis une query string / un formulaire : sets=base1,base2 ou sets=base1&sets=base2"""
+    params = {key: valeurs.get(key) for key in ('date_min', 'date_max') if valeurs.get(key)}
+    for key in ('sets', 'series'):
+        liste = [v.strip() for valeur in valeurs.getlist(key) for v in valeur.split(',') if v.strip()]
+        if liste:
+            params[key] = liste
+    return params
+
+# Décodage JPEG réduit (dans le domaine DCT) : 1/8, 1/4 ou 1/2 de la résolution
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+]
+
+def mode_decodage(image_bytes):
+    """Plus forte réduction au décodage qui garde au moins DECODE_DIMENSION pixels sur le grand côté"""
+    try:
+        # Image.open ne lit que l'en-tête : format et taille sans décoder les pixels
+        with Image.open(BytesIO(image_bytes)) as image:
+            format_image, taille = image.format, image.size
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE, 1
+    if format_image != 'JPEG':
+        return cv2.IMREAD_GRAYSCALE, 1
+    for facteur, flag in REDUCED_DECODE_FLAGS:
+        if max(taille) // facteur >= DECODE_DIMENSION:
+            return flag, facteur
+    return cv2.IMREAD_GRAYSCALE, 1
+
+def decoder_image(image_bytes):
+    """Octets de l'image -> image grayscale (réduite dès le décodage si c'est une grande photo JPEG)"""
+    # Décodage direct depuis le buffer (sans copie) en niveaux de gris ; une photo de
+    # téléphone (12 MP) est décodée à 1/8 (ou 1/4 pour le redressement) au lieu d'être
+    # décodée en entier puis réduite
+    with etape('decode'):
+        flag, facteur = mode_decodage(image_bytes)
+        img_array = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flag)
+    if img_array is None:
+        raise ValueError("format non reconnu (JPEG/PNG attendu)")
+    return img_array
+
+def redimensionner(img_array):
+    """Image entière, côté max MAX_DIMENSION"""
+    max_dimension = MAX_DIMENSION
+    height, width = img_array.shape
+    if max(height, width) > max_dimension:
+        scale = max_dimension / max(height, width)
+        new_width = int(width * scale)
+        new_height = int(height * scale)
+        img_array = cv2.resize(img_array, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    return img_array
+
+def preparer_image(v, img_array, cartes_filtrees):
+    """
+    Image décodée -> (réponse du chemin rapide pHash ou None, image pour ORB).
+    pHash de l'image entière d'abord (image du catalogue, capture, scan) : le redressement
+    peut se caler sur un cadre intérieur d'une carte déjà à plat. Sinon la carte localisée
+    et redressée (seule la carte, à plat, part vers pHash et ORB), à défaut l'image entière.
+    """
+    entiere = redimensionner(img_array)
+    rapide = chemin_rapide_phash(v, entiere, cartes_filtrees)
+    if rapide is not None or not RECTIFY:
+        return rapide, entiere
+    with etape('rectify'):
+        carte = rectify_card(img_array, MAX_DIMENSION)
+    RECTIFICATIONS.inc(result='card' if carte is not None else 'fallback')
+    if carte is None:
+        return None, entiere
+    return chemin_rapide_phash(v, carte, cartes_filtrees), carte
+
+def reponse_carte(v, card_idx, **details):
+    """Payload JSON d'une carte reconnue"""
+    card = v.store.cards[card_idx]
+    infos = extraire_infos_carte(card['id'])
+    payload = {
+        "success": True,
+        "carte": infos["carte_texte"],
+        "numero": infos["numero"],
+        "nom": infos["nom"],
+        "set_name": infos["set_name"],
+        **details
+    }
+    if v.catalogue is not None:
+        ligne = v.catalogue.lookup(card)
+        payload["cm_url"] = ligne["cm_url"] if ligne else None
+    return payload
+
+def chemin_rapide_phash(v, img_array, cartes_filtrees):
+    """
+    Réponse directe si un seul pHash du catalogue est assez proche, sinon None.
+    Mêmes types que la réponse ORB : score = bits communs des deux pHash (64 - distance),
+    inliers = 0 ; method = 'phash' distingue ce chemin
+    """
+    if v.phash_index is None:
+        return None
+    with etape('phash'):
+        hits, hit_distances = v.phash_index.search(phash(img_array))
+        if cartes_filtrees is not None:
+            keep = cartes_filtrees[hits]
+            hits, hit_distances = hits[keep], hit_distances[keep]
+    if len(hits) != 1:
+        return None
+    return reponse_carte(v, hits[0], method='phash', score=PHASH_BITS - int(hit_distances[0]), inliers=0,
+                         matches_count=0, phash_distance=int(hit_distances[0]), descriptors_used=0,
+                         descriptors_extracted=0)
+
+# Un détecteur ORB par thread : detectAndCompute n'est pas fait pour être partagé
+_orb_local = threading.local()
+
+def extraire_orb(img_array):
+    """Keypoints et descripteurs ORB de la photo (des_user None si rien de détecté)"""
+    if not hasattr(_orb_local, 'orb'):
+        _orb_local.orb = cv2.ORB_create(nfeatures=ORB_NFEATURES)
+    with etape('orb'):
+        kp_user, des_user = _orb_local.orb.detectAndCompute(img_array, None)
+    QUERY_DESCRIPTORS.observe(0 if des_user is None else len(des_user))
+    return kp_user, des_user
+
+def recherche_knn(v, des_user, rows, offsets=None):
+    """
+    2 plus proches voisins de chaque descripteur, sur tout le store ou sur les lignes filtrées.
+    offsets : bornes des photos empilées (/search/batch), pour les index à étape grossière
+    """
+    with etape('knn'):
+        return knn_brut(v, des_user, rows, offsets)
+
+def knn_brut(v, des_user, rows, offsets=None):
+    if rows is not None:
+        return v.filtered_index.knn_search(des_user, k=2, rows=rows)
+    if offsets is not None and getattr(v.search_index, 'grouped', False):
+        # Candidats vocab choisis photo par photo ; pas de micro-batcher, qui verrait le lot comme une seule requête
+        return v.search_index.knn_search(des_user, k=2, offsets=offsets)
+    if v.micro_batcher is not None:
+        return v.micro_batcher.knn_search(des_user, k=2)
+    return v.search_index.knn_search(des_user, k=2)
+
+def recherche_progressive(v, kp_user, des_user, rows):
+    """kNN par lots jusqu'à un écart décisif -> (keypoints utilisés, distances, indices)"""
+    with etape('knn'):
+        distances, indices, ordre, arret = progressive_knn(
+            lambda des: knn_brut(v, des, rows), des_user, kp_user, v.card_of_row, v.store.n_cards,
+            PROGRESSIVE_BATCH, PROGRESSIVE_Z, PROGRESSIVE_BUDGET_MS / 1000, RATIO_TEST)
+    EARLY_EXIT.inc(reason=arret)
+    # Les lignes de distances suivent ordre : mêmes keypoints, même ordre, pour la vérification
+    return [kp_user[i] for i in ordre], distances, indices
+
+# Ratio 0.80 = bon compromis entre précision et rappel
+RATIO_TEST = 0.80
+
+def conclure(v, kp_user, distances, indices, n_extraits=None):
+    """
+    Ratio test, votes, vérification géométrique -> (payload, status, issue)
+    kp_user / distances / indices : descripteurs cherchés ; n_extraits : total extrait de la photo
+    """
+    # Filtrage ratio test (il faut les 2 voisins)
+    with etape('ratio_test'):
+        query_idx, good_matches = good_pairs(distances, indices, RATIO_TEST)
+    GOOD_MATCHES.observe(len(good_matches))
+    DESCRIPTORS_USED.observe(len(distances))
+    
+    # Comptage votes : un seul bincount sur les lignes des good matches
+    with etape('vote'):
+        votes = count_votes(good_matches, v.card_of_row, v.store.n_cards)
+        candidats = top_cards(votes, max(3, VERIFY_TOP))
+        candidats = candidats[votes[candidats] > 0]
+    
+    if len(good_matches) == 0:
+        return {"error": "Aucune correspondance trouvée"}, 404, 'not_found'
+    
+    if v.geometric_verification:
+        # Classement par inliers RANSAC parmi les meilleures cartes
+        candidats = candidats[:VERIFY_TOP]
+        with etape('verification'):
+            inliers = verify_candidates(candidats, query_idx, good_matches, kp_user, v.card_of_row, v.store.keypoints)
+        # À égalité d'inliers, l'ordre des votes départage (tri stable)
+        best = np.argsort(-inliers, kind='stable')[0]
+        meilleur = candidats[best]
+        nb_inliers = int(inliers[best])
+    else:
+        meilleur = candidats[0]
+        nb_inliers = 0  # pas de vérification géométrique (entier pour les clients)
+    
+    # Meilleur match
+    score = int(votes[meilleur])
+    
+    if v.geometric_verification:
+        # Les inliers remplacent le seuil sur les votes bruts
+        if nb_inliers < INLIERS_MINIMUM:
+            return {
+                "error": f"Confiance insuffisante (inliers: {nb_inliers}/{INLIERS_MINIMUM} requis)",
+                "conseil": "Prenez une photo plus nette ou avec meilleur éclairage"
+            }, 404, 'low_confidence'
+    else:
         # SEUIL MINIMUM : rejeter si score trop faible (évite faux positifs)
         SCORE_MINIMUM = 8  # Au moins 8 features doivent correspondre
         if score < SCORE_MINIMUM:
-            print(f"⚠️ Score trop faible: {score} < {SCORE_MINIMUM}")
-            return jsonify({
+            return {
                 "error": f"Confiance insuffisante (score: {score}/{SCORE_MINIMUM} requis)",
                 "conseil": "Prenez une photo plus nette ou avec meilleur éclairage"
-            }), 404
+            }, 404, 'low_confidence'
+    
+    return reponse_carte(v, meilleur, method='orb', score=score, inliers=nb_inliers,
+                         matches_count=len(good_matches), phash_distance=None,
+                         descriptors_used=len(distances),
+                         descriptors_extracted=len(distances) if n_extraits is None else n_extraits), 200, 'found'
+
+def repondre(payload, status, issue, *cles):
+    """(payload, status, en_cache, issue), mis en cache sous chaque (cache, clé) si la réponse est définitive (200 / 404)"""
+    if status in (200, 404):
+        for cache, cle in cles:
+            # L'issue est gardée : une réponse resservie compte sous la même issue (found,
+            # not_found...) ; les hits eux-mêmes sont comptés par cardscan_cache_hits_total
+            cache.put(cle, (payload, status, issue))
+    return payload, status, False, issue
+
+def traiter_recherche(image_bytes, data):
+    """
+    Pipeline complet de /search, indépendant du serveur web (Flask ou ASGI) :
+    octets de l'image + paramètres (filtres) -> (payload, status, en_cache, durées par étape)
+    """
+    etapes = {}
+    jeton = _etapes_requete.set(etapes)
+    try:
+        with etape('total'):
+            # Une seule vue pour toute la requête, même si un rechargement bascule entre-temps
+            payload, status, en_cache, issue = pipeline_recherche(vue, image_bytes, data)
+    finally:
+        _etapes_requete.reset(jeton)
+    REQUESTS.inc(endpoint='search', outcome=issue)
+    return payload, status, en_cache, etapes
+
+def pipeline_recherche(v, image_bytes, data):
+    """Étapes de traiter_recherche -> (payload, status, en_cache, issue)"""
+    if not image_bytes:
+        return {"error": "Image manquante"}, 400, False, 'bad_request'
+    
+    # Cache niveau 1 : mêmes octets et mêmes filtres => même réponse, sans rien recalculer
+    # (la version de la vue dans la clé : rien de mis en cache avant un rechargement ne resert)
+    filtres = {key: data[key] for key in FILTER_KEYS if data.get(key)}
+    cle_octets = (cache_octets, content_key(image_bytes, filtres, v.version))
+    en_cache = cache_octets.get(cle_octets[1])
+    if en_cache is not None:
+        return (*en_cache[:2], True, en_cache[2])
+    
+    # Filtres optionnels : on ne garde que les shards (sets) correspondants
+    rows, cartes_filtrees, erreur = resoudre_filtres(v, data)
+    if erreur:
+        return erreur[0], erreur[1], False, issue_erreur(erreur[1])
+    
+    # Décoder l'image
+    try:
+        img_array = decoder_image(image_bytes)
+    except ValueError as e:
+        return {"error": f"Image illisible: {e}"}, 400, False, 'bad_request'
+    
+    # Chemin rapide : pHash de la photo (puis de la carte redressée), réponse directe si un seul hit
+    rapide, img_array = preparer_image(v, img_array, cartes_filtrees)
+    if rapide is not None:
+        return repondre(rapide, 200, 'found', cle_octets)
+    
+    # Extraction ORB
+    kp_user, des_user = extraire_orb(img_array)
+    if des_user is None:
+        return {"error": "Aucun détail détecté dans l'image"}, 400, False, 'no_features'
+    
+    # Cache niveau 2 : octets différents (réencodage, métadonnées) mais mêmes descripteurs
+    cle_descripteurs = (cache_descripteurs, content_key(des_user.tobytes(), filtres, v.version))
+    en_cache = cache_descripteurs.get(cle_descripteurs[1])
+    if en_cache is not None:
+        cache_octets.put(cle_octets[1], en_cache)
+        return (*en_cache[:2], True, en_cache[2])
+    
+    # Recherche des 2 plus proches voisins (par lots avec arrêt anticipé en mode progressif)
+    if PROGRESSIVE_BATCH > 0:
+        kp_utilises, distances, indices = recherche_progressive(v, kp_user, des_user, rows)
+    else:
+        kp_utilises, (distances, indices) = kp_user, recherche_knn(v, des_user, rows)
+    
+    payload, status, issue = conclure(v, kp_utilises, distances, indices, len(des_user))
+    return repondre(payload, status, issue, cle_octets, cle_descripteurs)
+
+@app.route('/search', methods=['POST'])
+def search_card():
+    """Endpoint principal : reçoit l'image (binaire, multipart ou base64), retourne carte trouvée"""
+    try:
+        # Récupérer les octets de l'image depuis la requête
+        image_bytes, data = lire_requete(request, 'image')
+        
+        payload, status, en_cache, etapes = traiter_recherche(image_bytes, data)
+        response = jsonify(payload)
+        if en_cache:
+            response.headers['X-Cache'] = 'HIT'
+        response.headers['Server-Timing'] = server_timing(etapes)
+        return response, status
+    
+    except Exception as e:
+        REQUESTS.inc(endpoint='search', outcome='error')
+        return jsonify({"error": str(e)}), 500
+
+# Décodage + ORB des images d'un lot en parallèle (OpenCV relâche le GIL)
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', '32'))
+batch_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+def preparer_image_lot(v, image, cartes_filtrees):
+    """Étapes par image d'un lot : (réponse pHash, keypoints, descripteurs, erreur (payload, status, issue))"""
+    try:
+        # Fichier multipart (octets) ou chaîne base64 du JSON
+        img_array = decoder_image(base64.b64decode(image) if isinstance(image, str) else image)
+    except Exception as e:
+        return None, None, None, ({"error": f"Image illisible: {e}"}, 400, 'bad_request')
+    rapide, img_array = preparer_image(v, img_array, cartes_filtrees)
+    if rapide is not None:
+        return rapide, None, None, None
+    kp_user, des_user = extraire_orb(img_array)
+    if des_user is None:
+        return None, None, None, ({"error": "Aucun détail détecté dans l'image"}, 400, 'no_features')
+    return None, kp_user, des_user, None
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Plusieurs images en une requête (page de classeur) : {"images": [base64, ...]},
+    ou multipart/form-data avec plusieurs fichiers dans le champ "images".
+    Décodage et ORB en parallèle, un seul kNN sur tous les descripteurs empilés,
+    puis votes séparés par image grâce aux offsets. Une réponse par image, dans l'ordre.
+    """
+    try:
+        if request.mimetype == 'multipart/form-data':
+            images = [fichier.read() for fichier in request.files.getlist('images')]
+            data = parametres_formulaire(request.form)
+        else:
+            data = request.get_json(silent=True) or {}
+            images = data.get('images') or []
+        if not images:
+            REQUESTS.inc(endpoint='batch', outcome='bad_request')
+            return jsonify({"error": "Images manquantes"}), 400
+        if len(images) > BATCH_MAX_IMAGES:
+            REQUESTS.inc(endpoint='batch', outcome='bad_request')
+            return jsonify({"error": f"Trop d'images ({len(images)} > {BATCH_MAX_IMAGES})"}), 400
+        
+        v = vue
+        rows, cartes_filtrees, erreur = resoudre_filtres(v, data)
+        if erreur:
+            REQUESTS.inc(endpoint='batch', outcome=issue_erreur(erreur[1]))
+            return jsonify(erreur[0]), erreur[1]
+        
+        debut = time.perf_counter()
+        prepared = list(batch_pool.map(lambda image: preparer_image_lot(v, image, cartes_filtrees), images))
+        resultats = [None] * len(images)
+        a_chercher = []
+        for i, (rapide, kp_user, des_user, erreur) in enumerate(prepared):
+            if erreur:
+                resultats[i] = {**erreur[0], "status": erreur[1]}
+                REQUESTS.inc(endpoint='batch', outcome=erreur[2])
+            elif rapide is not None:
+                resultats[i] = {**rapide, "status": 200}
+                REQUESTS.inc(endpoint='batch', outcome='found')
+            else:
+                a_chercher.append(i)
         
-        infos = extraire_infos_carte(meilleur_id)
+        if a_chercher:
+            # Un seul kNN pour tout le lot : offsets[j]:offsets[j + 1] = descripteurs de l'image j
+            stacked = np.concatenate([prepared[i][2] for i in a_chercher])
+            offsets = np.cumsum([0] + [len(prepared[i][2]) for i in a_chercher])
+            distances, indices = recherche_knn(v, stacked, rows, offsets)
+            for j, i in enumerate(a_chercher):
+                part = slice(offsets[j], offsets[j + 1])
+                payload, status, issue = conclure(v, prepared[i][1], distances[part], indices[part])
+                resultats[i] = {**payload, "status": status}
+                REQUESTS.inc(endpoint='batch', outcome=issue)
         
-        # Retour JSON
-        return jsonify({
-            "success": True,
-            "carte": infos["carte_texte"],
-            "numero": infos["numero"],
-            "nom": infos["nom"],
-            "set_name": infos["set_name"],
-            "score": score,
-            "matches_count": len(good_matches)
-        })
+        STAGE_SECONDS.observe(time.perf_counter() - debut, stage='total_batch')
+        return jsonify({"results": resultats})
     
     except Exception as e:
+        REQUESTS.inc(endpoint='batch', outcome='error')
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
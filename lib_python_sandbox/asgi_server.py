@@ -0,0 +1,204 @@
+"""
+Mode ASGI du serveur : même contrat /search, /health, /metrics et /admin/reload
+que api_server.py.
+
+Le décodage, l'ORB et le matching tournent sur un pool de ASGI_WORKERS
+threads ; au-delà, au plus ASGI_QUEUE requêtes attendent leur tour. Quand
+la file est pleine, la réponse est immédiate : 503 + Retry-After, au lieu
+de laisser les requêtes s'empiler jusqu'au timeout de 120 s. Chaque
+requête a une échéance (REQUEST_DEADLINE) : passée cette durée, 504, et
+un travail encore en file à son échéance n'est pas lancé.
+
+Lancement :
+    uvicorn asgi_server:app --host 0.0.0.0 --port $PORT --workers 1
+"""
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wrappers import Request
+
+import api_server
+from metrics import CONTENT_TYPE
+
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', str(os.cpu_count() or 1)))
+ASGI_QUEUE = int(os.environ.get('ASGI_QUEUE', str(2 * ASGI_WORKERS)))
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '10'))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', '1'))
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', str(20 * 1024 * 1024)))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_WORKERS)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Admission:
+    """Compte les requêtes dans l'executor (en cours + en file) et refuse au-delà de la limite"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.stats = {"accepted": 0, "rejected": 0, "deadline_exceeded": 0}
+
+    def try_enter(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.stats["rejected"] += 1
+                return False
+            self.in_flight += 1
+            self.stats["accepted"] += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def expired(self):
+        """Requête répondue en 504 (compteur partagé avec les threads de l'executor)"""
+        with self._lock:
+            self.stats["deadline_exceeded"] += 1
+
+    def snapshot(self):
+        """Compteurs lus ensemble, sous le verrou"""
+        with self._lock:
+            return {"in_flight": self.in_flight, **self.stats}
+
+
+admission = Admission(ASGI_WORKERS + ASGI_QUEUE)
+api_server.metriques.callback('cardscan_admission_in_flight', "Requêtes dans l'executor (en cours + en file)",
+                              lambda: admission.in_flight)
+
+
+def _traiter(body, headers, query_string, deadline):
+    """Travail CPU exécuté dans l'executor (décodage, ORB, kNN, vote)"""
+    if time.monotonic() > deadline:
+        # Resté en file au-delà de son échéance : le client a déjà reçu un 504
+        raise DeadlineExceeded()
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'QUERY_STRING': query_string,
+        'wsgi.input': io.BytesIO(body),
+    }
+    image_bytes, data = api_server.lire_requete(Request(environ), 'image')
+    return api_server.traiter_recherche(image_bytes, data)
+
+
+async def _lire_corps(receive):
+    """Corps complet de la requête, ou None s'il dépasse MAX_BODY_BYTES"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _envoyer(send, status, payload, extra_headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(body)).encode()),
+               (b'access-control-allow-origin', b'*'),  # comme CORS(app) côté Flask
+               *extra_headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _search(scope, receive, send):
+    body = await _lire_corps(receive)
+    if body is None:
+        api_server.REQUESTS.inc(endpoint='search', outcome='too_large')
+        await _envoyer(send, 413, {"error": f"Image trop lourde (max {MAX_BODY_BYTES} octets)"})
+        return
+
+    # Admission : pas de place dans l'executor ni dans la file -> refus immédiat
+    if not admission.try_enter():
+        api_server.REQUESTS.inc(endpoint='search', outcome='overloaded')
+        await _envoyer(send, 503, {"error": "Serveur surchargé, réessayez"},
+                       [(b'retry-after', str(RETRY_AFTER).encode())])
+        return
+
+    deadline = time.monotonic() + REQUEST_DEADLINE
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    future = executor.submit(_traiter, body, headers, scope.get('query_string', b'').decode('latin-1'), deadline)
+    # La place n'est rendue qu'à la fin réelle du travail, même après un 504
+    future.add_done_callback(lambda _: admission.leave())
+    try:
+        payload, status, en_cache, etapes = await asyncio.wait_for(asyncio.wrap_future(future), REQUEST_DEADLINE)
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        admission.expired()
+        api_server.REQUESTS.inc(endpoint='search', outcome='deadline')
+        await _envoyer(send, 504, {"error": f"Délai dépassé ({REQUEST_DEADLINE:g} s)"})
+        return
+    except Exception as e:
+        api_server.REQUESTS.inc(endpoint='search', outcome='error')
+        await _envoyer(send, 500, {"error": str(e)})
+        return
+    headers = [(b'server-timing', api_server.server_timing(etapes).encode())]
+    if en_cache:
+        headers.append((b'x-cache', b'HIT'))
+    await _envoyer(send, status, payload, headers)
+
+
+async def _health(send):
+    infos = api_server.infos_sante()
+    infos["admission"] = {"workers": ASGI_WORKERS, "queue": ASGI_QUEUE, **admission.snapshot()}
+    await _envoyer(send, 200, infos)
+
+
+async def _metrics(send):
+    body = api_server.metriques.render().encode('utf-8')
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', CONTENT_TYPE.encode()),
+        (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _admin_reload(scope, receive, send):
+    await _lire_corps(receive)
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    payload, status = api_server.demander_rechargement(headers.get('x-admin-token'))
+    await _envoyer(send, status, payload)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    path, method = scope['path'], scope['method']
+    if method == 'OPTIONS':
+        # Pré-requête CORS de l'app Flutter web
+        await send({'type': 'http.response.start', 'status': 204, 'headers': [
+            (b'access-control-allow-origin', b'*'),
+            (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+            (b'access-control-allow-headers', b'content-type')]})
+        await send({'type': 'http.response.body', 'body': b''})
+    elif path == '/health' and method == 'GET':
+        await _health(send)
+    elif path == '/metrics' and method == 'GET':
+        await _metrics(send)
+    elif path == '/search' and method == 'POST':
+        await _search(scope, receive, send)
+    elif path == '/admin/reload' and method == 'POST':
+        await _admin_reload(scope, receive, send)
+    else:
+        await _envoyer(send, 404, {"error": "Route inconnue"})
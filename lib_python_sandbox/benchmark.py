@@ -0,0 +1,375 @@
+"""
+Banc d'essai hors ligne : précision et latence de la reconnaissance pour une
+grille de paramètres (extraction, index, ratio test, vérification).
+
+Requêtes étiquetées :
+- distorsions synthétiques d'images du catalogue : perspective (carte posée
+  de biais sur un fond), flou, reflet, compression JPEG
+- photos de templates/ si un fichier d'étiquettes les relie à leur carte
+  (--labels, ex. {"locklass.png": "<id de la carte dans cards.json>"})
+
+Les images du catalogue (bdd/catalog.sqlite ou bdd/pokemon_card_bdd.csv, comme
+l'indexeur) viennent du même chemin que l'indexeur (IMAGES_DIR, cache IMAGE_CACHE_DIR, téléchargement).
+Pour chaque configuration : recall@1 / @5, réponses acceptées (seuils du
+serveur) justes ou fausses, latence p50 / p95 par requête (ORB + kNN +
+ratio test + votes + vérification), temps de construction de l'index et
+mémoire résidente. Le rapport JSON se compare d'une version à l'autre.
+
+Usage :
+    python benchmark.py --cards 1000 --queries 100 --out bench.json
+    python benchmark.py --sweep grille.json --out bench.json --compare bench_precedent.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from brute_force_index import BruteForceIndex
+from descriptor_store import DescriptorStore, StoreWriter
+from finger_print_quick import RetryLater, card_id, card_metadata, image_bytes, load_rows
+from geometric_verification import verify_candidates
+from lsh_index import LshIndex
+from matching import count_votes, good_pairs, top_cards
+from mih_index import MihIndex
+from rectification import rectify_card
+from vocab_tree import VOCAB_PARAMS, CoarseToFineIndex, VocabTree
+
+# Mêmes réglages par défaut que api_server.py
+MAX_DIMENSION = 300
+DECODE_DIMENSION = 2 * MAX_DIMENSION
+INLIERS_MINIMUM = 6
+SCORE_MINIMUM = 8
+COARSE_TOP_N = 50
+
+# Grille par défaut : réglages de production et variantes essayées à la main
+DEFAULT_SWEEP = {
+    "nfeatures": [80, 150],
+    "index": [
+        {"engine": "lsh", "table_number": 1, "key_size": 6, "multi_probe_level": 0},
+        {"engine": "lsh", "table_number": 2, "key_size": 6, "multi_probe_level": 0},
+        {"engine": "lsh", "table_number": 1, "key_size": 8, "multi_probe_level": 0},
+        {"engine": "lsh", "table_number": 1, "key_size": 6, "multi_probe_level": 1},
+        {"engine": "lsh", "table_number": 2, "key_size": 8, "multi_probe_level": 1},
+        {"engine": "brute"},
+        {"engine": "mih"},
+    ],
+    "ratio": [0.75, 0.80],
+    "verify_top": [0, 5],
+}
+
+DISTORTIONS = ("perspective", "blur", "glare", "jpeg")
+
+
+# ========== REQUÊTES SYNTHÉTIQUES ==========
+
+def distort(gray, kind, rng):
+    """Image de la carte dégradée comme une photo : perspective, flou, reflet ou JPEG"""
+    h, w = gray.shape
+    if kind == "perspective":
+        # Carte posée de biais au milieu d'un fond texturé deux fois plus grand
+        canvas = cv2.GaussianBlur(rng.integers(0, 256, (2 * h, 2 * w), dtype=np.uint8), (31, 31), 0)
+        jitter = rng.uniform(-0.12, 0.12, (4, 2)) * [w, h]
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        target = np.float32(corners + [w / 2, h / 2] + jitter)
+        matrix = cv2.getPerspectiveTransform(corners, target)
+        card = cv2.warpPerspective(gray, matrix, (2 * w, 2 * h))
+        mask = cv2.warpPerspective(np.full_like(gray, 255), matrix, (2 * w, 2 * h))
+        return np.where(mask > 0, card, canvas)
+    if kind == "blur":
+        return cv2.GaussianBlur(gray, (0, 0), rng.uniform(1.5, 3.0))
+    if kind == "glare":
+        # Tache de lumière (sleeve, lampe) : ajout d'une gaussienne saturante
+        cy, cx = rng.uniform(0.2, 0.8) * h, rng.uniform(0.2, 0.8) * w
+        sigma = rng.uniform(0.1, 0.2) * max(h, w)
+        yy, xx = np.mgrid[0:h, 0:w]
+        spot = 220 * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * sigma ** 2))
+        return np.clip(gray + spot, 0, 255).astype(np.uint8)
+    if kind == "jpeg":
+        _, encoded = cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(10, 25))])
+        return cv2.imdecode(encoded, 0)
+    raise ValueError(f"Distorsion inconnue: {kind}")
+
+
+def prepare_query(gray):
+    """Comme decoder_image du serveur : réduction, redressement, sinon redimensionnement"""
+    if max(gray.shape) > DECODE_DIMENSION:
+        scale = DECODE_DIMENSION / max(gray.shape)
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    card = rectify_card(gray, MAX_DIMENSION)
+    if card is not None:
+        return card
+    if max(gray.shape) > MAX_DIMENSION:
+        scale = MAX_DIMENSION / max(gray.shape)
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+# ========== CATALOGUE ==========
+
+def fetch_gray(url):
+    try:
+        data = image_bytes(url)
+    except RetryLater:
+        return None
+    return None if data is None else cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 0)
+
+
+def load_catalog(catalog_path, n_cards, required_ids, rng):
+    """(métadonnées, images en niveaux de gris) de n_cards cartes tirées du catalogue + required_ids"""
+    rows = load_rows(catalog_path)
+    chosen = set(rng.choice(len(rows), min(n_cards, len(rows)), replace=False).tolist())
+    chosen |= {i for i, row in enumerate(rows) if card_id(row) in required_ids}
+    rows = [rows[i] for i in sorted(chosen)]
+    with ThreadPoolExecutor(16) as pool:
+        images = list(pool.map(fetch_gray, [row['image'].strip() for row in rows]))
+    cards = [card_metadata(row) for row, image in zip(rows, images) if image is not None]
+    images = [image for image in images if image is not None]
+    if len(cards) < len(rows):
+        print(f"⚠️ {len(rows) - len(cards)} images du catalogue introuvables, ignorées")
+    return cards, images
+
+
+def build_store(store_dir, cards, images, orb):
+    """Store de descripteurs de l'échantillon du catalogue pour un réglage d'extraction"""
+    with StoreWriter(store_dir) as writer:
+        for card, image in zip(cards, images):
+            keypoints, descriptors = orb.detectAndCompute(image, None)
+            if descriptors is None:
+                descriptors, keypoints = np.zeros((0, 32), dtype=np.uint8), []
+            writer.add(card, descriptors, np.float32([kp.pt for kp in keypoints]).reshape(-1, 2))
+    return DescriptorStore(store_dir)
+
+
+def build_index(store, params):
+    engine = params["engine"]
+    if engine == "lsh":
+        return LshIndex.build(store.descriptors, params["table_number"], params["key_size"],
+                              params["multi_probe_level"])
+    if engine == "brute":
+        return BruteForceIndex(store.descriptors)
+    if engine == "mih":
+        return MihIndex.build(store.descriptors)
+    if engine == "vocab":
+        tree = VocabTree.build(store, **VOCAB_PARAMS)
+        return CoarseToFineIndex(store, tree, params.get("top_n", COARSE_TOP_N))
+    raise ValueError(f"Moteur inconnu: {engine}")
+
+
+def rss_mb():
+    """Mémoire résidente actuelle du process (Linux), sinon le pic"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# ========== ÉVALUATION ==========
+
+def rank_cards(store, keypoints, distances, indices, ratio, verify_top):
+    """Cartes classées comme le serveur (votes, puis inliers parmi les verify_top premières) et acceptation"""
+    query_idx, good_matches = good_pairs(distances, indices, ratio)
+    votes = count_votes(good_matches, store.card_of_row, store.n_cards)
+    ranking = top_cards(votes, max(5, verify_top))
+    ranking = ranking[votes[ranking] > 0]
+    if len(ranking) == 0:
+        return ranking, False
+    if verify_top > 0 and store.keypoints is not None:
+        head = ranking[:verify_top]
+        inliers = verify_candidates(head, query_idx, good_matches, keypoints, store.card_of_row, store.keypoints)
+        order = np.argsort(-inliers, kind='stable')
+        ranking = np.concatenate([head[order], ranking[verify_top:]])
+        return ranking, int(inliers[order[0]]) >= INLIERS_MINIMUM
+    return ranking, int(votes[ranking[0]]) >= SCORE_MINIMUM
+
+
+def summarize(hits, latencies):
+    """hits : liste de (rang de la bonne carte ou None, acceptée)"""
+    n = len(hits)
+    top1 = [rank == 0 for rank, _ in hits]
+    return {
+        "queries": n,
+        "recall@1": round(sum(top1) / n, 4) if n else None,
+        "recall@5": round(sum(rank is not None and rank < 5 for rank, _ in hits) / n, 4) if n else None,
+        "accepted_correct": round(sum(ok and accepted for ok, (_, accepted) in zip(top1, hits)) / n, 4) if n else None,
+        "accepted_wrong": round(sum(not ok and accepted for ok, (_, accepted) in zip(top1, hits)) / n, 4) if n else None,
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)) * 1000, 2) if n else None,
+            "p95": round(float(np.percentile(latencies, 95)) * 1000, 2) if n else None,
+            "mean": round(float(np.mean(latencies)) * 1000, 2) if n else None,
+        },
+    }
+
+
+def expand_sweep(sweep):
+    """Produit cartésien de la grille -> liste de configurations"""
+    return [dict(nfeatures=nf, index=idx, ratio=r, verify_top=v)
+            for nf, idx, r, v in itertools.product(sweep["nfeatures"], sweep["index"],
+                                                   sweep["ratio"], sweep["verify_top"])]
+
+
+def run(cards, images, queries, sweep):
+    """
+    queries : liste de (source, index de la carte attendue, image prête pour ORB).
+    L'extraction est faite une fois par nfeatures et le kNN une fois par index ;
+    ratio test et vérification sont rejoués sur ses résultats.
+    """
+    results = []
+    tmp_root = tempfile.mkdtemp(prefix="bench-")
+    try:
+        for nfeatures in sweep["nfeatures"]:
+            orb = cv2.ORB_create(nfeatures=nfeatures)
+            store = build_store(os.path.join(tmp_root, f"nf{nfeatures}"), cards, images, orb)
+            extracted = []
+            for _, _, image in queries:
+                start = time.perf_counter()
+                keypoints, descriptors = orb.detectAndCompute(image, None)
+                extracted.append((keypoints, descriptors, time.perf_counter() - start))
+
+            for params in sweep["index"]:
+                rss_before = rss_mb()
+                start = time.perf_counter()
+                index = build_index(store, params)
+                build_seconds = time.perf_counter() - start
+                index_rss = rss_mb() - rss_before
+
+                searched = []
+                for keypoints, descriptors, _ in extracted:
+                    if descriptors is None:
+                        searched.append((None, None, 0.0))
+                        continue
+                    start = time.perf_counter()
+                    distances, indices = index.knn_search(descriptors, 2)
+                    searched.append((distances, indices, time.perf_counter() - start))
+
+                for ratio, verify_top in itertools.product(sweep["ratio"], sweep["verify_top"]):
+                    hits, latencies, by_source = [], [], {}
+                    for (source, expected, _), (keypoints, _, t_orb), (distances, indices, t_knn) in \
+                            zip(queries, extracted, searched):
+                        start = time.perf_counter()
+                        if distances is None:
+                            ranking, accepted = np.empty(0, dtype=np.intp), False
+                        else:
+                            ranking, accepted = rank_cards(store, keypoints, distances, indices, ratio, verify_top)
+                        latency = t_orb + t_knn + time.perf_counter() - start
+                        found = np.flatnonzero(ranking == expected)
+                        hit = (int(found[0]) if len(found) else None, accepted)
+                        hits.append(hit)
+                        latencies.append(latency)
+                        by_source.setdefault(source, ([], []))
+                        by_source[source][0].append(hit)
+                        by_source[source][1].append(latency)
+
+                    result = {"config": dict(nfeatures=nfeatures, index=params, ratio=ratio, verify_top=verify_top),
+                              **summarize(hits, latencies),
+                              "index_build_seconds": round(build_seconds, 3),
+                              "index_rss_mb": round(index_rss, 1),
+                              "rss_mb": round(rss_mb(), 1),
+                              "by_source": {s: {k: v for k, v in summarize(*values).items() if k != "queries"}
+                                            for s, values in sorted(by_source.items())}}
+                    results.append(result)
+                    print(f"{config_label(result['config']):<58} R@1 {result['recall@1']:.3f}  "
+                          f"R@5 {result['recall@5']:.3f}  faux {result['accepted_wrong']:.3f}  "
+                          f"p50 {result['latency_ms']['p50']:7.2f} ms  p95 {result['latency_ms']['p95']:7.2f} ms  "
+                          f"build {build_seconds:6.2f} s")
+                del index
+            del store
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+    return results
+
+
+def config_label(config):
+    index = config["index"]
+    engine = index["engine"] + "".join(f" {k[0]}{v}" for k, v in index.items() if k != "engine")
+    return f"nf={config['nfeatures']} {engine} ratio={config['ratio']} verify={config['verify_top']}"
+
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def compare(report, previous):
+    """Écarts de recall et de latence avec un rapport précédent, configuration par configuration"""
+    before = {config_key(r["config"]): r for r in previous["results"]}
+    print(f"\nComparaison avec {previous.get('created', '?')} :")
+    if previous.get("dataset") != report["dataset"]:
+        print(f"⚠️ Jeux de requêtes différents ({previous.get('dataset')} / {report['dataset']}) : écarts peu fiables")
+    for r in report["results"]:
+        old = before.get(config_key(r["config"]))
+        if old is None:
+            continue
+        print(f"{config_label(r['config']):<58} "
+              f"R@1 {r['recall@1'] - old['recall@1']:+.3f}  R@5 {r['recall@5'] - old['recall@5']:+.3f}  "
+              f"p50 {r['latency_ms']['p50'] - old['latency_ms']['p50']:+7.2f} ms  "
+              f"p95 {r['latency_ms']['p95'] - old['latency_ms']['p95']:+7.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banc d'essai précision / latence de la reconnaissance")
+    parser.add_argument('--catalog', '--csv', help="catalogue SQLite ou CSV (défaut : celui de finger_print_quick.py)")
+    parser.add_argument('--cards', type=int, default=1000, help="cartes du catalogue indexées")
+    parser.add_argument('--queries', type=int, default=100, help="cartes déformées (x4 distorsions)")
+    parser.add_argument('--templates', default='templates', help="dossier des photos réelles")
+    parser.add_argument('--labels', default='templates/labels.json', help="{fichier: id de carte}")
+    parser.add_argument('--sweep', help="grille JSON (mêmes clés que DEFAULT_SWEEP)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', help="rapport précédent à comparer")
+    args = parser.parse_args()
+
+    sweep = DEFAULT_SWEEP
+    if args.sweep:
+        with open(args.sweep, 'r', encoding='utf-8') as f:
+            sweep = {**DEFAULT_SWEEP, **json.load(f)}
+
+    labels = {}
+    if os.path.exists(args.labels):
+        with open(args.labels, 'r', encoding='utf-8') as f:
+            labels = json.load(f)
+    else:
+        print(f"⚠️ {args.labels} absent : photos de {args.templates} non utilisées")
+
+    rng = np.random.default_rng(args.seed)
+    t0 = time.perf_counter()
+    cards, images = load_catalog(args.catalog, args.cards, set(labels.values()), rng)
+    position = {card['id']: i for i, card in enumerate(cards)}
+    print(f"✅ {len(cards)} cartes du catalogue chargées en {time.perf_counter() - t0:.1f} s")
+
+    queries = []
+    for i in rng.choice(len(cards), min(args.queries, len(cards)), replace=False):
+        for kind in DISTORTIONS:
+            queries.append((kind, int(i), prepare_query(distort(images[i], kind, rng))))
+    for name, cid in sorted(labels.items()):
+        photo = cv2.imread(os.path.join(args.templates, name), 0)
+        if photo is None or cid not in position:
+            print(f"⚠️ {name} ignorée ({'image illisible' if photo is None else 'carte absente du catalogue'})")
+            continue
+        queries.append(("photo", position[cid], prepare_query(photo)))
+    print(f"✅ {len(queries)} requêtes étiquetées")
+
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+                        "cpu_count": os.cpu_count(), "machine": platform.machine()},
+        "dataset": {"cards": len(cards), "seed": args.seed,
+                    "queries": {s: sum(q[0] == s for q in queries) for s in (*DISTORTIONS, "photo")}},
+        "sweep": sweep,
+        "results": run(cards, images, queries, sweep),
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"✅ Rapport écrit dans {args.out}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
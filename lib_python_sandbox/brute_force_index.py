@@ -0,0 +1,98 @@
+"""
+Recherche exacte des k plus proches voisins (Hamming) par force brute.
+
+La super_matrix est vue comme des mots uint64 (4 par descripteur ORB) et
+parcourue par blocs dont le tableau de distances tient dans le cache ;
+les blocs sont répartis sur un pool de threads (numpy relâche le GIL),
+commun à tous les index : un rechargement ou un nouveau segment ne crée pas
+de threads en plus.
+Même interface que LshIndex.knn_search : (distances, indices) en (n, k).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from hamming import as_words, encode_keys, hamming_matrix, merge_top_k
+
+# Taille visée pour la matrice de distances d'un bloc (n_query x block_rows x 8 octets)
+CACHE_BYTES = 512 * 1024
+MIN_BLOCK_ROWS = 256
+# Au-delà, la requête (lot d'images empilées) est elle aussi découpée en paquets
+QUERY_BLOCK_ROWS = CACHE_BYTES // (8 * MIN_BLOCK_ROWS)
+
+# Pools de threads partagés, par nombre de threads
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(workers):
+    """Pool de `workers` threads commun à tous les index qui en demandent autant"""
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"knn-{workers}")
+        return _pools[workers]
+
+
+class BruteForceIndex:
+    """kNN exact sur une matrice (n_rows, 32) uint8, éventuellement memmap"""
+
+    def __init__(self, descriptors, workers=None):
+        self.words = as_words(descriptors)
+        self.n_rows = len(self.words)
+        self._pool = shared_pool(workers or os.cpu_count())
+
+    def _block_top_k(self, query_words, block, k):
+        # block = (start, stop) contigu, ou tableau de lignes (sous-ensemble)
+        if isinstance(block, tuple):
+            rows = np.arange(block[0], block[1], dtype=np.int64)
+            block_words = self.words[block[0]:block[1]]
+        else:
+            rows = block
+            block_words = self.words[block]
+        distances = hamming_matrix(query_words, block_words)
+        keys = encode_keys(distances, rows[None, :])
+        if keys.shape[1] > k:
+            keys = np.partition(keys, k - 1, axis=1)[:, :k]
+        return keys
+
+    def range_top_k_keys(self, query_words, start, stop, k):
+        """Clés (distance << 32 | ligne) des k plus proches parmi les lignes [start, stop), sans thread"""
+        block_rows = max(MIN_BLOCK_ROWS, CACHE_BYTES // (8 * len(query_words)))
+        partial = [self._block_top_k(query_words, (first, min(first + block_rows, stop)), k)
+                   for first in range(start, stop, block_rows)]
+        keys = np.concatenate(partial, axis=1)
+        if keys.shape[1] > k:
+            keys = np.partition(keys, k - 1, axis=1)[:, :k]
+        return keys
+
+    def knn_search(self, query, k=2, rows=None):
+        """
+        k plus proches voisins exacts ; -1 si la base a moins de k lignes.
+        rows : restreint la recherche à ces lignes de la super_matrix
+        (les indices renvoyés restent ceux de la super_matrix).
+        """
+        query_words = as_words(query)
+        n = len(query_words)
+        n_rows = self.n_rows if rows is None else len(rows)
+        if n == 0 or n_rows == 0:
+            empty = np.full((n, k), -1, dtype=np.int32)
+            return empty, empty.copy()
+
+        # Tuiles (paquet de requête x bloc de lignes) dont les distances tiennent dans le cache
+        query_chunks = [query_words[start:start + QUERY_BLOCK_ROWS] for start in range(0, n, QUERY_BLOCK_ROWS)]
+        block_rows = max(MIN_BLOCK_ROWS, CACHE_BYTES // (8 * len(query_chunks[0])))
+        if rows is None:
+            blocks = [(start, min(start + block_rows, n_rows))
+                      for start in range(0, n_rows, block_rows)]
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            blocks = [rows[start:start + block_rows] for start in range(0, n_rows, block_rows)]
+
+        # Mêmes blocs pour chaque paquet : les clés partielles ont toutes la même largeur
+        keys = []
+        for chunk in query_chunks:
+            partial = self._pool.map(lambda b: self._block_top_k(chunk, b, k), blocks)
+            keys.append(np.concatenate(list(partial), axis=1))
+        return merge_top_k(np.concatenate(keys), k)
@@ -0,0 +1,210 @@
+"""
+Catalogue des cartes : pokemon-tcg-data (cards/en/*.json + sets/en.json) ->
+une base SQLite typée et indexée, construite en une passe.
+
+    sets    id (clé), name, series, ptcgo_code, release_date
+    cards   id pokemon-tcg (clé, ex. 'base1-4'), set_id, position (ordre dans
+            le fichier du set), name, number, image, cm_url (Cardmarket, NULL si
+            la source ne la donne pas)
+    meta    source (taille et date des fichiers lus), built_at, cards
+
+Les fichiers de cartes (~170 fichiers, 25 Mo) sont décodés en parallèle par
+un pool de process et insérés au fil de l'eau, dans une seule transaction,
+dans une base temporaire renommée à la fin (os.replace) : un lecteur voit
+l'ancien catalogue ou le nouveau, jamais une base à moitié écrite. Une
+reconstruction dont la source n'a pas changé est sautée (--force pour la
+forcer).
+
+Remplace la chaîne bdd_brut_json.py -> json_to_bdd_final.py -> CSV : l'indexeur
+(finger_print_quick.py) lit le catalogue s'il existe (sinon le CSV), le
+serveur y cherche l'URL Cardmarket des cartes reconnues.
+
+Usage :
+    python catalog.py                                   # -> bdd/catalog.sqlite
+    python catalog.py --data ../pokemon-tcg-data-master --out bdd/catalog.sqlite --force
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+CATALOG_VERSION = 1
+DATA_DIR = '../pokemon-tcg-data-master'
+CATALOG_FILE = 'bdd/catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE sets (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    series TEXT NOT NULL,
+    ptcgo_code TEXT NOT NULL,
+    release_date TEXT NOT NULL
+);
+CREATE TABLE cards (
+    id TEXT PRIMARY KEY,
+    set_id TEXT NOT NULL REFERENCES sets(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    number TEXT NOT NULL,
+    image TEXT NOT NULL,
+    cm_url TEXT
+) WITHOUT ROWID;
+"""
+# Créés après le chargement : moins cher que de les tenir à jour ligne par ligne
+INDEXES = """
+CREATE INDEX cards_set_number ON cards(set_id, number);
+CREATE INDEX cards_name ON cards(name);
+"""
+
+# Mêmes champs que les lignes du CSV (finger_print_quick.card_metadata), plus les colonnes du catalogue
+ROWS_QUERY = """
+SELECT c.id AS tcg_id, c.name, c.number, s.name AS set_name, c.image, s.release_date,
+       s.ptcgo_code AS ip_set_card, c.set_id, s.series, c.cm_url
+FROM cards c JOIN sets s ON s.id = c.set_id
+"""
+
+
+def source_files(data_dir):
+    cards_dir = os.path.join(data_dir, 'cards', 'en')
+    paths = [os.path.join(data_dir, 'sets', 'en.json')]
+    paths += sorted(os.path.join(cards_dir, name) for name in os.listdir(cards_dir) if name.endswith('.json'))
+    return paths
+
+
+def source_signature(paths):
+    """Taille et date de modification des fichiers source : change si l'un d'eux change"""
+    return json.dumps([[os.path.basename(p), os.path.getsize(p), int(os.path.getmtime(p))] for p in paths])
+
+
+def parse_card_file(path):
+    """(set_id, [ligne de cards]) d'un fichier cards/en/<set_id>.json ; exécuté dans un process du pool"""
+    set_id = os.path.basename(path)[:-len('.json')]
+    with open(path, 'r', encoding='utf-8') as f:
+        cards = json.load(f)
+    return set_id, [(card['id'], set_id, position, card.get('name') or '', card.get('number') or '',
+                     (card.get('images') or {}).get('small') or '', (card.get('cardmarket') or {}).get('url'))
+                    for position, card in enumerate(cards)]
+
+
+def build_catalog(data_dir=DATA_DIR, output=CATALOG_FILE, workers=None, force=False):
+    """Construit le catalogue ; renvoie le nombre de cartes (None si la source n'a pas changé)"""
+    paths = source_files(data_dir)
+    signature = source_signature(paths)
+    if not force and os.path.exists(output):
+        try:
+            with Catalog(output) as existing:
+                if existing.meta.get('source') == signature:
+                    return None
+        except sqlite3.Error:
+            pass
+
+    with open(paths[0], 'r', encoding='utf-8') as f:
+        sets = json.load(f)
+    tmp_path = f"{output}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # Base jetable jusqu'au renommage : pas de journal, pas de fsync par page
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.executemany('INSERT INTO sets VALUES (?, ?, ?, ?, ?)',
+                             [(s['id'], s['name'], s.get('series') or '', s.get('ptcgoCode') or '',
+                               s.get('releaseDate') or '') for s in sets])
+            known_sets = {s['id'] for s in sets}
+            n_cards = 0
+            with ProcessPoolExecutor(workers) as pool:
+                for set_id, rows in pool.map(parse_card_file, paths[1:], chunksize=8):
+                    if set_id not in known_sets:
+                        print(f"⚠️ Set '{set_id}' absent de sets/en.json : cartes ignorées")
+                        continue
+                    conn.executemany('INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                    n_cards += len(rows)
+            conn.executescript(INDEXES)
+            conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(CATALOG_VERSION)), ('source', signature),
+                ('built_at', time.strftime('%Y-%m-%dT%H:%M:%S')), ('cards', str(n_cards))])
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+    os.replace(tmp_path, output)
+    return n_cards
+
+
+class Catalog:
+    """Lecture seule ; une connexion par thread (sqlite3 ne les partage pas entre threads)"""
+
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._connect()  # erreur tout de suite si la base est absente ou illisible
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def meta(self):
+        return dict(self._connect().execute('SELECT key, value FROM meta').fetchall())
+
+    def rows(self):
+        """Toutes les cartes (dicts), par date de sortie du set puis ordre du fichier du set"""
+        query = ROWS_QUERY + ' ORDER BY s.release_date, c.set_id, c.position'
+        return [dict(row) for row in self._connect().execute(query)]
+
+    def get(self, tcg_id):
+        row = self._connect().execute(ROWS_QUERY + ' WHERE c.id = ?', (tcg_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def find(self, set_id, number):
+        row = self._connect().execute(ROWS_QUERY + ' WHERE c.set_id = ? AND c.number = ?',
+                                      (set_id, number)).fetchone()
+        return None if row is None else dict(row)
+
+    def lookup(self, card):
+        """Ligne du catalogue d'une carte du store (tcg_id, ou set_id + numéro pour les stores plus anciens)"""
+        if card.get('tcg_id'):
+            return self.get(card['tcg_id'])
+        if card.get('set_id') and card.get('number'):
+            return self.find(card['set_id'], card['number'])
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Construit le catalogue SQLite depuis pokemon-tcg-data")
+    parser.add_argument('--data', default=DATA_DIR, help="dossier pokemon-tcg-data-master")
+    parser.add_argument('--out', default=CATALOG_FILE)
+    parser.add_argument('--workers', type=int, help="process de décodage (défaut : un par coeur)")
+    parser.add_argument('--force', action='store_true', help="reconstruire même si la source n'a pas changé")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_cards = build_catalog(args.data, args.out, args.workers, args.force)
+    if n_cards is None:
+        print(f"✅ {args.out} déjà à jour (--force pour reconstruire)")
+    else:
+        print(f"✅ {n_cards} cartes écrites dans {args.out} en {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,209 @@
+"""
+Store de descripteurs ORB sur disque, ouvert avec np.memmap.
+
+Format d'un store (un dossier) :
+    header.json      version du format, nombre de lignes et de cartes
+    descriptors.u8   matrice uint8 contiguë (n_rows x 32), toutes cartes à la suite
+    offsets.i32      table int32 (n_cards + 1) : la carte i possède les lignes
+                     offsets[i]:offsets[i+1] de descriptors.u8
+    cards.json       métadonnées des cartes (au minimum 'id'), dans le même ordre
+    keypoints.f16    (optionnel) coordonnées x/y float16 (n_rows x 2) du keypoint
+                     de chaque descripteur, pour la vérification géométrique
+    phash.u64        (optionnel) pHash 64 bits de l'image de chaque carte (n_cards,)
+
+Le chargement ne copie rien : les pages sont lues à la demande et partagées
+par tous les process du serveur via le cache du noyau.
+
+Conversion d'un ancien orb_db.pkl :
+    python descriptor_store.py orb_db.pkl orb_store
+"""
+import json
+import os
+import pickle
+import shutil
+import sys
+from functools import cached_property
+
+import numpy as np
+
+STORE_VERSION = 1
+DESCRIPTOR_BYTES = 32  # ORB = 256 bits
+
+HEADER_FILE = "header.json"
+DESCRIPTORS_FILE = "descriptors.u8"
+OFFSETS_FILE = "offsets.i32"
+CARDS_FILE = "cards.json"
+KEYPOINTS_FILE = "keypoints.f16"
+PHASH_FILE = "phash.u64"
+
+
+def concat_ranges(starts, lengths):
+    """Concatène les plages [start, start + length) en un seul tableau d'index (vectorisé)"""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    first = np.cumsum(lengths) - lengths
+    return np.arange(total) - np.repeat(first, lengths) + np.repeat(starts, lengths)
+
+
+def store_exists(store_dir):
+    """Un store est complet uniquement si son header a été écrit"""
+    return os.path.exists(os.path.join(store_dir, HEADER_FILE))
+
+
+class StoreWriter:
+    """Écrit un store en flux, carte par carte, sans tout garder en RAM"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        # On écrit dans un dossier temporaire renommé à la fin :
+        # un lecteur ne voit jamais un store à moitié écrit
+        self._tmp_dir = f"{store_dir}.tmp-{os.getpid()}"
+        if os.path.exists(self._tmp_dir):
+            shutil.rmtree(self._tmp_dir)
+        os.makedirs(self._tmp_dir)
+        self._desc_file = open(os.path.join(self._tmp_dir, DESCRIPTORS_FILE), 'wb')
+        self._kp_file = None
+        self._phashes = None
+        self._offsets = [0]
+        self._cards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._desc_file.close()
+            if self._kp_file is not None:
+                self._kp_file.close()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def add(self, card, descriptors, keypoints=None, phash=None):
+        """
+        Ajoute une carte (dict avec au moins 'id') et ses descripteurs.
+        keypoints : coordonnées (n, 2) des keypoints, pour toutes les cartes ou aucune.
+        phash : hash perceptuel 64 bits de l'image, pour toutes les cartes ou aucune.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+        if descriptors.ndim != 2 or descriptors.shape[1] != DESCRIPTOR_BYTES:
+            raise ValueError(f"Descripteurs invalides pour {card.get('id')}: {descriptors.shape}")
+
+        if len(self._cards) == 0 and keypoints is not None:
+            self._kp_file = open(os.path.join(self._tmp_dir, KEYPOINTS_FILE), 'wb')
+        if (keypoints is not None) != (self._kp_file is not None):
+            raise ValueError(f"Keypoints fournis pour une partie des cartes seulement ({card.get('id')})")
+        if keypoints is not None:
+            keypoints = np.asarray(keypoints, dtype=np.float16)
+            if keypoints.shape != (len(descriptors), 2):
+                raise ValueError(f"Keypoints invalides pour {card.get('id')}: {keypoints.shape}")
+            self._kp_file.write(keypoints.tobytes())
+
+        if len(self._cards) == 0 and phash is not None:
+            self._phashes = []
+        if (phash is not None) != (self._phashes is not None):
+            raise ValueError(f"pHash fourni pour une partie des cartes seulement ({card.get('id')})")
+        if phash is not None:
+            self._phashes.append(phash)
+
+        self._desc_file.write(descriptors.tobytes())
+        self._offsets.append(self._offsets[-1] + len(descriptors))
+        self._cards.append(card)
+
+    def close(self):
+        self._desc_file.close()
+        if self._kp_file is not None:
+            self._kp_file.close()
+        np.asarray(self._offsets, dtype=np.int32).tofile(os.path.join(self._tmp_dir, OFFSETS_FILE))
+        with open(os.path.join(self._tmp_dir, CARDS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self._cards, f, ensure_ascii=False)
+        if self._phashes is not None:
+            np.asarray(self._phashes, dtype=np.uint64).tofile(os.path.join(self._tmp_dir, PHASH_FILE))
+
+        # Le header en dernier : sa présence signale un store complet
+        header = {
+            "version": STORE_VERSION,
+            "n_rows": self._offsets[-1],
+            "n_cards": len(self._cards),
+            "descriptor_bytes": DESCRIPTOR_BYTES,
+            "keypoints": self._kp_file is not None,
+            "phash": self._phashes is not None,
+        }
+        with open(os.path.join(self._tmp_dir, HEADER_FILE), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.replace(self._tmp_dir, self.store_dir)
+
+
+class DescriptorStore:
+    """Vue en lecture seule (memmap) d'un store écrit par StoreWriter"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, HEADER_FILE), 'r', encoding='utf-8') as f:
+            self.header = json.load(f)
+        if self.header.get("version") != STORE_VERSION:
+            raise ValueError(f"Version de store non supportée: {self.header.get('version')}")
+
+        self.n_rows = self.header["n_rows"]
+        self.n_cards = self.header["n_cards"]
+
+        if self.n_rows > 0:
+            self.descriptors = np.memmap(os.path.join(store_dir, DESCRIPTORS_FILE), dtype=np.uint8,
+                                         mode='r', shape=(self.n_rows, DESCRIPTOR_BYTES))
+        else:
+            # np.memmap refuse les fichiers vides
+            self.descriptors = np.zeros((0, DESCRIPTOR_BYTES), dtype=np.uint8)
+        self.offsets = np.memmap(os.path.join(store_dir, OFFSETS_FILE), dtype=np.int32,
+                                 mode='r', shape=(self.n_cards + 1,))
+
+        # Coordonnées des keypoints, absentes pour un store converti depuis un pickle
+        self.keypoints = None
+        if self.header.get("keypoints") and self.n_rows > 0:
+            self.keypoints = np.memmap(os.path.join(store_dir, KEYPOINTS_FILE), dtype=np.float16,
+                                       mode='r', shape=(self.n_rows, 2))
+
+        # pHash par carte, absent si le store n'a pas été construit depuis les images
+        self.phashes = None
+        if self.header.get("phash"):
+            self.phashes = np.fromfile(os.path.join(store_dir, PHASH_FILE), dtype=np.uint64)
+
+        with open(os.path.join(store_dir, CARDS_FILE), 'r', encoding='utf-8') as f:
+            self.cards = json.load(f)
+
+    @cached_property
+    def card_of_row(self):
+        """Index (int32) de la carte de chaque ligne de descriptors"""
+        counts = np.diff(self.offsets)
+        return np.repeat(np.arange(self.n_cards, dtype=np.int32), counts)
+
+    def rows_of_cards(self, cards):
+        """Lignes de la matrice appartenant à un ensemble de cartes"""
+        cards = np.asarray(cards, dtype=np.int64)
+        starts = self.offsets[cards]
+        return concat_ranges(starts, self.offsets[cards + 1] - starts)
+
+
+def convert_pickle(pkl_path, store_dir):
+    """Convertit un ancien orb_db.pkl (liste de {'id', 'descriptors'}) en store"""
+    with open(pkl_path, 'rb') as f:
+        db_cartes = pickle.load(f)
+
+    with StoreWriter(store_dir) as writer:
+        for carte in db_cartes:
+            if carte['descriptors'] is not None:
+                writer.add({'id': carte['id']}, carte['descriptors'])
+    return store_dir
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python descriptor_store.py orb_db.pkl orb_store")
+        sys.exit(1)
+
+    convert_pickle(sys.argv[1], sys.argv[2])
+    store = DescriptorStore(sys.argv[2])
+    print(f"✅ Store '{sys.argv[2]}' créé : {store.n_cards} cartes, {store.n_rows} descripteurs")
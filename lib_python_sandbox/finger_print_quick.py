@@ -1,69 +1,441 @@
+"""
+Indexeur ORB : images du catalogue (bdd/catalog.sqlite, construit par catalog.py,
+ou à défaut bdd/pokemon_card_bdd.csv) -> store lu par api_server.py.
+
+Indexation en flux, reprenable après un crash :
+- deux étages : DOWNLOAD_CONCURRENCY téléchargements en parallèle (asyncio,
+  connexions réutilisées) remplissent une file bornée que INDEX_PROCESSES
+  process vident (décodage, ORB, pHash ; un extracteur ORB par process)
+- chaque image est lue dans IMAGES_DIR (miroir local set/fichier, reconstruction
+  hors ligne), puis dans le cache IMAGE_CACHE_DIR (image_cache.py), et n'est
+  téléchargée qu'à défaut (jamais avec OFFLINE=1)
+- les cartes sont écrites par paquets de FLUSH_EVERY dans PARTS_DIR, un store
+  segmenté de travail : son manifest sert de point de reprise, une relance ne
+  traite que les cartes absentes des paquets
+- une carte en échec passager (réseau, 429/5xx) est retentée à la relance suivante,
+  et écartée après MAX_FAILED_RUNS exécutions en échec : elle ne bloque pas la fusion
+- quand tout est traité, les paquets sont fusionnés set par set dans orb_store
+  (ou dans un segment delta si orb_store est segmenté) et PARTS_DIR est supprimé
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import time
 import pandas as pd
 import cv2
 import requests
 import numpy as np
-import pickle
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
-orb = cv2.ORB_create(nfeatures=80)  # Augmenté à 80 pour meilleure précision
+from catalog import CATALOG_FILE, Catalog
+from descriptor_store import DescriptorStore, StoreWriter
+from image_cache import ImageCache
+from lsh_index import LSH_PARAMS, LshIndex
+from mih_index import MihIndex
+from perceptual_hash import phash
+from segments import SegmentedStore, add_segment, is_segmented, read_manifest, write_manifest
+from vocab_tree import VOCAB_PARAMS, VocabTree
+
+ORB_NFEATURES = 80  # Augmenté à 80 pour meilleure précision
+_orb = None  # un extracteur par process du pool (cv2.ORB n'est pas partageable entre threads)
+
+STORE_DIR = "orb_store"
+# Store segmenté (python segments.py init orb_store) : seules les cartes absentes sont
+# indexées, dans ce store temporaire, puis publiées comme segment delta (rechargement à chaud)
+DELTA_DIR = "orb_store_delta"
+
+PARTS_DIR = os.environ.get('PARTS_DIR', 'orb_store_parts')
+SKIPPED_FILE = "skipped.json"  # cartes écartées pour de bon (404, image illisible, trop peu de features)
+FAILURES_FILE = "failures.json"  # nombre d'exécutions en échec passager de chaque carte
+# Au-delà, une carte toujours en échec passager (URL en 429/5xx permanent...) est écartée :
+# les autres cartes sont fusionnées au lieu d'attendre indéfiniment
+MAX_FAILED_RUNS = int(os.environ.get('MAX_FAILED_RUNS', '3'))
+FLUSH_EVERY = int(os.environ.get('FLUSH_EVERY', '500'))
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')  # '' = pas de cache
+IMAGES_DIR = os.environ.get('IMAGES_DIR', '')
+OFFLINE = os.environ.get('OFFLINE', '0') == '1'
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', '20'))  # secondes (connexion et lecture)
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', '3'))  # nouvelles tentatives après 1 s, 2 s, 4 s...
+
+# Étage E/S (threads qui attendent le réseau) et étage CPU (un process par coeur)
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', '32'))
+INDEX_PROCESSES = int(os.environ.get('INDEX_PROCESSES', str(os.cpu_count() or 1)))
+QUEUE_SIZE = 2 * INDEX_PROCESSES  # images téléchargées en attente d'un process : mémoire bornée
+
+image_cache = ImageCache(IMAGE_CACHE_DIR) if IMAGE_CACHE_DIR else None
+
+# Connexions keep-alive réutilisées par tous les threads de téléchargement
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_maxsize=DOWNLOAD_CONCURRENCY))
+session.mount('https://', HTTPAdapter(pool_maxsize=DOWNLOAD_CONCURRENCY))
 
+# Catalogue SQLite (catalog.py) ; sans lui, l'ancien CSV
+CATALOG_DB = os.environ.get('CATALOG_DB', CATALOG_FILE)
+CSV_FILE = 'bdd/pokemon_card_bdd.csv'
 
-def url_to_image(url):
-    """Télécharge une image depuis une URL et la convertit pour OpenCV"""
+# Série de chaque set (pokemon-tcg-data), pour les filtres de /search (lignes du CSV)
+SETS_FILE = '../pokemon-tcg-data-master/sets/en.json'
+
+
+class RetryLater(Exception):
+    """Échec passager (réseau, timeout, 5xx) : la carte est retentée à la prochaine exécution"""
+
+
+# Erreurs de lecture d'une ligne du catalogue (card_metadata) : la carte est écartée
+MALFORMED_ROW = (KeyError, IndexError, ValueError, TypeError, AttributeError)
+
+
+def load_series_by_set():
+    """{set_id: série} depuis pokemon-tcg-data, vide si le fichier manque"""
     try:
-        # 1. On télécharge l'image brute
-        # stream=True permet de ne pas tout charger d'un coup si l'image est énorme
-        resp = requests.get(url, stream=True, headers={'User-Agent': 'Mozilla/5.0'})
-                
-        # 2. On transforme les octets en tableau NumPy
-        image_array = np.asarray(bytearray(resp.content), dtype=np.uint8)
-        
-        # 3. On décode l'image pour OpenCV (0 = Noir et Blanc direct, idéal pour SIFT)
-        img = cv2.imdecode(image_array, 0)
-        
-        return img
-    except Exception as e:
-        print(f"Erreur de téléchargement pour {url}: {e}")
+        with open(SETS_FILE, 'r', encoding='utf-8') as f:
+            return {s['id']: s.get('series', '') for s in json.load(f)}
+    except FileNotFoundError:
+        print(f"⚠️ {SETS_FILE} introuvable : séries non renseignées")
+        return {}
+
+
+def image_bytes(url):
+    """Octets de l'image : miroir local, cache, puis téléchargement ; None si elle n'existe pas"""
+    if IMAGES_DIR:
+        # https://images.pokemontcg.io/base1/1.png -> IMAGES_DIR/base1/1.png
+        local_path = os.path.join(IMAGES_DIR, *url.rstrip('/').split('/')[-2:])
+        if os.path.exists(local_path):
+            with open(local_path, 'rb') as f:
+                return f.read()
+    if image_cache is not None:
+        data = image_cache.get(url)
+        if data is not None:
+            return data
+    if OFFLINE:
+        # Reconstruction hors ligne : une image ni dans le miroir ni dans le cache est écartée
         return None
 
+    try:
+        resp = session.get(url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        raise RetryLater(str(e))
+    if resp.status_code == 429 or resp.status_code >= 500:
+        raise RetryLater(f"HTTP {resp.status_code}")
+    if resp.status_code != 200:
+        return None
+    if image_cache is not None:
+        image_cache.put(url, resp.content)
+    return resp.content
 
-def process_one_card(row_data):
-    index, row = row_data
-    image_path = row['image'].strip()
-    print("image_path:", image_path)
-    
-    print("card_id:", image_path)
-    image_path = url_to_image(image_path)
-    if image_path is not None:
-        keypoints, descriptors = orb.detectAndCompute(image_path, None)
-        if descriptors is not None and len(keypoints) > 10:
-            # On n'a même pas besoin de sauvegarder les Keypoints (kp) pour la BDD
-            # On sauvegarde JUSTE les descripteurs (des) et l'ID.
-            # "des" est en uint8 (8 bits) au lieu de float32 (32 bits) -> 4x plus léger !
-            return {
-                'id': f"{row['number']}-{row['name']}-{row['set_name']}",
-                'descriptors': descriptors
-            }
 
-if __name__ == '__main__':
-    db_file = 'bdd/pokemon_card_bdd.csv' 
-    df = pd.read_csv(db_file, sep=';')
+def load_rows(path=None):
+    """Lignes du catalogue (dicts ou lignes pandas) : SQLite si path n'est pas un .csv, sinon CSV"""
+    path = path or (CATALOG_DB if os.path.exists(CATALOG_DB) else CSV_FILE)
+    if not path.endswith('.csv'):
+        with Catalog(path) as catalog:
+            return catalog.rows()
+    df = pd.read_csv(path, sep=';', dtype=str, keep_default_na=False)
     df.columns = df.columns.str.strip()
-    
-    tasks = list(df.iterrows())
-    print("Démarrage Indexation ORB (Rapide & Léger)...")
-    
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        results = list(tqdm(executor.map(process_one_card, tasks), total=len(tasks)))
-        
-
-    valid_results = [r for r in results if r is not None]
-    print(f"Terminé ! {len(valid_results)} cartes indexées.")
-    
-    # Sauvegarde
-    with open("orb_db.pkl", 'wb') as f:
-        pickle.dump(valid_results, f)
-    
-    print("Base de données 'orb_db.pkl' créée.")
+    return [row for _, row in df.iterrows()]
+
+
+def card_id(row):
+    # Format historique des id du store (champs du CSV ' ; ' avec leurs espaces), le même
+    # que la ligne vienne du CSV ou du catalogue : les stores existants restent compatibles
+    return f" {row['number'].strip()} -{row['name'].strip()} - {row['set_name'].strip()} "
+
+
+def _row_id(row):
+    """Id de la carte pour les messages, même si la ligne est incomplète"""
+    try:
+        return card_id(row)
+    except MALFORMED_ROW:
+        return str(row.get('tcg_id') or row.get('image') or '?')
+
+
+def card_metadata(row):
+    url = row['image'].strip()
+    extra = {}
+    if 'tcg_id' in row:
+        # Ligne du catalogue : id pokemon-tcg (recherche de l'URL Cardmarket par le serveur) et série
+        extra = {'tcg_id': row['tcg_id'], 'series': row['series']}
+    return {
+        'id': card_id(row),
+        'name': row['name'].strip(),
+        'number': row['number'].strip(),
+        'set_name': row['set_name'].strip(),
+        # https://images.pokemontcg.io/base1/1.png -> set 'base1'
+        'set_id': url.rstrip('/').split('/')[-2],
+        'release_date': row['release_date'].strip(),
+        'ip_set_card': row['ip_set_card'].strip(),
+        **extra,
+    }
+
+
+def _init_worker():
+    global _orb
+    # Un process par coeur : les threads internes d'OpenCV ne feraient que se concurrencer
+    cv2.setNumThreads(1)
+    _orb = cv2.ORB_create(nfeatures=ORB_NFEATURES)
+
+
+def describe_card(card, data):
+    """Dans un process du pool : décodage, ORB, pHash -> ('ok', id, carte) ou ('skipped', id, raison)"""
+    # 0 = Noir et Blanc direct, comme les photos côté serveur
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 0)
+    if image is None:
+        return 'skipped', card['id'], "image illisible"
+    keypoints, descriptors = _orb.detectAndCompute(image, None)
+    if descriptors is None or len(keypoints) <= 10:
+        return 'skipped', card['id'], "trop peu de features"
+
+    # On sauvegarde les descripteurs (des) et l'ID, plus les coordonnées x/y
+    # des keypoints (float16 dans le store) pour la vérification géométrique.
+    # "des" est en uint8 (8 bits) au lieu de float32 (32 bits) -> 4x plus léger !
+    card['descriptors'] = descriptors
+    card['keypoints'] = np.float32([kp.pt for kp in keypoints])
+    card['phash'] = phash(image)  # chemin rapide des photos propres / captures
+    return 'ok', card['id'], card
+
+
+async def download(loop, io_pool, url):
+    """image_bytes dans un thread d'E/S, retentée DOWNLOAD_RETRIES fois en cas d'échec passager"""
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return await loop.run_in_executor(io_pool, image_bytes, url)
+        except RetryLater:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+async def index_cards(rows, on_result):
+    """
+    Télécharge et décrit toutes les cartes de rows ; on_result(statut, id, contenu)
+    est appelée dans la boucle pour chacune, statut 'ok', 'skipped' ou 'retry'.
+    Quand la file est pleine, les téléchargements attendent les process.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    rows = iter(rows)
+
+    async def downloader(io_pool):
+        # Itérateur partagé : next() sans await, chaque carte n'est prise qu'une fois
+        for row in rows:
+            try:
+                card = card_metadata(row)
+                data = await download(loop, io_pool, row['image'].strip())
+            except RetryLater as e:
+                on_result('retry', card['id'], str(e))
+                continue
+            except MALFORMED_ROW as e:
+                # Ligne du catalogue malformée (champ absent, URL d'image sans set...) : écartée,
+                # les autres cartes continuent
+                on_result('skipped', _row_id(row), f"ligne invalide ({type(e).__name__}: {e})")
+                continue
+            except OSError as e:
+                # Cache ou miroir illisible, disque plein : retentée à la prochaine exécution
+                on_result('retry', _row_id(row), f"{type(e).__name__}: {e}")
+                continue
+            except Exception as e:
+                # Erreur inattendue, qui se reproduirait à chaque exécution : carte écartée
+                on_result('skipped', _row_id(row), f"erreur ({type(e).__name__}: {e})")
+                continue
+            if data is None:
+                on_result('skipped', card['id'], "image introuvable")
+                continue
+            await queue.put((card, data))
+
+    async def extractor(cpu_pool):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            try:
+                result = await loop.run_in_executor(cpu_pool, describe_card, *item)
+            except BrokenExecutor as e:
+                # Process du pool tué (mémoire...) : pas la faute de la carte, retentée
+                result = 'retry', item[0]['id'], f"{type(e).__name__}: {e}"
+            except Exception as e:
+                # Même image, même erreur à chaque exécution : carte écartée
+                result = 'skipped', item[0]['id'], f"erreur ({type(e).__name__}: {e})"
+            on_result(*result)
+
+    with ThreadPoolExecutor(DOWNLOAD_CONCURRENCY) as io_pool, \
+            ProcessPoolExecutor(INDEX_PROCESSES, initializer=_init_worker) as cpu_pool:
+        extractors = [asyncio.create_task(extractor(cpu_pool)) for _ in range(INDEX_PROCESSES)]
+        downloaders = [asyncio.create_task(downloader(io_pool)) for _ in range(DOWNLOAD_CONCURRENCY)]
+        try:
+            await asyncio.gather(*downloaders)
+            for _ in extractors:
+                await queue.put(None)
+            await asyncio.gather(*extractors)
+        except BaseException:
+            # Erreur hors d'une carte (on_result, écriture d'un paquet) : arrêt propre de toutes les tâches
+            for task in downloaders + extractors:
+                task.cancel()
+            await asyncio.gather(*downloaders, *extractors, return_exceptions=True)
+            raise
+
+
+class Checkpoint:
+    """
+    Paquets déjà écrits (store segmenté PARTS_DIR) et cartes écartées : ce qu'une relance
+    saute ; plus le nombre d'exécutions en échec passager de chaque carte (failures).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        if not is_segmented(root):
+            os.makedirs(root, exist_ok=True)
+            write_manifest(root, [], 0)
+        self.parts = read_manifest(root)["segments"]
+        self.done = {card['id'] for part in self.parts
+                     for card in DescriptorStore(os.path.join(root, part)).cards}
+        self.skipped = self._read(SKIPPED_FILE)
+        self.failures = self._read(FAILURES_FILE)
+
+    def _read(self, name):
+        if not os.path.exists(os.path.join(self.root, name)):
+            return {}
+        with open(os.path.join(self.root, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, name, content):
+        tmp_path = os.path.join(self.root, f"{name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.root, name))
+
+    def failed(self, cid, reason):
+        """Compte un échec passager ; True si la carte est à retenter, False si elle vient d'être écartée"""
+        runs = self.failures.pop(cid, 0) + 1
+        if runs >= MAX_FAILED_RUNS:
+            self.skipped[cid] = f"{reason} (en échec à {runs} exécutions)"
+            return False
+        self.failures[cid] = runs
+        return True
+
+    def flush(self, results):
+        """Écrit un paquet de cartes et le publie (avec les cartes écartées depuis le dernier paquet)"""
+        if results:
+            incoming = os.path.join(self.root, "incoming")
+            with StoreWriter(incoming) as writer:
+                for r in results:
+                    writer.add({k: v for k, v in r.items() if k not in ('descriptors', 'keypoints', 'phash')},
+                               r['descriptors'], r['keypoints'], r['phash'])
+            self.parts.append(add_segment(self.root, incoming))
+            self.done.update(r['id'] for r in results)
+            for r in results:
+                self.failures.pop(r['id'], None)
+        self._write(SKIPPED_FILE, self.skipped)
+        self._write(FAILURES_FILE, self.failures)
+
+
+def merge_parts(parts_dir, output_dir, catalog_order):
+    """Réécrit tous les paquets dans output_dir, cartes regroupées par set (ordre du catalogue dans un set)"""
+    parts = SegmentedStore(parts_dir)
+    # Cartes regroupées par set : chaque shard (set) occupe des lignes contiguës du store ;
+    # dans un set, l'ordre du catalogue plutôt que celui (variable) de fin des process
+    order = sorted(range(parts.n_cards),
+                   key=lambda i: (parts.cards[i].get('release_date', ''), parts.cards[i].get('set_id', ''),
+                                  catalog_order.get(parts.cards[i]['id'], len(catalog_order))))
+    with StoreWriter(output_dir) as writer:
+        for i in order:
+            rows = np.arange(parts.offsets[i], parts.offsets[i + 1])
+            writer.add(parts.cards[i], parts.descriptors[rows], parts.keypoints[rows], parts.phashes[i])
+    return parts.n_cards
+
+
+if __name__ == '__main__':
+    rows = load_rows()
+    catalog_order = {card_id(row): i for i, row in enumerate(rows)}
+    segmented = is_segmented(STORE_DIR)
+    output_dir = STORE_DIR
+    known = set()
+    if segmented:
+        known = {card['id'] for card in SegmentedStore(STORE_DIR).cards}
+        output_dir = DELTA_DIR
+    checkpoint = Checkpoint(PARTS_DIR)
+    if segmented and checkpoint.done & known:
+        # Arrêt entre add_segment et la suppression de PARTS_DIR : les paquets sont déjà
+        # publiés dans le store, les fusionner à nouveau doublerait leurs cartes (et leurs votes)
+        print(f"Paquets déjà publiés dans '{STORE_DIR}' : point de reprise remis à zéro.")
+        skipped, failures = checkpoint.skipped, checkpoint.failures
+        shutil.rmtree(PARTS_DIR)
+        checkpoint = Checkpoint(PARTS_DIR)
+        checkpoint.skipped, checkpoint.failures = skipped, failures
+    known |= checkpoint.done | set(checkpoint.skipped)
+    rows = [row for row in rows if card_id(row) not in known]
+    if checkpoint.parts or checkpoint.skipped:
+        print(f"Reprise : {len(checkpoint.done)} cartes déjà indexées, {len(checkpoint.skipped)} écartées")
+    print(f"Démarrage Indexation ORB (Rapide & Léger) : {len(rows)} cartes à traiter, "
+          f"{DOWNLOAD_CONCURRENCY} téléchargements / {INDEX_PROCESSES} process...")
+
+    series_by_set = {} if rows and 'series' in rows[0] else load_series_by_set()
+    pending, retries, given_up = [], {}, {}
+    progress = tqdm(total=len(rows))
+
+    def on_result(status, cid, payload):
+        progress.update()
+        if status == 'ok':
+            if 'series' not in payload:
+                payload['series'] = series_by_set.get(payload['set_id'], '')
+            pending.append(payload)
+        elif status == 'skipped':
+            checkpoint.skipped[cid] = payload
+        elif checkpoint.failed(cid, payload):
+            retries[cid] = payload
+        else:
+            given_up[cid] = checkpoint.skipped[cid]
+        if len(pending) >= FLUSH_EVERY:
+            checkpoint.flush(pending)
+            pending.clear()
+
+    start = time.perf_counter()
+    asyncio.run(index_cards(rows, on_result))
+    checkpoint.flush(pending)
+    progress.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Terminé ! {len(checkpoint.done)} cartes indexées, {len(checkpoint.skipped)} écartées "
+          f"({len(rows) / max(elapsed, 1e-9):.1f} cartes/s).")
+    if given_up:
+        print(f"⚠️ {len(given_up)} cartes écartées après {MAX_FAILED_RUNS} exécutions en échec :")
+        for cid, reason in list(given_up.items())[:10]:
+            print(f"   {cid}: {reason}")
+    if retries:
+        # Le point de reprise est gardé : la relance ne refait que ces cartes
+        for cid, reason in list(retries.items())[:10]:
+            print(f"   {cid}: {reason}")
+        print(f"⚠️ {len(retries)} cartes en échec temporaire : relancez l'indexation pour les reprendre "
+              f"(écartées après {MAX_FAILED_RUNS} exécutions en échec).")
+        sys.exit(1)
+    if not checkpoint.parts:
+        print("Aucune nouvelle carte à indexer.")
+        shutil.rmtree(PARTS_DIR)
+        sys.exit(0)
+
+    # Sauvegarde : store memmap (descripteurs contigus + offsets + keypoints + pHash + métadonnées)
+    merge_parts(PARTS_DIR, output_dir, catalog_order)
+    print(f"Base de données '{output_dir}' créée.")
+
+    # Tables LSH construites une fois ici, rechargées directement par api_server.py
+    store = DescriptorStore(output_dir)
+    LshIndex.build(store.descriptors, **LSH_PARAMS).save(store.store_dir)
+    print(f"Index LSH sauvegardé ({LSH_PARAMS}).")
+
+    # Tables MIH pour la recherche exacte (SEARCH_ENGINE=mih)
+    MihIndex.build(store.descriptors).save(store.store_dir)
+    print("Index MIH sauvegardé.")
+
+    # Arbre de vocabulaire + fichier inversé pour l'étape grossière (SEARCH_ENGINE=vocab)
+    VocabTree.build(store, **VOCAB_PARAMS).save(store.store_dir, store.n_rows, store.n_cards)
+    print("Arbre de vocabulaire sauvegardé.")
 
+    if segmented:
+        # Publication : le serveur le charge à son prochain rechargement (/admin/reload
+        # ou surveillance du manifest), sans reconstruire les segments existants
+        print(f"Segment '{add_segment(STORE_DIR, output_dir)}' ajouté à '{STORE_DIR}'.")
+    shutil.rmtree(PARTS_DIR)
@@ -0,0 +1,38 @@
+"""
+Vérification géométrique des meilleures cartes candidates.
+
+Les good matches d'une carte candidate relient des keypoints de la photo à
+des keypoints de l'image de référence (coordonnées stockées dans le store) :
+une homographie estimée par RANSAC ne garde que les correspondances
+cohérentes, et le nombre d'inliers sert de score, bien plus discriminant
+que le simple nombre de votes.
+"""
+import cv2
+import numpy as np
+
+RANSAC_REPROJ_THRESHOLD = 5.0  # pixels
+MIN_MATCHES = 4  # une homographie a besoin de 4 correspondances
+
+
+def count_inliers(query_points, reference_points):
+    """Nombre de correspondances cohérentes avec une homographie (RANSAC)"""
+    if len(query_points) < MIN_MATCHES:
+        return 0
+    _, mask = cv2.findHomography(reference_points, query_points, cv2.RANSAC, RANSAC_REPROJ_THRESHOLD)
+    return 0 if mask is None else int(mask.sum())
+
+
+def verify_candidates(cards, query_idx, train_idx, query_keypoints, card_of_row, keypoints):
+    """
+    Inliers de chaque carte candidate.
+    query_idx / train_idx : good matches (descripteur de la photo, ligne de la super_matrix)
+    query_keypoints : keypoints cv2 de la photo ; keypoints : coordonnées du store
+    """
+    query_points = np.float32([kp.pt for kp in query_keypoints])
+    match_cards = card_of_row[train_idx]
+    inliers = np.zeros(len(cards), dtype=np.int32)
+    for i, card in enumerate(cards):
+        selected = match_cards == card
+        inliers[i] = count_inliers(query_points[query_idx[selected]],
+                                   np.asarray(keypoints[train_idx[selected]], dtype=np.float32))
+    return inliers
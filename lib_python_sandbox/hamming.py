@@ -0,0 +1,78 @@
+"""
+Distances de Hamming entre descripteurs binaires ORB (32 octets).
+"""
+import numpy as np
+
+# Nombre de bits à 1 pour chaque valeur d'octet
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# ---------- Version "mots 64 bits" : un descripteur = 4 x uint64 ----------
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_M8 = np.uint64(0x00ff00ff00ff00ff)
+_H16 = np.uint64(0x0001000100010001)
+
+
+def as_words(descriptors):
+    """Vue (n, 4) uint64 d'une matrice (n, 32) uint8, sans copie"""
+    return np.ascontiguousarray(descriptors).view(np.uint64)
+
+
+def hamming_matrix(query_words, block_words):
+    """
+    Matrice (n, m) des distances entre deux paquets de descripteurs en uint64.
+    XOR mot par mot puis popcount : np.bitwise_count si numpy >= 2,
+    sinon popcount SWAR fait sur place (peu de tableaux temporaires).
+    """
+    if hasattr(np, 'bitwise_count'):
+        acc = np.bitwise_count(np.bitwise_xor.outer(query_words[:, 0], block_words[:, 0])).astype(np.uint16)
+        for w in range(1, query_words.shape[1]):
+            acc += np.bitwise_count(np.bitwise_xor.outer(query_words[:, w], block_words[:, w]))
+        return acc
+
+    acc = None
+    for w in range(query_words.shape[1]):
+        x = np.bitwise_xor.outer(query_words[:, w], block_words[:, w])
+        t = x >> np.uint64(1)
+        t &= _M1
+        x -= t
+        t = x >> np.uint64(2)
+        t &= _M2
+        x &= _M2
+        x += t
+        t = x >> np.uint64(4)
+        x += t
+        x &= _M4  # nombre de bits par octet (<= 8)
+        if acc is None:
+            acc = x
+        else:
+            acc += x  # <= 32 par octet pour 4 mots
+    # Somme des octets : d'abord par paires (16 bits), puis multiplication
+    t = acc >> np.uint64(8)
+    t &= _M8
+    acc &= _M8
+    acc += t
+    acc *= _H16
+    acc >>= np.uint64(48)
+    return acc
+
+
+def encode_keys(distances, rows):
+    """Clé triable : distance dans les bits de poids fort, ligne en poids faible"""
+    return (distances.astype(np.int64) << 32) | rows.astype(np.int64)
+
+
+def merge_top_k(keys, k):
+    """Garde les k plus petites clés de chaque ligne, triées (à distance égale : plus petit index)"""
+    if keys.shape[1] > k:
+        keys = np.partition(keys, k - 1, axis=1)[:, :k]
+    keys = np.sort(keys, axis=1)
+    distances = (keys >> 32).astype(np.int32)
+    indices = (keys & 0xFFFFFFFF).astype(np.int32)
+    if keys.shape[1] < k:
+        pad = ((0, 0), (0, k - keys.shape[1]))
+        distances = np.pad(distances, pad, constant_values=-1)
+        indices = np.pad(indices, pad, constant_values=-1)
+    return distances, indices
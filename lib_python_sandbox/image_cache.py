@@ -0,0 +1,62 @@
+"""
+Cache local des images de cartes, adressé par contenu.
+
+    objects/ab/abcdef...   octets de l'image, nommés par leur SHA-256
+    urls/12/1234...        pour chaque URL (nommée par son SHA-1) : le SHA-256 de son image
+
+Une réindexation ne retélécharge que les URLs jamais vues ; deux URLs qui
+servent la même image ne la stockent qu'une fois. Chaque fichier est écrit
+à côté puis renommé (os.replace) : un crash ne laisse jamais d'image
+tronquée dans le cache.
+"""
+import hashlib
+import os
+import tempfile
+
+
+def _atomic_write(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Nom temporaire unique : les threads de téléchargement d'un même process
+    # peuvent écrire la même image (même URL, même contenu) en même temps
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageCache:
+    def __init__(self, root):
+        self.root = root
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _url_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, "urls", key[:2], key)
+
+    def get(self, url):
+        """Octets de l'image déjà téléchargée pour url, ou None"""
+        try:
+            with open(self._url_path(url), 'r', encoding='ascii') as f:
+                digest = f.read().strip()
+            with open(self._object_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, data):
+        """Range l'image de url ; renvoie son SHA-256"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+        # L'objet avant la référence : une URL ne pointe jamais vers une image absente
+        _atomic_write(self._url_path(url), digest.encode('ascii'))
+        return digest
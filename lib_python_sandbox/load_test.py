@@ -0,0 +1,258 @@
+"""
+Test de charge de /search : rejoue un corpus d'images contre un serveur
+(local ou Railway) à débit fixe (--rps) ou à concurrence fixe (--concurrency).
+
+Débit fixe (boucle ouverte) : les requêtes partent à l'heure prévue même si
+le serveur ralentit, et la latence est comptée depuis cette heure prévue ;
+sinon un serveur saturé ralentirait le client et masquerait sa propre file
+d'attente. Concurrence fixe (boucle fermée) : N clients qui renvoient une
+requête dès la réponse précédente, pour trouver le débit maximal.
+
+Rapport : débit, latences p50 / p90 / p99, répartition des statuts (200, 404,
+503 de l'admission ASGI, 504, timeouts, erreurs de connexion), réponses en
+cache (X-Cache) et durées par étape déclarées par le serveur (Server-Timing).
+Enregistré en JSON avec l'étiquette de la configuration testée, pour comparer
+réglages gunicorn / ASGI et moteurs (--compare) avant de toucher railway.toml.
+Lancer le serveur avec RESULT_CACHE_SIZE=0 pour mesurer le pipeline complet
+à chaque requête (sinon le corpus rejoué sort du cache).
+
+Usage :
+    python load_test.py --url http://localhost:5000 --images templates --rps 5 --duration 60 \\
+        --label "gunicorn 2w/4t lsh" --out charge.json
+    python load_test.py --concurrency 8 --requests 400 --out charge2.json --compare charge.json
+"""
+import argparse
+import json
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_corpus(paths):
+    """[(nom, octets, content-type)] des images des dossiers / fichiers donnés"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            files.append(path)
+    corpus = []
+    for path in files:
+        with open(path, 'rb') as f:
+            corpus.append((os.path.basename(path), f.read(),
+                           mimetypes.guess_type(path)[0] or 'application/octet-stream'))
+    return corpus
+
+
+def parse_server_timing(header):
+    """'decode;dur=3.1, orb;dur=8.4' -> {'decode': 3.1, 'orb': 8.4} (ms)"""
+    stages = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if name and key == 'dur':
+                try:
+                    stages[name] = float(value)
+                except ValueError:
+                    pass
+    return stages
+
+
+class LoadTest:
+    def __init__(self, url, corpus, timeout):
+        self.url = url.rstrip('/') + '/search'
+        self.corpus = corpus
+        self.timeout = timeout
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        # Une session (connexions keep-alive) par thread client
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self, i, scheduled=None):
+        """Requête i (image i modulo le corpus) ; latence depuis scheduled si donné (débit fixe)"""
+        name, data, content_type = self.corpus[i % len(self.corpus)]
+        start = time.perf_counter()
+        record = {"image": name, "sent": start}
+        try:
+            response = self._session().post(self.url, data=data, headers={'Content-Type': content_type},
+                                            timeout=self.timeout)
+            record["status"] = response.status_code
+            record["cache"] = response.headers.get('X-Cache') == 'HIT'
+            record["stages"] = parse_server_timing(response.headers.get('Server-Timing'))
+        except requests.Timeout:
+            record["status"] = 'timeout'
+        except requests.ConnectionError:
+            record["status"] = 'connection'
+        except requests.RequestException as e:
+            # Autre échec côté client (réponse tronquée, trop de redirections...) : compté
+            # comme erreur, sans arrêter le thread qui envoie les requêtes
+            record["status"] = type(e).__name__
+        end = time.perf_counter()
+        record["latency"] = end - (start if scheduled is None else scheduled)
+        record["end"] = end
+        with self._lock:
+            self.records.append(record)
+
+    def run_rate(self, rps, n_requests, duration, max_in_flight):
+        """Boucle ouverte : une requête toutes les 1/rps secondes, à l'heure prévue"""
+        total = n_requests or int(rps * duration)
+        with ThreadPoolExecutor(max_in_flight) as pool:
+            begin = time.perf_counter()
+            for i in range(total):
+                scheduled = begin + i / rps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.send, i, scheduled)
+        return begin
+
+    def run_concurrency(self, concurrency, n_requests, duration):
+        """Boucle fermée : concurrency clients, chacun enchaîne ses requêtes"""
+        counter = iter(range(n_requests or 1 << 62))
+        counter_lock = threading.Lock()
+        begin = time.perf_counter()
+        deadline = begin + duration if duration else None
+
+        def client():
+            while deadline is None or time.perf_counter() < deadline:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                self.send(i)
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return begin
+
+
+def percentiles_ms(values):
+    if not values:
+        return None
+    stats = {f"p{p}": round(float(np.percentile(values, p)) * 1000, 2) for p in (50, 90, 99)}
+    stats["mean"] = round(float(np.mean(values)) * 1000, 2)
+    stats["max"] = round(float(np.max(values)) * 1000, 2)
+    return stats
+
+
+def summarize(records, begin, warmup):
+    """Statistiques des requêtes envoyées après les warmup premières secondes"""
+    records = [r for r in records if r["sent"] >= begin + warmup]
+    if not records:
+        return {"requests": 0}
+    elapsed = max(r["end"] for r in records) - min(r["sent"] for r in records)
+    statuses = {}
+    for r in records:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    ok = [r for r in records if r["status"] == 200]
+    answered = [r for r in records if isinstance(r["status"], int)]
+    stages = {}
+    for r in answered:
+        if not r.get("cache"):
+            for name, ms in r.get("stages", {}).items():
+                stages.setdefault(name, []).append(ms / 1000)
+    return {
+        "requests": len(records),
+        "duration_s": round(elapsed, 2),
+        # Débit utile (200 / 404) ; offered_rps compte aussi les refus et erreurs
+        "throughput_rps": round(sum(r["status"] in (200, 404) for r in records) / elapsed, 2) if elapsed > 0 else None,
+        "offered_rps": round(len(records) / elapsed, 2) if elapsed > 0 else None,
+        "statuses": dict(sorted(statuses.items())),
+        # 404 = carte non reconnue, une vraie réponse ; le reste (4xx, 5xx, 503, timeouts) est une erreur
+        "error_rate": round(sum(r["status"] not in (200, 404) for r in records) / len(records), 4),
+        "cache_hits": sum(bool(r.get("cache")) for r in answered),
+        "latency_ms": percentiles_ms([r["latency"] for r in records]),
+        "latency_ms_200": percentiles_ms([r["latency"] for r in ok]),
+        # Hors réponses en cache : durées du pipeline côté serveur
+        "server_stages_ms": {name: percentiles_ms(values) for name, values in sorted(stages.items())},
+    }
+
+
+def compare(report, previous):
+    old, new = previous["summary"], report["summary"]
+    print(f"\nComparaison avec « {previous.get('label') or previous.get('created')} » :")
+    if (old.get("throughput_rps") is not None) and (new.get("throughput_rps") is not None):
+        print(f"   débit      {new['throughput_rps'] - old['throughput_rps']:+8.2f} req/s")
+    for key in ("p50", "p90", "p99"):
+        if old.get("latency_ms") and new.get("latency_ms"):
+            print(f"   {key:<10} {new['latency_ms'][key] - old['latency_ms'][key]:+8.2f} ms")
+    print(f"   erreurs    {new['error_rate'] - old['error_rate']:+8.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Test de charge de /search")
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--images', nargs='+', default=['templates'], help="dossiers ou fichiers d'images")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--rps', type=float, help="débit fixe (requêtes par seconde)")
+    mode.add_argument('--concurrency', type=int, default=4, help="clients simultanés (boucle fermée)")
+    parser.add_argument('--duration', type=float, default=30, help="secondes (si --requests n'est pas donné)")
+    parser.add_argument('--requests', type=int, help="nombre total de requêtes")
+    parser.add_argument('--warmup', type=float, default=0, help="secondes du début exclues des statistiques")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--max-in-flight', type=int, default=256, help="requêtes simultanées max en mode --rps")
+    parser.add_argument('--label', default='', help="configuration testée (workers, threads, moteur...)")
+    parser.add_argument('--out', default='load_test.json')
+    parser.add_argument('--compare', help="rapport précédent à comparer")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.images)
+    if not corpus:
+        raise SystemExit(f"Aucune image dans {args.images}")
+    try:
+        health = requests.get(args.url.rstrip('/') + '/health', timeout=10).json()
+    except (requests.RequestException, ValueError) as e:
+        raise SystemExit(f"❌ Serveur injoignable ({args.url}): {e}")
+    print(f"✅ {len(corpus)} images, serveur {args.url} ({health.get('cartes_loaded')} cartes, "
+          f"moteur {health.get('engine')})")
+
+    test = LoadTest(args.url, corpus, args.timeout)
+    duration = None if args.requests else args.duration
+    if args.rps:
+        print(f"🔄 {args.rps:g} req/s ...")
+        begin = test.run_rate(args.rps, args.requests, args.duration, args.max_in_flight)
+    else:
+        print(f"🔄 {args.concurrency} clients ...")
+        begin = test.run_concurrency(args.concurrency, args.requests, duration)
+
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "label": args.label,
+        "url": args.url,
+        "mode": {"rps": args.rps} if args.rps else {"concurrency": args.concurrency},
+        "corpus": [name for name, _, _ in corpus],
+        "server": {key: health.get(key) for key in ("cartes_loaded", "engine", "micro_batch", "cache")},
+        "summary": summarize(test.records, begin, args.warmup),
+    }
+    summary = report["summary"]
+    print(f"✅ {summary['requests']} requêtes, {summary.get('throughput_rps')} req/s, statuts {summary.get('statuses')}")
+    if summary.get("latency_ms"):
+        latency = summary["latency_ms"]
+        print(f"   latence p50 {latency['p50']} ms, p90 {latency['p90']} ms, p99 {latency['p99']} ms")
+    for name, values in summary.get("server_stages_ms", {}).items():
+        print(f"   {name:<14} p50 {values['p50']:8.2f} ms  p99 {values['p99']:8.2f} ms")
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"✅ Rapport écrit dans {args.out}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
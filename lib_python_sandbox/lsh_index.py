@@ -0,0 +1,202 @@
+"""
+Index LSH (Locality-Sensitive Hashing) persistant pour les descripteurs ORB.
+
+Même principe que l'index LSH de FLANN (algorithm=6) : chaque table hache un
+descripteur sur key_size bits tirés au hasard, la recherche ne compare que les
+descripteurs des buckets visités (multi_probe_level = nombre de bits de la clé
+qu'on s'autorise à inverser). OpenCV ne sait pas recharger un index LSH
+sauvegardé, d'où cette implémentation dont les tables sont écrites à côté du
+store et rechargées en memmap au démarrage des workers.
+
+Fichiers (dossier <store>/lsh) :
+    header.json   version, table_number, key_size, multi_probe_level, n_rows
+    bits.i32      (table_number, key_size) positions des bits hachés
+    order.i32     (table_number, n_rows) lignes triées par clé de hachage
+    buckets.i32   (table_number, 2**key_size + 1) début de chaque bucket dans order
+"""
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+
+from hamming import as_words, hamming_matrix
+
+LSH_VERSION = 1
+LSH_DIR = "lsh"
+
+# Paramètres utilisés en production (optimisés pour la RAM de Railway)
+LSH_PARAMS = dict(
+    table_number=1,
+    key_size=6,
+    multi_probe_level=0,
+)
+
+HASH_CHUNK_ROWS = 1 << 18  # hachage par paquets pour limiter la RAM
+MAX_PAIRS = 1 << 18  # distances (requête, candidat) calculées d'un coup
+_NO_KEY = np.iinfo(np.int64).max  # pas de candidat
+
+
+def _hash(descriptors, bits):
+    """Clé de hachage (int64) de chaque descripteur pour une table"""
+    keys = np.zeros(len(descriptors), dtype=np.int64)
+    for j, b in enumerate(bits):
+        bit = (descriptors[:, b >> 3] >> (b & 7)) & 1
+        keys |= bit.astype(np.int64) << j
+    return keys
+
+
+def _probe_masks(key_size, multi_probe_level):
+    """Masques XOR des buckets visités : la clé elle-même puis ses voisines"""
+    masks = [0]
+    for level in range(1, multi_probe_level + 1):
+        for positions in itertools.combinations(range(key_size), level):
+            masks.append(sum(1 << p for p in positions))
+    return np.asarray(masks, dtype=np.int64)
+
+
+class LshIndex:
+    """Tables de hachage LSH sur la matrice de descripteurs d'un store"""
+
+    def __init__(self, descriptors, bits, order, buckets, multi_probe_level):
+        self.descriptors = descriptors
+        self.bits = bits
+        self.order = order
+        self.buckets = buckets
+        self.table_number, self.key_size = bits.shape
+        self.multi_probe_level = multi_probe_level
+        self._masks = _probe_masks(self.key_size, multi_probe_level)
+
+    @property
+    def params(self):
+        return dict(table_number=self.table_number, key_size=self.key_size,
+                    multi_probe_level=self.multi_probe_level)
+
+    @classmethod
+    def build(cls, descriptors, table_number, key_size, multi_probe_level, seed=0):
+        """Construit les tables (bits tirés au hasard comme dans FLANN)"""
+        rng = np.random.default_rng(seed)
+        n_bits = descriptors.shape[1] * 8
+        bits = np.stack([rng.choice(n_bits, size=key_size, replace=False)
+                         for _ in range(table_number)]).astype(np.int32)
+
+        n_rows = len(descriptors)
+        order = np.empty((table_number, n_rows), dtype=np.int32)
+        buckets = np.empty((table_number, (1 << key_size) + 1), dtype=np.int32)
+        for t in range(table_number):
+            keys = np.empty(n_rows, dtype=np.int64)
+            for start in range(0, n_rows, HASH_CHUNK_ROWS):
+                stop = min(start + HASH_CHUNK_ROWS, n_rows)
+                keys[start:stop] = _hash(descriptors[start:stop], bits[t])
+            order[t] = np.argsort(keys, kind='stable')
+            counts = np.bincount(keys, minlength=1 << key_size)
+            buckets[t, 0] = 0
+            np.cumsum(counts, out=buckets[t, 1:])
+        return cls(descriptors, bits, order, buckets, multi_probe_level)
+
+    def save(self, store_dir):
+        """Écrit l'index dans <store_dir>/lsh (remplacement atomique)"""
+        lsh_dir = os.path.join(store_dir, LSH_DIR)
+        tmp_dir = f"{lsh_dir}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        self.bits.tofile(os.path.join(tmp_dir, "bits.i32"))
+        np.ascontiguousarray(self.order).tofile(os.path.join(tmp_dir, "order.i32"))
+        np.ascontiguousarray(self.buckets).tofile(os.path.join(tmp_dir, "buckets.i32"))
+        header = {"version": LSH_VERSION, "n_rows": len(self.descriptors), **self.params}
+        with open(os.path.join(tmp_dir, "header.json"), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+        if os.path.exists(lsh_dir):
+            shutil.rmtree(lsh_dir)
+        os.replace(tmp_dir, lsh_dir)
+
+    @classmethod
+    def load(cls, store_dir, descriptors, table_number, key_size, multi_probe_level):
+        """Recharge l'index sauvegardé, ou None s'il est absent ou incompatible"""
+        lsh_dir = os.path.join(store_dir, LSH_DIR)
+        try:
+            with open(os.path.join(lsh_dir, "header.json"), 'r', encoding='utf-8') as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        expected = {"version": LSH_VERSION, "n_rows": len(descriptors), "table_number": table_number,
+                    "key_size": key_size, "multi_probe_level": multi_probe_level}
+        if any(header.get(key) != value for key, value in expected.items()):
+            return None
+
+        bits = np.fromfile(os.path.join(lsh_dir, "bits.i32"), dtype=np.int32).reshape(table_number, key_size)
+        order = np.memmap(os.path.join(lsh_dir, "order.i32"), dtype=np.int32, mode='r',
+                          shape=(table_number, len(descriptors)))
+        buckets = np.fromfile(os.path.join(lsh_dir, "buckets.i32"), dtype=np.int32).reshape(table_number, -1)
+        return cls(descriptors, bits, order, buckets, multi_probe_level)
+
+    @classmethod
+    def load_or_build(cls, store, table_number, key_size, multi_probe_level):
+        """Index prêt à l'emploi : rechargé si possible, sinon reconstruit puis sauvegardé"""
+        index = cls.load(store.store_dir, store.descriptors, table_number, key_size, multi_probe_level)
+        if index is not None:
+            return index
+
+        print("⚠️ Index LSH absent ou paramètres différents : reconstruction...")
+        index = cls.build(store.descriptors, table_number, key_size, multi_probe_level)
+        try:
+            index.save(store.store_dir)
+        except OSError as e:
+            print(f"⚠️ Impossible de sauvegarder l'index LSH: {e}")
+        return index
+
+    def knn_search(self, query, k=2):
+        """
+        k plus proches voisins de chaque descripteur de query.
+        Retourne (distances, indices) de forme (n, k) en int32 ;
+        -1 quand les buckets visités contiennent moins de k descripteurs.
+        Toutes les requêtes sont traitées ensemble (lot d'images empilées) :
+        chaque bucket visité est lu une seule fois pour toutes les requêtes
+        qui tombent dedans, et n'en garde que les k meilleurs par requête.
+        """
+        n = len(query)
+        distances = np.full((n, k), -1, dtype=np.int32)
+        indices = np.full((n, k), -1, dtype=np.int32)
+        if n == 0:
+            return distances, indices
+
+        query_words = as_words(query)
+        n_probes = len(self._masks)
+        # k meilleures clés (distance << 32 | ligne) de chaque (table, bucket visité), par requête
+        best = np.full((n, self.table_number * n_probes * k), _NO_KEY, dtype=np.int64)
+        for t in range(self.table_number):
+            visited = _hash(query, self.bits[t])[:, None] ^ self._masks[None, :]
+            for bucket in np.unique(visited):
+                qids, probes = np.nonzero(visited == bucket)
+                start, stop = self.buckets[t, bucket], self.buckets[t, bucket + 1]
+                keys = self._bucket_top_k(query_words[qids], self.order[t, start:stop], k)
+                slots = ((t * n_probes + probes) * k)[:, None] + np.arange(k)
+                best[qids[:, None], slots] = keys
+
+        best.sort(axis=1)
+        if self.table_number > 1:
+            # Une ligne trouvée dans plusieurs tables ne compte qu'une fois
+            best[:, 1:][best[:, 1:] == best[:, :-1]] = _NO_KEY
+            best.sort(axis=1)
+        best = best[:, :k]
+        found = best != _NO_KEY
+        distances[found] = best[found] >> 32
+        indices[found] = best[found] & 0xFFFFFFFF
+        return distances, indices
+
+    def _bucket_top_k(self, query_words, rows, k):
+        """(len(query_words), k) plus petites clés sur les lignes d'un bucket, _NO_KEY si moins de k"""
+        best = np.full((len(query_words), k), _NO_KEY, dtype=np.int64)
+        # Paquets de lignes : au plus MAX_PAIRS distances en mémoire à la fois
+        block = max(1024, MAX_PAIRS // len(query_words))
+        for start in range(0, len(rows), block):
+            block_rows = np.asarray(rows[start:start + block], dtype=np.int64)
+            dist = hamming_matrix(query_words, as_words(self.descriptors[block_rows]))
+            keys = np.concatenate([best, (dist.astype(np.int64) << 32) | block_rows[None, :]], axis=1)
+            best = np.partition(keys, k - 1, axis=1)[:, :k] if keys.shape[1] > k else keys
+        return best
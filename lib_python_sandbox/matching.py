@@ -0,0 +1,25 @@
+"""
+Ratio test et comptage des votes, vectorisés sur les tableaux (n, k)
+renvoyés par les index de recherche (distances, indices).
+"""
+import numpy as np
+
+
+def good_pairs(distances, indices, ratio):
+    """(descripteurs de la photo, lignes de la super_matrix) qui passent le ratio test"""
+    ok = (indices[:, 1] >= 0) & (distances[:, 0] < ratio * distances[:, 1])
+    return np.flatnonzero(ok), indices[ok, 0]
+
+
+def count_votes(train_idx, card_of_row, n_cards):
+    """Nombre de good matches par carte (tableau de taille n_cards)"""
+    return np.bincount(card_of_row[train_idx], minlength=n_cards)
+
+
+def top_cards(votes, k):
+    """Index des k cartes les plus votées, de la meilleure à la moins bonne"""
+    k = min(k, len(votes))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(votes, -k)[-k:]
+    return top[np.argsort(votes[top])[::-1]]
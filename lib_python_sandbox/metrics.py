@@ -0,0 +1,110 @@
+"""
+Métriques du serveur au format texte Prometheus (endpoint /metrics).
+
+Compteurs et histogrammes en mémoire du process, protégés par un verrou ;
+les valeurs déjà tenues ailleurs (taille de l'index, compteurs du cache)
+sont lues au moment du rendu via une fonction.
+"""
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [compteurs par bucket, somme, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (buckets, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {n}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Callback:
+    """Métrique lue au rendu : fn() renvoie une valeur, ou {valeurs des labels: valeur}"""
+
+    def __init__(self, name, help_text, fn, kind="gauge", labels=()):
+        self.name, self.help, self.fn, self.kind, self.labels = name, help_text, fn, kind, tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, labels=()):
+        return self._add(Histogram(name, help_text, buckets, labels))
+
+    def callback(self, name, help_text, fn, kind="gauge", labels=()):
+        return self._add(Callback(name, help_text, fn, kind, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,113 @@
+"""
+Micro-batching des recherches kNN de requêtes /search concurrentes.
+
+Les descripteurs des requêtes qui arrivent pendant une fenêtre de
+window_ms (ou jusqu'à max_batch requêtes) sont empilés en une seule
+matrice, un seul knn_search est lancé, et chaque requête récupère ses
+lignes de (distances, indices) grâce aux offsets. Un peu de latence en
+plus (au plus la fenêtre) contre beaucoup moins d'appels en pic de charge.
+Avec un index à étape grossière (grouped, ex. vocab), les offsets lui sont
+passés : le résultat d'une requête ne dépend pas des autres du lot.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Même interface knn_search que les index, calcul groupé dans un thread dédié"""
+
+    def __init__(self, index, window_ms, max_batch, k=2):
+        self.index = index
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.k = k
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"batches": 0, "queries": 0, "descriptors": 0, "max_batch_seen": 0,
+                      "wait_ms_total": 0.0, "search_ms_total": 0.0}
+        threading.Thread(target=self._run, name="micro-batcher", daemon=True).start()
+
+    def knn_search(self, query, k=2):
+        """Bloque jusqu'au passage du lot contenant cette requête"""
+        future = Future()
+        with self._lock:
+            # Après close() : plus de thread pour traiter la file, appel direct
+            if k != self.k or self._closed:
+                future = None
+            else:
+                self._queue.put((np.ascontiguousarray(query), time.perf_counter(), future))
+        if future is None:
+            return self.index.knn_search(query, k)
+        return future.result()
+
+    def close(self):
+        """Arrête le thread une fois traitées les requêtes déjà en file"""
+        with self._lock:
+            self._closed = True
+            self._queue.put(None)
+
+    def _collect(self):
+        """Premier élément en attente, puis tout ce qui arrive pendant la fenêtre ; (lot, fin demandée)"""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            queries = [query for query, _, _ in batch]
+            offsets = np.cumsum([0] + [len(query) for query in queries])
+            try:
+                if getattr(self.index, 'grouped', False):
+                    # Étape grossière (vocab) : chaque requête garde ses propres cartes candidates
+                    distances, indices = self.index.knn_search(np.concatenate(queries), self.k, offsets=offsets)
+                else:
+                    distances, indices = self.index.knn_search(np.concatenate(queries), self.k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for j, (_, _, future) in enumerate(batch):
+                part = slice(offsets[j], offsets[j + 1])
+                future.set_result((distances[part], indices[part]))
+
+            with self._lock:
+                self.stats["batches"] += 1
+                self.stats["queries"] += len(batch)
+                self.stats["descriptors"] += int(offsets[-1])
+                self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(batch))
+                self.stats["wait_ms_total"] += sum(started - queued for _, queued, _ in batch) * 1000
+                self.stats["search_ms_total"] += (time.perf_counter() - started) * 1000
+
+    def metrics(self):
+        """Compteurs + moyennes (taille de lot, attente par requête)"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats["window_ms"] = self.window * 1000
+        stats["max_batch"] = self.max_batch
+        stats["mean_batch"] = stats["queries"] / stats["batches"] if stats["batches"] else 0.0
+        stats["mean_wait_ms"] = stats["wait_ms_total"] / stats["queries"] if stats["queries"] else 0.0
+        return stats
@@ -0,0 +1,250 @@
+"""
+Multi-index hashing (MIH) : kNN exact et sous-linéaire sur les descripteurs ORB.
+
+Chaque descripteur de 256 bits est découpé en m sous-chaînes, chacune avec sa
+table (lignes triées par valeur de la sous-chaîne). m est choisi d'après la
+taille du store, m ~ 256 / log2(n_rows) (Norouzi et al.) : une sous-chaîne
+a alors à peu près autant de valeurs possibles que le store a de lignes, et
+un bucket n'en contient qu'une poignée (12 x 21-22 bits pour ~1,5 M lignes,
+18 x 14-15 bits pour ~20 k). Avec des sous-chaînes trop courtes, les buckets
+sont si remplis que la recherche finit par vérifier tout le store.
+
+Principe des tiroirs : une ligne absente des buckets à distance <= r_j de la
+sous-chaîne j de la requête, pour chaque table j, est à distance >= somme des
+(r_j + 1). On élargit donc le rayon table par table (0 partout, puis 1 dans la
+première table, dans la deuxième...), on vérifie les nouveaux candidats avec
+la distance complète, et on s'arrête dès que le k-ième voisin est plus proche
+que cette borne. Les voisins renvoyés sont exactement ceux de la force brute
+(à distance égale, le plus petit index). Une requête dont les buckets à
+visiter couvriraient une bonne part du store est finie en force brute.
+
+Fichiers (dossier <store>/mih) :
+    header.json   version, widths (bits de chaque sous-chaîne), n_rows
+    keys.u32      (m, n_rows) valeurs des sous-chaînes, triées par table
+    order.i32     (m, n_rows) lignes dans le même ordre
+"""
+import json
+import os
+import shutil
+from itertools import combinations
+
+import numpy as np
+
+from brute_force_index import BruteForceIndex
+from descriptor_store import concat_ranges
+from hamming import as_words, encode_keys, hamming_matrix, merge_top_k
+
+MIH_VERSION = 2
+MIH_DIR = "mih"
+
+DESCRIPTOR_BITS = 256
+# Bornes du nombre de sous-chaînes (32 bits au plus par sous-chaîne : clés uint32)
+MIN_SUBSTRINGS = 8
+MAX_SUBSTRINGS = 32
+# Force brute dès que le coût d'une requête (distances vérifiées, recherches de buckets
+# et étapes, comptées en distances) dépasserait cette fraction d'une force brute
+BRUTE_FORCE_FRACTION = 0.3
+# Coûts mesurés en nombre de distances (~100 ns chacune) : recherche d'un bucket dans
+# une table triée (~1 us, défauts de cache), et surcoût Python fixe d'une étape (~40 us)
+LOOKUP_COST = 10
+STEP_COST = 400
+
+# Masques XOR par (largeur, rayon), calculés à la première utilisation
+_masks = {}
+
+
+def substring_widths(n_rows):
+    """Largeurs des sous-chaînes pour un store de n_rows lignes (m ~ 256 / log2 n)"""
+    m = round(DESCRIPTOR_BITS / np.log2(max(n_rows, 2)))
+    m = min(MAX_SUBSTRINGS, max(MIN_SUBSTRINGS, m))
+    width, extra = divmod(DESCRIPTOR_BITS, m)
+    return [width + 1] * extra + [width] * (m - extra)
+
+
+def masks_at(width, radius):
+    """Masques XOR de `width` bits ayant exactement `radius` bits à 1"""
+    if (width, radius) not in _masks:
+        masks = [sum(1 << bit for bit in bits) for bits in combinations(range(width), radius)]
+        _masks[width, radius] = np.array(masks, dtype=np.uint32)
+    return _masks[width, radius]
+
+
+def substring_values(words, start, width):
+    """Valeurs (n,) uint32 des bits [start, start + width) de descripteurs en uint64"""
+    word, shift = divmod(start, 64)
+    values = words[:, word] >> np.uint64(shift)
+    if shift + width > 64:
+        values |= words[:, word + 1] << np.uint64(64 - shift)
+    return (values & np.uint64((1 << width) - 1)).astype(np.uint32)
+
+
+class MihIndex:
+    """Tables de sous-chaînes MIH sur la matrice de descripteurs d'un store"""
+
+    def __init__(self, descriptors, widths, keys, order):
+        self.words = as_words(descriptors)
+        self.n_rows = len(descriptors)
+        self.widths = list(widths)
+        self.starts = np.cumsum([0] + self.widths[:-1]).tolist()
+        self.m = len(self.widths)
+        self.keys = keys
+        self.order = order
+        self._brute = BruteForceIndex(descriptors)
+        # Nombre de distances complètes calculées (pour comparer à la force brute)
+        self.stats = {"queries": 0, "distances": 0}
+
+    @classmethod
+    def build(cls, descriptors):
+        words = as_words(descriptors)
+        widths = substring_widths(len(descriptors))
+        keys = np.empty((len(widths), len(descriptors)), dtype=np.uint32)
+        order = np.empty((len(widths), len(descriptors)), dtype=np.int32)
+        start = 0
+        for j, width in enumerate(widths):
+            values = substring_values(words, start, width)
+            order[j] = np.argsort(values, kind='stable')
+            keys[j] = values[order[j]]
+            start += width
+        return cls(descriptors, widths, keys, order)
+
+    def save(self, store_dir):
+        """Écrit l'index dans <store_dir>/mih (remplacement atomique)"""
+        mih_dir = os.path.join(store_dir, MIH_DIR)
+        tmp_dir = f"{mih_dir}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        np.ascontiguousarray(self.keys).tofile(os.path.join(tmp_dir, "keys.u32"))
+        np.ascontiguousarray(self.order).tofile(os.path.join(tmp_dir, "order.i32"))
+        header = {"version": MIH_VERSION, "widths": self.widths, "n_rows": self.n_rows}
+        with open(os.path.join(tmp_dir, "header.json"), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+        if os.path.exists(mih_dir):
+            shutil.rmtree(mih_dir)
+        os.replace(tmp_dir, mih_dir)
+
+    @classmethod
+    def load(cls, store_dir, descriptors):
+        """Recharge l'index sauvegardé (memmap), ou None s'il est absent ou périmé"""
+        mih_dir = os.path.join(store_dir, MIH_DIR)
+        try:
+            with open(os.path.join(mih_dir, "header.json"), 'r', encoding='utf-8') as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        widths = substring_widths(len(descriptors))
+        expected = {"version": MIH_VERSION, "widths": widths, "n_rows": len(descriptors)}
+        if any(header.get(key) != value for key, value in expected.items()):
+            return None
+
+        shape = (len(widths), len(descriptors))
+        keys = np.memmap(os.path.join(mih_dir, "keys.u32"), dtype=np.uint32, mode='r', shape=shape)
+        order = np.memmap(os.path.join(mih_dir, "order.i32"), dtype=np.int32, mode='r', shape=shape)
+        return cls(descriptors, widths, keys, order)
+
+    @classmethod
+    def load_or_build(cls, store):
+        """Index prêt à l'emploi : rechargé si possible, sinon reconstruit puis sauvegardé"""
+        index = cls.load(store.store_dir, store.descriptors)
+        if index is not None:
+            return index
+
+        print("⚠️ Index MIH absent ou périmé : reconstruction...")
+        index = cls.build(store.descriptors)
+        try:
+            index.save(store.store_dir)
+        except OSError as e:
+            print(f"⚠️ Impossible de sauvegarder l'index MIH: {e}")
+        return index
+
+    def query_substrings(self, query_words):
+        """Sous-chaînes (n, m) uint32 des requêtes, découpées comme les tables"""
+        return np.stack([substring_values(query_words, start, width)
+                         for start, width in zip(self.starts, self.widths)], axis=1)
+
+    def _search_one(self, query_words, query_substrings, k, seen):
+        """Clés triées des k plus proches, ou None si la requête doit passer en force brute"""
+        best = np.empty(0, dtype=np.int64)
+        verified = 0
+        cost = 0
+        budget = BRUTE_FORCE_FRACTION * self.n_rows
+        touched = []
+        try:
+            for radius in range(max(self.widths) + 1):
+                for j, width in enumerate(self.widths):
+                    if radius > width:
+                        continue
+                    masks = masks_at(width, radius)
+                    cost += STEP_COST + LOOKUP_COST * len(masks)
+                    if cost + verified > budget:
+                        # Requête isolée : les buckets à visiter coûteraient une bonne part
+                        # d'une force brute ; finie en force brute, avec les autres
+                        self.stats["distances"] += verified
+                        return None
+
+                    # Buckets à distance exactement `radius` de la sous-chaîne j (même dtype
+                    # que les clés : searchsorted ne convertit pas la table)
+                    values = masks ^ query_substrings[j]
+                    starts = np.searchsorted(self.keys[j], values, side='left')
+                    lengths = np.searchsorted(self.keys[j], values, side='right') - starts
+                    if cost + verified + lengths.sum() > budget:
+                        self.stats["distances"] += verified
+                        return None
+
+                    # Les buckets d'une étape sont disjoints : seules les lignes vues aux étapes
+                    # précédentes (autres tables) sont à retirer
+                    rows = self.order[j][concat_ranges(starts, lengths)]
+                    rows = rows[~seen[rows]]
+                    if len(rows):
+                        seen[rows] = True
+                        touched.append(rows)
+                        distances = hamming_matrix(query_words, self.words[rows])[0]
+                        verified += len(rows)
+                        best = np.sort(np.concatenate([best, encode_keys(distances, rows)]))[:k]
+
+                    # Tout ce qui n'a pas été vu est à distance >= m * radius + j + 1
+                    if len(best) == k and (best[-1] >> 32) < self.m * radius + j + 1:
+                        self.stats["distances"] += verified
+                        return best
+            self.stats["distances"] += verified
+            return best
+        finally:
+            for rows in touched:
+                seen[rows] = False
+
+    def knn_search(self, query, k=2):
+        """k plus proches voisins exacts ; -1 si la base a moins de k lignes"""
+        query_words = as_words(query)
+        query_substrings = self.query_substrings(query_words)
+        n = len(query_words)
+        keys = np.full((n, k), np.iinfo(np.int64).max, dtype=np.int64)
+        # Lignes déjà vérifiées pour la requête en cours (remis à False après chaque requête)
+        seen = np.zeros(self.n_rows, dtype=bool)
+        isolated = []
+        if 2 * self.m * STEP_COST > BRUTE_FORCE_FRACTION * self.n_rows:
+            # Petit store : deux rayons de MIH coûtent déjà plus qu'une force brute
+            isolated = list(range(n))
+            n_searched = 0
+        else:
+            n_searched = n
+        for i in range(n_searched):
+            best = self._search_one(query_words[i:i + 1], query_substrings[i], k, seen)
+            if best is None:
+                isolated.append(i)
+            else:
+                keys[i, :len(best)] = best
+        if isolated:
+            # Une seule force brute (par blocs, multithreadée) pour toutes les requêtes isolées
+            distances, indices = self._brute.knn_search(query[isolated], k)
+            keys[isolated] = np.where(indices >= 0, encode_keys(distances, indices), np.iinfo(np.int64).max)
+            self.stats["distances"] += len(isolated) * self.n_rows
+        self.stats["queries"] += n
+
+        distances, indices = merge_top_k(keys, k)
+        missing = keys == np.iinfo(np.int64).max
+        distances[missing] = -1
+        indices[missing] = -1
+        return distances, indices
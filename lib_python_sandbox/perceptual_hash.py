@@ -0,0 +1,90 @@
+"""
+Hash perceptuel (pHash 64 bits) des images de cartes.
+
+Chemin rapide de /search : une photo propre ou une capture d'écran de la
+carte a presque le même pHash que l'image de référence. Si un seul hash du
+catalogue est à moins de PHASH_RADIUS bits de celui de la photo, on répond
+directement, sans ORB ni kNN.
+
+pHash : image réduite à 32x32, DCT, bloc 8x8 des basses fréquences,
+un bit par coefficient (supérieur à la médiane ou non).
+
+Index multi-table (même principe que mih_index) : le hash est coupé en
+4 sous-chaînes de 16 bits ; si d(q, x) <= PHASH_RADIUS, au moins une
+sous-chaîne de x est à distance <= PHASH_RADIUS // 4 de celle de q.
+"""
+import cv2
+import numpy as np
+
+from descriptor_store import concat_ranges
+from hamming import POPCOUNT_TABLE
+
+PHASH_SIZE = 32  # taille de l'image réduite
+PHASH_LOW_FREQ = 8  # bloc 8x8 de la DCT = 64 bits
+PHASH_BITS = PHASH_LOW_FREQ * PHASH_LOW_FREQ
+
+SUBSTRING_BITS = 16
+N_SUBSTRINGS = 64 // SUBSTRING_BITS
+N_BUCKETS = 1 << SUBSTRING_BITS
+
+
+def phash(gray):
+    """pHash 64 bits (np.uint64) d'une image en niveaux de gris"""
+    small = cv2.resize(gray, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(np.float32(small))[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ].ravel()
+    # Médiane sans le coefficient continu (luminosité moyenne)
+    bits = dct > np.median(dct[1:])
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def hash_distances(query_hash, hashes):
+    """Distances de Hamming entre un hash et un tableau de hashes uint64"""
+    xor = np.bitwise_xor(hashes, np.uint64(query_hash))
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int32)
+
+
+def _masks_up_to(radius):
+    """Masques XOR de 16 bits ayant au plus `radius` bits à 1"""
+    masks = np.arange(N_BUCKETS, dtype=np.int64)
+    weights = POPCOUNT_TABLE[masks & 0xFF] + POPCOUNT_TABLE[masks >> 8]
+    return masks[weights <= radius]
+
+
+class PhashIndex:
+    """Recherche des cartes dont le pHash est proche de celui d'une photo"""
+
+    def __init__(self, hashes, radius):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+        self._masks = _masks_up_to(radius // N_SUBSTRINGS)
+
+        # Une table par sous-chaîne : cartes triées par valeur, début de chaque bucket
+        substrings = self._substrings(self.hashes)
+        self.order = np.empty((N_SUBSTRINGS, len(self.hashes)), dtype=np.int32)
+        self.buckets = np.zeros((N_SUBSTRINGS, N_BUCKETS + 1), dtype=np.int32)
+        for j in range(N_SUBSTRINGS):
+            self.order[j] = np.argsort(substrings[:, j], kind='stable')
+            np.cumsum(np.bincount(substrings[:, j], minlength=N_BUCKETS), out=self.buckets[j, 1:])
+
+    @staticmethod
+    def _substrings(hashes):
+        """(n, 4) sous-chaînes de 16 bits de chaque hash"""
+        shifts = np.arange(N_SUBSTRINGS, dtype=np.uint64) * np.uint64(SUBSTRING_BITS)
+        return ((np.atleast_1d(hashes)[:, None] >> shifts) & np.uint64(0xFFFF)).astype(np.int64)
+
+    def search(self, query_hash):
+        """(cartes, distances) à moins de radius bits, de la plus proche à la plus lointaine"""
+        tables = np.arange(N_SUBSTRINGS)[:, None]
+        bucket = self._substrings(np.uint64(query_hash))[0][:, None] ^ self._masks[None, :]
+        starts = self.buckets[tables, bucket]
+        lengths = (self.buckets[tables, bucket + 1] - starts).ravel()
+        starts = (starts + tables * len(self.hashes)).ravel()
+        positions = concat_ranges(starts, lengths)
+        if len(positions) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        cards = np.unique(self.order.reshape(-1)[positions])
+        distances = hash_distances(query_hash, self.hashes[cards])
+        keep = distances <= self.radius
+        order = np.argsort(distances[keep], kind='stable')
+        return cards[keep][order], distances[keep][order]
@@ -0,0 +1,63 @@
+"""
+Matching progressif (anytime) : les descripteurs de la photo sont cherchés
+par lots, des keypoints les plus forts (response ORB) aux plus faibles.
+
+Après chaque lot, les votes sont mis à jour ; on s'arrête dès que la carte
+en tête a un écart décisif sur la deuxième. Si chaque vote partagé entre
+les deux tombait à pile ou face, l'écart a - b suivrait à peu près une loi
+normale d'écart-type √(a + b) : a - b > z·√(a + b) rejette cette hypothèse
+(z = 3 : moins de 0,2 % de chances que l'écart soit dû au hasard).
+Un budget de temps par requête borne aussi la recherche.
+"""
+import time
+
+import numpy as np
+
+from matching import count_votes, good_pairs, top_cards
+
+
+def response_order(keypoints):
+    """Ordre des descripteurs, du keypoint le plus fort au plus faible"""
+    return np.argsort([-kp.response for kp in keypoints], kind='stable')
+
+
+def decisive_margin(votes, z):
+    """Vrai si la carte en tête dépasse la deuxième de plus de z·√(a + b) votes"""
+    best = top_cards(votes, 2)
+    a = int(votes[best[0]])
+    b = int(votes[best[1]]) if len(best) > 1 else 0
+    return a > 0 and a - b > z * np.sqrt(a + b)
+
+
+def progressive_knn(knn_search, descriptors, keypoints, card_of_row, n_cards,
+                    batch_size, z, budget, ratio):
+    """
+    knn_search(descripteurs) -> (distances, indices) appelé lot par lot.
+    Renvoie (distances, indices, ordre, arrêt) : les lignes de distances /
+    indices correspondent aux descripteurs ordre (ceux réellement cherchés),
+    arrêt vaut 'margin', 'budget' ou 'complete'.
+    budget en secondes, 0 = pas de limite.
+    """
+    start = time.perf_counter()
+    order = response_order(keypoints)
+    votes = np.zeros(n_cards, dtype=np.int64)
+    distances, indices = [], []
+    reason = 'complete'
+    for begin in range(0, len(order), batch_size):
+        batch = order[begin:begin + batch_size]
+        batch_distances, batch_indices = knn_search(descriptors[batch])
+        distances.append(batch_distances)
+        indices.append(batch_indices)
+        votes += count_votes(good_pairs(batch_distances, batch_indices, ratio)[1], card_of_row, n_cards)
+
+        if begin + batch_size >= len(order):
+            break
+        if decisive_margin(votes, z):
+            reason = 'margin'
+            break
+        if budget > 0 and time.perf_counter() - start >= budget:
+            reason = 'budget'
+            break
+
+    used = sum(len(d) for d in distances)
+    return np.concatenate(distances), np.concatenate(indices), order[:used], reason
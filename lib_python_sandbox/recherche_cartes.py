@@ -1,11 +1,14 @@
 import cv2
-import pickle
 import numpy as np
 import time
 import requests
 import urllib.parse
 import webbrowser
 
+from descriptor_store import DescriptorStore
+from matching import count_votes, top_cards
+from rectification import rectify_card
+
 # ========== CHRONOMÈTRE DÉBUT ==========
 temps_debut_total = time.time()
 print("🕐 Démarrage du programme...")
@@ -27,10 +30,9 @@ headers = {
 #Chargement de la base de données des cartes pré-indexées
 t_load_start = time.time()
 print("Chargement BDD ORB...")
-with open("orb_db.pkl", 'rb') as f:
-    DB_CARTES = pickle.load(f)
+store = DescriptorStore("orb_store")  # créé par finger_print_quick.py ou descriptor_store.py
 t_load_end = time.time()
-print(f"✅ {len(DB_CARTES)} cartes chargées en {t_load_end - t_load_start:.2f}s")
+print(f"✅ {store.n_cards} cartes chargées en {t_load_end - t_load_start:.2f}s")
 
 # Initialisation de l'ia ORB
 orb = cv2.ORB_create(nfeatures=150) # ALIGNÉ avec la base : 150 features
@@ -50,19 +52,9 @@ search_params = dict(checks=1)  # AGRESSIF : 1 check seulement
 
 matcher = cv2.FlannBasedMatcher(index_params, search_params)
 
-# On empile tous les descripteurs dans une seule grosse matrice
-all_descriptors = []
-map_descriptor_to_card_id = [] # Pour retrouver quelle ligne appartient à quelle carte
-
-for carte in DB_CARTES:
-    desc = carte['descriptors']
-    if desc is not None:
-        all_descriptors.append(desc)
-        # On note que ces N descripteurs appartiennent à cette carte ID
-        map_descriptor_to_card_id.extend([carte['id']] * len(desc))
-
-# Conversion en super matrice numpy
-super_matrix = np.vstack(all_descriptors)
+# Le store contient déjà tous les descripteurs dans une seule grosse matrice
+super_matrix = store.descriptors
+card_of_row = store.card_of_row # Pour retrouver à quelle carte appartient chaque ligne (int32)
 
 # Entraînement FLANN
 matcher.add([super_matrix])
@@ -99,37 +91,39 @@ def extraire_infos_carte(card_id):
     }
 
 def trouver_carte_rapide(chemin_photo):
-    t_start = time.time()
+    """Carte la plus votée ; durées par étape (s) et compteurs dans "etapes" au lieu de print()"""
+    t_start = time.perf_counter()
+    etapes = {}
     
     img = cv2.imread(chemin_photo, 0)
     if img is None: return "Erreur image"
 
     # OPTIMISATION 1: Réduire la taille de l'image AGRESSIVE
     max_dimension = 300  # AGRESSIF : 300px pour vitesse max
+    # Carte localisée et redressée (sans le fond) ; sinon simple redimensionnement
+    carte = rectify_card(img, max_dimension)
+    if carte is not None:
+        img = carte
     height, width = img.shape
     if max(height, width) > max_dimension:
         scale = max_dimension / max(height, width)
         new_width = int(width * scale)
         new_height = int(height * scale)
         img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        print(f"Image redimensionnée: {width}x{height} → {new_width}x{new_height}")
+    etapes["decode"] = time.perf_counter() - t_start
 
-    t_orb_start = time.time()
+    t_orb_start = time.perf_counter()
     # Calcul ORB user
     kp_user, des_user = orb.detectAndCompute(img, None)
     if des_user is None: return "Pas de détails détectés"
-    t_orb_end = time.time()
-    print(f"⏱️  ORB extraction: {t_orb_end - t_orb_start:.2f}s")
-    print(f"Descripteurs extraits: {len(des_user)}")
+    etapes["orb"] = time.perf_counter() - t_orb_start
 
-    t_match_start = time.time()
+    t_match_start = time.perf_counter()
     # RECHERCHE FLANN ultra-optimisé
     matches = matcher.knnMatch(des_user, k=2)
-    t_match_end = time.time()
-    print(f"⏱️  FLANN knnMatch: {t_match_end - t_match_start:.2f}s")
-    print(f"Matches trouvés: {len(matches)}")
+    etapes["knn"] = time.perf_counter() - t_match_start
     
-    t_filter_start = time.time()
+    t_filter_start = time.perf_counter()
     # Filtrage (Ratio test) - MOINS STRICT pour avoir plus de matches
     good_matches = []
     for match_pair in matches:
@@ -137,28 +131,23 @@ def trouver_carte_rapide(chemin_photo):
         m, n = match_pair
         if m.distance < 0.75 * n.distance:  # Moins strict (0.75) pour plus de résultats
             good_matches.append(m)
-    t_filter_end = time.time()
-    print(f"⏱️  Filtrage: {t_filter_end - t_filter_start:.2f}s")
-    print(f"Good matches après filtrage: {len(good_matches)}")
+    etapes["ratio_test"] = time.perf_counter() - t_filter_start
     
-    t_vote_start = time.time()
-    # COMPTER LES VOTES
-    votes = {}
-    for match in good_matches:
-        idx_in_super_matrix = match.trainIdx
-        card_id = map_descriptor_to_card_id[idx_in_super_matrix]
-        votes[card_id] = votes.get(card_id, 0) + 1
+    t_vote_start = time.perf_counter()
+    # COMPTER LES VOTES (un seul bincount sur les trainIdx)
+    train_idx = np.array([m.trainIdx for m in good_matches], dtype=np.int64)
+    votes = count_votes(train_idx, card_of_row, store.n_cards)
     
     # Trouver le gagnant
-    if not votes:
+    if len(train_idx) == 0:
         return "Aucune correspondance."
 
-    meilleur_id = max(votes, key=votes.get)
-    score = votes[meilleur_id]
-    t_vote_end = time.time()
-    print(f"⏱️  Vote: {t_vote_end - t_vote_start:.2f}s")
+    meilleur = top_cards(votes, 1)[0]
+    score = int(votes[meilleur])
+    meilleur_id = store.cards[meilleur]['id']
+    etapes["vote"] = time.perf_counter() - t_vote_start
     
-    t_end = time.time()
+    t_end = time.perf_counter()
 
     infos = extraire_infos_carte(meilleur_id)
     
@@ -170,7 +159,11 @@ def trouver_carte_rapide(chemin_photo):
             "set_name": infos["set_name"]
         },
         "score": score,
-        "temps": round(t_end - t_start, 4)
+        "temps": round(t_end - t_start, 4),
+        "etapes": {etape: round(duree, 4) for etape, duree in etapes.items()},
+        "descripteurs": len(des_user),
+        "carte_redressee": carte is not None,
+        "good_matches": len(good_matches)
     }
 
 
@@ -229,6 +222,8 @@ if isinstance(carte_trouvé, dict):
     print(f"📋 Carte trouvée: {carte_trouvé['carte']}")
     print(f"🎯 Score: {carte_trouvé['score']}")
     print(f"⚡ Temps interne fonction: {carte_trouvé['temps']}s")
+    print(f"⏱️  Étapes: {carte_trouvé['etapes']}")
+    print(f"Descripteurs extraits: {carte_trouvé['descripteurs']}, good matches: {carte_trouvé['good_matches']}")
     
     t_cardmarket_start = time.time()
     ouvrir_cardmarket_precis(carte_trouvé["carte_infos"]["nom"], carte_trouvé["carte_infos"]["numero"])
@@ -1,5 +1,6 @@
 import requests
 import base64
+import mimetypes
 import webbrowser
 import urllib.parse
 import time
@@ -8,35 +9,49 @@ import time
 # URL de votre API Railway déployée
 API_URL = "https://projetcardmarket-production.up.railway.app"
 
+# Envoi des octets bruts de l'image (image/jpeg, image/png) au lieu du base64 en JSON :
+# 33% de données en moins et pas de décodage base64 côté serveur
+UPLOAD_BINAIRE = True
+
 # Configuration des headers pour Cardmarket
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Accept-Language": "fr-FR,fr;q=0.9",
 }
 
-def trouver_carte_via_api(chemin_photo):
+def trouver_carte_via_api(chemin_photo, binaire=UPLOAD_BINAIRE):
     """
     Envoie l'image à l'API Render et retourne les infos de la carte
     Plus besoin de charger orb_db.pkl ni de faire les calculs localement !
+    binaire : octets bruts (True) ou base64 dans du JSON (False, ancien format)
     """
     print(f"📤 Envoi de l'image à l'API: {chemin_photo}")
     t_start = time.time()
     
     try:
-        # 1. Lire l'image et la convertir en base64
+        # 1. Lire l'image
         with open(chemin_photo, 'rb') as f:
             image_bytes = f.read()
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
         
-        print(f"   Taille: {len(image_bytes) / 1024:.1f} Ko")
+        print(f"   Taille: {len(image_bytes) / 1024:.1f} Ko ({'binaire' if binaire else 'base64'})")
         
         # 2. Envoyer à l'API
-        response = requests.post(
-            f"{API_URL}/search",
-            json={'image': image_base64},
-            headers={'Content-Type': 'application/json'},
-            timeout=60  # Augmenté à 60s pour Railway
-        )
+        if binaire:
+            content_type = mimetypes.guess_type(chemin_photo)[0] or 'application/octet-stream'
+            response = requests.post(
+                f"{API_URL}/search",
+                data=image_bytes,
+                headers={'Content-Type': content_type},
+                timeout=60  # Augmenté à 60s pour Railway
+            )
+        else:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+            response = requests.post(
+                f"{API_URL}/search",
+                json={'image': image_base64},
+                headers={'Content-Type': 'application/json'},
+                timeout=60  # Augmenté à 60s pour Railway
+            )
         
         t_end = time.time()
         print(f"⏱️  Temps total (réseau + traitement): {t_end - t_start:.2f}s")
@@ -0,0 +1,113 @@
+"""
+Localisation de la carte dans la photo et redressement de la perspective.
+
+Une photo prise depuis scanner_screen.dart contient aussi la table, les
+mains, la sleeve : sans recadrage, une bonne partie des features ORB part
+sur le fond. On cherche le quadrilatère de la carte (contours sur les
+bords de Canny), puis on le redresse au format d'une carte (63 x 88 mm),
+comme les images de référence du store. Si aucun quadrilatère plausible
+n'est trouvé, l'appelant garde le simple redimensionnement.
+
+Une image entière déjà au format carte (image du catalogue, scan, capture
+recadrée) n'est pas redressée : elle est déjà à plat, et le seul
+quadrilatère au format carte qu'on y trouverait est un cadre intérieur
+(illustration, bordure). Une photo de téléphone (3:4, 9:16) reste redressée.
+"""
+import cv2
+import numpy as np
+
+CARD_ASPECT = 63 / 88  # largeur / hauteur d'une carte Pokémon
+ASPECT_TOLERANCE = 0.2  # écart relatif accepté (perspective, bords arrondis)
+FLAT_ASPECT_TOLERANCE = 0.03  # image entière à moins de 3 % du format carte : déjà à plat (3:4 est à 4,8 %)
+MIN_AREA_FRACTION = 0.05  # la carte doit couvrir au moins 5 % de la photo
+MAX_AREA_FRACTION = 0.95  # au-delà, c'est le cadre de la photo
+BORDER_MARGIN = 0.02  # un coin collé au bord de la photo = fond ou carte coupée
+APPROX_EPSILONS = (0.02, 0.04, 0.06)  # tolérances de approxPolyDP (fraction du périmètre)
+MIN_QUAD_FILL = 0.8  # aire du quadrilatère / aire de l'enveloppe (un amas rond n'est pas une carte)
+DETECTION_SIZE = 400  # côté max de l'image de travail pour la détection
+CANNY_THRESHOLDS = (50, 150)
+
+
+def order_corners(points):
+    """4 coins -> (haut-gauche, haut-droit, bas-droit, bas-gauche)"""
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    sums, diffs = points.sum(axis=1), np.diff(points, axis=1).ravel()
+    return np.float32([points[np.argmin(sums)], points[np.argmin(diffs)],
+                       points[np.argmax(sums)], points[np.argmax(diffs)]])
+
+
+def _side_lengths(corners):
+    """(largeur, hauteur) moyennes du quadrilatère ordonné"""
+    tl, tr, br, bl = corners
+    width = (np.linalg.norm(tr - tl) + np.linalg.norm(br - bl)) / 2
+    height = (np.linalg.norm(bl - tl) + np.linalg.norm(br - tr)) / 2
+    return width, height
+
+
+def find_card(gray):
+    """Coins ordonnés de la carte dans l'image (coordonnées de gray), ou None"""
+    scale = min(1.0, DETECTION_SIZE / max(gray.shape))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), *CANNY_THRESHOLDS)
+    # Referme les petits trous du bord (reflets, coins arrondis)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    # RETR_LIST : sur un fond chargé, le bord de la carte est souvent le contour
+    # intérieur d'une zone d'arêtes qui touche le fond, pas un contour externe
+    contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+    image_area = small.shape[0] * small.shape[1]
+    best, best_area = None, MIN_AREA_FRACTION * image_area
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        # Le cadre de la photo elle-même n'est pas une carte (ni ce qui touche ses bords)
+        if area <= best_area or area > MAX_AREA_FRACTION * image_area:
+            continue
+        corners = _card_quad(contour, small.shape)
+        if corners is not None:
+            best, best_area = corners, area
+    return None if best is None else best / scale
+
+
+def _card_quad(contour, shape):
+    """Coins ordonnés si l'enveloppe du contour est un quadrilatère au format carte, sinon None"""
+    # Enveloppe convexe : les illustrations qui touchent le bord creusent le contour
+    hull = cv2.convexHull(contour)
+    for epsilon in APPROX_EPSILONS:
+        quad = cv2.approxPolyDP(hull, epsilon * cv2.arcLength(hull, True), True)
+        if len(quad) == 4:
+            break
+    else:
+        return None
+    if cv2.contourArea(quad) < MIN_QUAD_FILL * cv2.contourArea(hull):
+        return None
+    corners = order_corners(quad)
+    margin = BORDER_MARGIN * max(shape)
+    if (corners.min() < margin or (corners[:, 0] > shape[1] - 1 - margin).any()
+            or (corners[:, 1] > shape[0] - 1 - margin).any()):
+        return None
+    width, height = _side_lengths(corners)
+    aspect = min(width, height) / max(width, height)
+    return corners if abs(aspect - CARD_ASPECT) <= ASPECT_TOLERANCE * CARD_ASPECT else None
+
+
+def is_flat_card(gray):
+    """True si l'image entière a déjà le format d'une carte (portrait ou paysage)"""
+    aspect = min(gray.shape[:2]) / max(gray.shape[:2])
+    return abs(aspect - CARD_ASPECT) <= FLAT_ASPECT_TOLERANCE * CARD_ASPECT
+
+
+def rectify_card(gray, height):
+    """Carte redressée en portrait (height pixels de haut, format 63:88), ou None (pas de carte, ou déjà à plat)"""
+    if is_flat_card(gray):
+        return None
+    corners = find_card(gray)
+    if corners is None:
+        return None
+    width, card_height = _side_lengths(corners)
+    if width > card_height:
+        # Carte couchée : le bord gauche de l'image devient le haut de la carte
+        corners = corners[[3, 0, 1, 2]]
+    target = np.float32([[0, 0], [round(height * CARD_ASPECT) - 1, 0],
+                         [round(height * CARD_ASPECT) - 1, height - 1], [0, height - 1]])
+    matrix = cv2.getPerspectiveTransform(corners, target)
+    return cv2.warpPerspective(gray, matrix, (round(height * CARD_ASPECT), height), flags=cv2.INTER_AREA)
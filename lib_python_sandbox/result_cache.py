@@ -0,0 +1,70 @@
+"""
+Cache LRU + TTL des réponses de /search, en mémoire du process.
+
+Une même photo renvoyée (retry après timeout, double tap dans l'app) ne
+refait pas décodage -> ORB -> kNN : la réponse finale est retrouvée par un
+hash des octets reçus (niveau 1), ou par l'empreinte des descripteurs ORB
+quand les octets diffèrent mais les pixels sont les mêmes (niveau 2).
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_key(data, *context):
+    """Clé de cache : blake2b des octets + contexte (filtres, moteur...)"""
+    digest = hashlib.blake2b(data, digest_size=16)
+    digest.update(json.dumps(context, sort_keys=True, default=str).encode())
+    return digest.digest()
+
+
+class ResultCache:
+    """Dictionnaire borné : les entrées les moins récemment lues partent en premier"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # clé -> (expiration, valeur)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def get(self, key):
+        """Valeur en cache, ou None (absente ou expirée)"""
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Vide le cache (index rechargé : les réponses peuvent changer)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_entries": self.max_entries, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expired": self.expired}
@@ -0,0 +1,262 @@
+"""
+Store segmenté : une liste de segments immuables, un segment de base plus
+des segments delta pour les cartes ajoutées depuis (nouvelle extension).
+
+Format d'un store segmenté (un dossier) :
+    manifest.json    {"version", "generation", "segments": ["seg-000000", ...], "retired": [...]}
+    seg-000000/      store complet (voir descriptor_store.py) et ses index
+    seg-000001/      (lsh/, mih/, vocab/), jamais modifié une fois publié
+
+Le manifest est remplacé atomiquement (os.replace) : un lecteur voit soit
+l'ancienne liste de segments, soit la nouvelle. Le serveur ouvre chaque
+segment en memmap avec son propre index de recherche ; SegmentedIndex
+interroge tous les segments et fusionne leurs top-k. Au rechargement,
+seuls les nouveaux segments sont ouverts et indexés.
+
+La compaction réécrit tous les segments en un seul (moins d'index à
+interroger par requête) puis publie un manifest qui ne contient que lui.
+Les segments remplacés restent sur disque (liste "retired") jusqu'à la
+compaction suivante : une vue pas encore rechargée, et les process de
+SEARCH_ENGINE=processes qui ouvrent les segments à la demande, peuvent
+encore les lire.
+
+Usage :
+    python segments.py init orb_store               # store existant -> segment de base
+    python segments.py add orb_store orb_store_delta  # publie un store comme segment delta
+    python segments.py compact orb_store            # fusionne tous les segments
+"""
+import json
+import os
+import shutil
+import sys
+from functools import cached_property
+
+import numpy as np
+
+from descriptor_store import DescriptorStore, StoreWriter, concat_ranges, store_exists
+from hamming import merge_top_k
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+SEGMENT_PREFIX = "seg-"
+
+
+def is_segmented(root):
+    return os.path.exists(os.path.join(root, MANIFEST_FILE))
+
+
+def read_manifest(root):
+    with open(os.path.join(root, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Version de manifest non supportée: {manifest.get('version')}")
+    return manifest
+
+
+def write_manifest(root, segments, generation, retired=()):
+    """Publie la liste des segments (remplacement atomique du manifest) ; retired : à supprimer plus tard"""
+    tmp_path = os.path.join(root, f"{MANIFEST_FILE}.tmp-{os.getpid()}")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": MANIFEST_VERSION, "generation": generation, "segments": segments,
+                   "retired": list(retired)}, f)
+    os.replace(tmp_path, os.path.join(root, MANIFEST_FILE))
+
+
+def _next_segment_name(root):
+    numbers = [int(name[len(SEGMENT_PREFIX):]) for name in os.listdir(root)
+               if name.startswith(SEGMENT_PREFIX) and name[len(SEGMENT_PREFIX):].isdigit()]
+    return f"{SEGMENT_PREFIX}{max(numbers, default=-1) + 1:06d}"
+
+
+class ManifestLock:
+    """Un seul écrivain à la fois (ajout, compaction) : fichier créé en O_EXCL"""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, LOCK_FILE)
+
+    def __enter__(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            raise RuntimeError(f"{self.path} existe : une autre écriture est en cours "
+                               "(supprimez le fichier si elle a été interrompue)")
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        os.remove(self.path)
+
+
+def init_segments(root):
+    """Transforme un store simple en store segmenté dont il est le segment de base"""
+    if is_segmented(root):
+        raise ValueError(f"{root} est déjà un store segmenté")
+    if not store_exists(root):
+        raise ValueError(f"{root} n'est pas un store")
+    tmp_dir = f"{root}.base-{os.getpid()}"
+    os.replace(root, tmp_dir)
+    os.makedirs(root)
+    name = _next_segment_name(root)
+    os.replace(tmp_dir, os.path.join(root, name))
+    write_manifest(root, [name], 0)
+    return name
+
+
+def add_segment(root, store_dir):
+    """Déplace un store complet dans root et le publie comme nouveau segment"""
+    if not store_exists(store_dir):
+        raise ValueError(f"{store_dir} n'est pas un store complet")
+    with ManifestLock(root):
+        manifest = read_manifest(root)
+        name = _next_segment_name(root)
+        # Même disque : simple renommage ; sinon copie puis suppression
+        shutil.move(store_dir, os.path.join(root, name))
+        write_manifest(root, manifest["segments"] + [name], manifest["generation"] + 1,
+                       manifest.get("retired", []))
+    return name
+
+
+def compact(root):
+    """
+    Réécrit tous les segments en un seul. Les anciens sont gardés une compaction de plus
+    (retired) ; ceux remplacés par la compaction précédente sont supprimés.
+    """
+    with ManifestLock(root):
+        manifest = read_manifest(root)
+        if len(manifest["segments"]) < 2:
+            return manifest["segments"][0] if manifest["segments"] else None
+        store = SegmentedStore(root, manifest)
+        name = _next_segment_name(root)
+        with StoreWriter(os.path.join(root, name)) as writer:
+            for i, card in enumerate(store.cards):
+                rows = np.arange(store.offsets[i], store.offsets[i + 1])
+                writer.add(card, store.descriptors[rows],
+                           None if store.keypoints is None else store.keypoints[rows],
+                           None if store.phashes is None else store.phashes[i])
+        write_manifest(root, [name], manifest["generation"] + 1, manifest["segments"])
+    # Remplacés il y a une compaction : toutes les vues ont été rechargées depuis (un process
+    # qui les aurait encore en memmap garde ses pages, POSIX)
+    for old in manifest.get("retired", []):
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return name
+
+
+class ConcatenatedRows:
+    """Lignes de plusieurs matrices (memmap) vues comme une seule, lues par tableau d'index"""
+
+    def __init__(self, parts, bases):
+        self.parts = parts
+        self.bases = bases
+        self.dtype = parts[0].dtype
+        self.shape = (int(bases[-1]),) + parts[0].shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        part = np.searchsorted(self.bases, rows, side='right') - 1
+        out = np.empty(rows.shape + self.shape[1:], dtype=self.dtype)
+        for p in np.unique(part):
+            selected = part == p
+            out[selected] = self.parts[p][rows[selected] - self.bases[p]]
+        return out
+
+
+class SegmentedStore:
+    """Même interface que DescriptorStore, sur tous les segments du manifest mis bout à bout"""
+
+    def __init__(self, root, manifest=None, opened=None):
+        """opened : {nom du segment: DescriptorStore} déjà ouverts, réutilisés tels quels"""
+        self.store_dir = root
+        manifest = manifest or read_manifest(root)
+        self.generation = manifest["generation"]
+        self.segment_names = list(manifest["segments"])
+        opened = opened or {}
+        self.segments = [opened.get(name) or DescriptorStore(os.path.join(root, name))
+                         for name in self.segment_names]
+
+        self.row_bases = np.cumsum([0] + [s.n_rows for s in self.segments]).astype(np.int64)
+        self.card_bases = np.cumsum([0] + [s.n_cards for s in self.segments]).astype(np.int64)
+        self.n_rows = int(self.row_bases[-1])
+        self.n_cards = int(self.card_bases[-1])
+        self.cards = [card for s in self.segments for card in s.cards]
+        self.offsets = np.concatenate([np.asarray(s.offsets[:-1], dtype=np.int64) + base
+                                       for s, base in zip(self.segments, self.row_bases)]
+                                      + [[self.n_rows]]).astype(np.int32)
+        self.descriptors = ConcatenatedRows([s.descriptors for s in self.segments], self.row_bases)
+        # Keypoints / pHash seulement si tous les segments les ont
+        self.keypoints = None
+        if all(s.keypoints is not None for s in self.segments):
+            self.keypoints = ConcatenatedRows([s.keypoints for s in self.segments], self.row_bases)
+        self.phashes = None
+        if all(s.phashes is not None for s in self.segments):
+            self.phashes = np.concatenate([s.phashes for s in self.segments])
+
+    @cached_property
+    def card_of_row(self):
+        counts = np.diff(self.offsets)
+        return np.repeat(np.arange(self.n_cards, dtype=np.int32), counts)
+
+    def rows_of_cards(self, cards):
+        cards = np.asarray(cards, dtype=np.int64)
+        starts = self.offsets[cards]
+        return concat_ranges(starts, self.offsets[cards + 1] - starts)
+
+
+class SegmentedIndex:
+    """kNN sur tous les segments (un index chacun), top-k fusionnés en indices globaux"""
+
+    def __init__(self, indexes, row_bases):
+        self.indexes = indexes
+        self.row_bases = row_bases
+        # Index à étape grossière (vocab) : offsets des photos empilées transmis à chaque segment
+        self.grouped = any(getattr(index, 'grouped', False) for index in indexes)
+
+    def knn_search(self, query, k=2, rows=None, offsets=None):
+        """
+        rows : lignes globales autorisées (uniquement si les index acceptent rows=)
+        offsets : bornes des photos empilées dans query (index grouped uniquement)
+        """
+        keys = []
+        for s, index in enumerate(self.indexes):
+            base, end = self.row_bases[s], self.row_bases[s + 1]
+            if rows is None and offsets is not None and getattr(index, 'grouped', False):
+                distances, indices = index.knn_search(query, k, offsets=offsets)
+            elif rows is None:
+                distances, indices = index.knn_search(query, k)
+            else:
+                local = rows[(rows >= base) & (rows < end)] - base
+                if len(local) == 0:
+                    continue
+                distances, indices = index.knn_search(query, k, rows=local)
+            # Voisin manquant (-1) : clé maximale, jamais devant un vrai voisin
+            keys.append(np.where(indices >= 0,
+                                 (distances.astype(np.int64) << 32) | (indices.astype(np.int64) + base),
+                                 np.iinfo(np.int64).max))
+        if not keys:
+            empty = np.full((len(query), k), -1, dtype=np.int32)
+            return empty, empty.copy()
+        distances, indices = merge_top_k(np.concatenate(keys, axis=1), k)
+        missing = (distances < 0) | (distances == np.iinfo(np.int32).max)
+        distances[missing] = -1
+        indices[missing] = -1
+        return distances, indices
+
+
+if __name__ == '__main__':
+    commands = {"init": 3, "add": 4, "compact": 3}
+    if len(sys.argv) < 2 or commands.get(sys.argv[1]) != len(sys.argv):
+        print("Usage: python segments.py init <store> | add <store> <store_delta> | compact <store>")
+        sys.exit(1)
+
+    if sys.argv[1] == "init":
+        print(f"✅ Segment de base : {init_segments(sys.argv[2])}")
+    elif sys.argv[1] == "add":
+        print(f"✅ Segment ajouté : {add_segment(sys.argv[2], sys.argv[3])}")
+    else:
+        print(f"✅ Segments fusionnés dans : {compact(sys.argv[2])}")
+    manifest = read_manifest(sys.argv[2])
+    print(f"   génération {manifest['generation']}, segments {manifest['segments']}")
@@ -0,0 +1,112 @@
+"""
+kNN exact réparti sur un pool de process, un shard de lignes par process.
+
+Avec gunicorn --workers 1, un seul process Python fait tout le matching ;
+ici la super_matrix est coupée en n_shards plages de lignes contiguës, et
+chaque requête est envoyée à tous les process du pool. Chaque process
+ouvre le store en memmap (les pages sont partagées via le cache du noyau,
+rien n'est copié), calcule les k plus proches voisins de son shard, et le
+process principal fusionne les top-k avant le ratio test.
+
+Un seul pool pour tous les index (un par segment d'un store segmenté) :
+chaque index le réserve à sa création et le rend par close() ; le pool est
+arrêté quand plus aucun index ne l'utilise. Les process sont créés par un
+forkserver (spawn à défaut) : un rechargement à chaud crée ses index depuis
+un thread, et un fork d'un process multithreadé n'est pas sûr.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from brute_force_index import BruteForceIndex
+from descriptor_store import DescriptorStore
+from hamming import as_words, merge_top_k
+
+# Index des stores ouverts par un process worker, par dossier (ouverts à la première requête)
+_worker_indexes = {}
+
+
+def _worker_index(store_dir):
+    if store_dir not in _worker_indexes:
+        # Nouveau store (segment) : oublie ceux dont le dossier a disparu (compaction)
+        for old in [d for d in _worker_indexes if not os.path.isdir(d)]:
+            del _worker_indexes[old]
+        _worker_indexes[store_dir] = BruteForceIndex(DescriptorStore(store_dir).descriptors, workers=1)
+    return _worker_indexes[store_dir]
+
+
+def _shard_top_k(store_dir, query, start, stop, k):
+    """Clés top-k d'un shard, calculées dans un process du pool"""
+    return _worker_index(store_dir).range_top_k_keys(as_words(query), start, stop, k)
+
+
+def _ready(_):
+    return os.getpid()
+
+
+class _SharedPool:
+    """Pool de process commun, compté par référence"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._users = 0
+
+    def acquire(self, n_processes):
+        with self._lock:
+            if self._pool is None:
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    # Le forkserver ne charge que ce module (pas __main__ : pas de second serveur)
+                    context.set_forkserver_preload(['sharded_index'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=n_processes, mp_context=context)
+                # Échauffement : lance tous les process maintenant, pas pendant une requête
+                list(self._pool.map(_ready, range(n_processes)))
+            self._users += 1
+            return self._pool
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+_shared_pool = _SharedPool()
+
+
+class ProcessShardedIndex:
+    """Même interface knn_search que BruteForceIndex, calcul réparti sur des process"""
+
+    def __init__(self, store, n_shards=None):
+        self.store_dir = os.path.abspath(store.store_dir)
+        self.n_rows = store.n_rows
+        self.n_shards = max(1, min(n_shards or os.cpu_count(), self.n_rows or 1))
+        bounds = np.linspace(0, self.n_rows, self.n_shards + 1).astype(np.int64)
+        self.shards = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        # Taille du pool : celle demandée par le premier index qui le crée
+        self._pool = _shared_pool.acquire(max(1, n_shards or os.cpu_count()))
+        self._closed = False
+
+    def close(self):
+        """Rend le pool (arrêté si plus aucun index ne s'en sert) ; appelée quand la vue n'utilise plus l'index"""
+        if not self._closed:
+            self._closed = True
+            _shared_pool.release()
+
+    def knn_search(self, query, k=2):
+        """k plus proches voisins exacts ; -1 si la base a moins de k lignes"""
+        query = np.ascontiguousarray(query, dtype=np.uint8)
+        if len(query) == 0 or not self.shards:
+            empty = np.full((len(query), k), -1, dtype=np.int32)
+            return empty, empty.copy()
+
+        futures = [self._pool.submit(_shard_top_k, self.store_dir, query, start, stop, k)
+                   for start, stop in self.shards]
+        return merge_top_k(np.concatenate([f.result() for f in futures], axis=1), k)
@@ -0,0 +1,83 @@
+"""
+Découpage du store en shards, un par set de cartes.
+
+Le shard d'une carte est son 'set_id' (ou à défaut son 'set_name') dans
+cards.json ; finger_print_quick.py écrit les cartes set par set, donc les
+lignes d'un shard sont contiguës dans la super_matrix. Les filtres de
+/search (sets, série, dates de sortie) sélectionnent des shards, et seule
+la recherche sur leurs lignes est faite.
+"""
+import numpy as np
+
+
+def _as_list(value):
+    """Un filtre peut être donné seul ou en liste (de textes) ; ValueError sinon"""
+    if value is None:
+        return None
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+        raise ValueError("un filtre est un texte ou une liste de textes")
+    return values
+
+
+def _normalize_date(date):
+    """'1999-01-09' ou '1999/01/09' -> '1999/01/09' (comparable en texte)"""
+    return None if date is None else str(date).strip().replace('-', '/')
+
+
+class ShardMap:
+    """Shards (sets) d'un store et sélection par filtres"""
+
+    def __init__(self, store):
+        self.store = store
+        keys = [card.get('set_id') or card.get('set_name') for card in store.cards]
+        # Store converti depuis un pickle : pas de métadonnées de set
+        self.available = store.n_cards > 0 and all(keys)
+        if not self.available:
+            self.n_shards = 0
+            return
+
+        self.shard_ids, first_card, self.card_shard = np.unique(keys, return_index=True, return_inverse=True)
+        self.card_shard = self.card_shard.astype(np.int32)
+        self.n_shards = len(self.shard_ids)
+        # Métadonnées du shard = celles de sa première carte
+        self.set_names = [store.cards[i].get('set_name', '') for i in first_card]
+        self.series = [store.cards[i].get('series', '') for i in first_card]
+        self.release_dates = [_normalize_date(store.cards[i].get('release_date', '')) for i in first_card]
+        self.n_cards = np.bincount(self.card_shard, minlength=self.n_shards)
+
+    def describe(self):
+        """Liste des shards, pour que les clients connaissent les filtres possibles"""
+        if not self.available:
+            return []
+        return [{"set_id": str(self.shard_ids[s]), "set_name": self.set_names[s], "series": self.series[s],
+                 "release_date": self.release_dates[s], "cards": int(self.n_cards[s])}
+                for s in range(self.n_shards)]
+
+    def select(self, sets=None, series=None, date_min=None, date_max=None):
+        """Masque des shards qui passent tous les filtres donnés (None = pas de filtre)"""
+        selected = np.ones(self.n_shards, dtype=bool)
+        sets = _as_list(sets)
+        if sets is not None:
+            # Un set se désigne par son id ('base1') ou son nom ('Base')
+            wanted = {s.strip().lower() for s in sets}
+            selected &= [str(self.shard_ids[s]).lower() in wanted or self.set_names[s].lower() in wanted
+                         for s in range(self.n_shards)]
+        series = _as_list(series)
+        if series is not None:
+            wanted = {s.strip().lower() for s in series}
+            selected &= [self.series[s].lower() in wanted for s in range(self.n_shards)]
+        date_min, date_max = _normalize_date(date_min), _normalize_date(date_max)
+        if date_min is not None:
+            selected &= [self.release_dates[s] >= date_min for s in range(self.n_shards)]
+        if date_max is not None:
+            selected &= [self.release_dates[s] <= date_max for s in range(self.n_shards)]
+        return selected
+
+    def card_mask(self, shard_mask):
+        """Masque (n_cards,) des cartes appartenant aux shards sélectionnés"""
+        return shard_mask[self.card_shard]
+
+    def rows(self, shard_mask):
+        """Lignes de la super_matrix des shards sélectionnés"""
+        return self.store.rows_of_cards(np.flatnonzero(self.card_mask(shard_mask)))
@@ -1,6 +1,8 @@
 import requests
 import base64
 import json
+import mimetypes
+import sys
 import time
 
 # URL du serveur API
@@ -8,6 +10,10 @@ import time
 # En production : https://votre-app.onrender.com
 API_URL = "http://localhost:5000"
 
+# Envoi des octets bruts (image/jpeg, image/png) au lieu du base64 en JSON
+# (python test_api_client.py --base64 pour tester l'ancien format)
+UPLOAD_BINAIRE = '--base64' not in sys.argv
+
 def test_health():
     """Test si le serveur est accessible"""
     print("🔍 Test de connexion au serveur...")
@@ -26,26 +32,35 @@ def test_health():
         print("   python api_server.py")
         return False
 
-def search_card(image_path):
+def search_card(image_path, binaire=UPLOAD_BINAIRE):
     """Envoie une image au serveur et affiche le résultat"""
-    print(f"\n📤 Envoi de l'image: {image_path}")
+    print(f"\n📤 Envoi de l'image: {image_path} ({'binaire' if binaire else 'base64'})")
     
     try:
-        # 1. Lire l'image et la convertir en base64
+        # 1. Lire l'image
         with open(image_path, 'rb') as f:
             image_bytes = f.read()
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
         
         print(f"   Taille image: {len(image_bytes) / 1024:.1f} Ko")
         
         # 2. Envoyer la requête
         t_start = time.time()
-        response = requests.post(
-            f"{API_URL}/search",
-            json={'image': image_base64},
-            headers={'Content-Type': 'application/json'},
-            timeout=30
-        )
+        if binaire:
+            content_type = mimetypes.guess_type(image_path)[0] or 'application/octet-stream'
+            response = requests.post(
+                f"{API_URL}/search",
+                data=image_bytes,
+                headers={'Content-Type': content_type},
+                timeout=30
+            )
+        else:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+            response = requests.post(
+                f"{API_URL}/search",
+                json={'image': image_base64},
+                headers={'Content-Type': 'application/json'},
+                timeout=30
+            )
         t_end = time.time()
         
         print(f"⏱️  Temps de réponse: {t_end - t_start:.2f}s")
@@ -0,0 +1,62 @@
+"""
+Non-régression : une image propre du catalogue (celle qui a été indexée) doit
+être reconnue. Le redressement peut se caler sur un cadre intérieur d'une carte
+déjà à plat ; le serveur doit quand même la trouver (chemin pHash ou ORB).
+
+Les images viennent du même chemin que l'indexeur (IMAGES_DIR, cache, téléchargement).
+
+Usage (serveur lancé avec le store du catalogue) :
+    python test_images_catalogue.py
+    python test_images_catalogue.py --cards 200 --url http://localhost:5000
+"""
+import argparse
+import random
+import sys
+
+import requests
+
+from finger_print_quick import RetryLater, image_bytes, load_rows
+
+
+def test_image_catalogue(api_url, row):
+    """(ok, détail) pour une ligne du catalogue envoyée telle quelle à /search"""
+    try:
+        data = image_bytes(row['image'].strip())
+    except RetryLater as e:
+        return None, f"image indisponible ({e})"
+    if data is None:
+        return None, "image introuvable"
+    response = requests.post(f"{api_url}/search", data=data,
+                             headers={'Content-Type': 'image/png'}, timeout=30)
+    resultat = response.json()
+    if response.status_code != 200:
+        return False, f"{response.status_code} {resultat.get('error')}"
+    attendu = (row['number'].strip(), row['set_name'].strip())
+    trouve = (resultat['numero'].strip(), resultat['set_name'].strip())
+    methode = 'pHash' if resultat.get('method') == 'phash' else f"{resultat.get('inliers')} inliers"
+    return trouve == attendu, f"{trouve} ({methode})"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vérifie que des images propres du catalogue sont reconnues")
+    parser.add_argument('--url', default="http://localhost:5000")
+    parser.add_argument('--cards', type=int, default=50, help="cartes tirées au hasard dans le catalogue")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rows = load_rows()
+    rows = random.Random(args.seed).sample(rows, min(args.cards, len(rows)))
+    echecs, testees = [], 0
+    for row in rows:
+        ok, detail = test_image_catalogue(args.url, row)
+        if ok is None:
+            print(f"⏭️  {row['name'].strip()} {row['number'].strip()}: {detail}")
+            continue
+        testees += 1
+        if not ok:
+            echecs.append(f"{row['name'].strip()} {row['number'].strip()} - {row['set_name'].strip()}: {detail}")
+
+    for echec in echecs:
+        print(f"❌ {echec}")
+    print(f"{testees - len(echecs)}/{testees} images du catalogue reconnues")
+    sys.exit(1 if echecs or testees == 0 else 0)
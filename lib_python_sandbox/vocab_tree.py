@@ -0,0 +1,258 @@
+"""
+Arbre de vocabulaire (k-majority hiérarchique) + fichier inversé TF-IDF.
+
+Étape grossière avant le matching : chaque descripteur ORB est quantifié en
+"mot visuel" (feuille de l'arbre), les cartes sont classées par similarité
+TF-IDF entre leurs mots et ceux de la photo, puis le kNN exact + vote ne
+tourne que sur les descripteurs des top-N cartes. Le coût d'une requête
+dépend de N, plus de la taille du catalogue.
+
+Arbre complet de branching^depth feuilles, noeuds numérotés comme un tas :
+les enfants du noeud n sont n * branching + 1 ... n * branching + branching.
+Les centres sont binaires : bit majoritaire des descripteurs du cluster.
+
+Fichiers (dossier <store>/vocab) :
+    header.json       version, branching, depth, n_rows, n_cards
+    centers.u8        (n_nodes, 32) centre de chaque noeud (racine incluse, inutilisée)
+    word_offsets.i32  (n_words + 1) début de la liste de chaque mot dans inv_*
+    inv_cards.i32     cartes contenant le mot
+    inv_tf.u16        nombre d'occurrences du mot dans la carte
+    idf.f32           (n_words,) log(n_cards / nombre de cartes contenant le mot)
+    card_norms.f32    (n_cards,) norme L2 du vecteur TF-IDF de chaque carte
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from brute_force_index import BruteForceIndex
+from descriptor_store import concat_ranges
+from hamming import POPCOUNT_TABLE
+
+VOCAB_VERSION = 1
+VOCAB_DIR = "vocab"
+
+VOCAB_PARAMS = dict(
+    branching=10,
+    depth=4,  # 10^4 mots visuels
+)
+TRAIN_SAMPLE = 200_000  # descripteurs utilisés pour apprendre l'arbre
+KMAJORITY_ITERATIONS = 5
+QUANTIZE_CHUNK_ROWS = 1 << 15
+
+
+def _nearest_center(points, centers):
+    """Index du centre le plus proche (Hamming) de chaque point"""
+    distances = POPCOUNT_TABLE[np.bitwise_xor(points[:, None, :], centers[None, :, :])].sum(axis=2, dtype=np.uint16)
+    return np.argmin(distances, axis=1)
+
+
+def _k_majority(points, k, rng):
+    """k-means binaire : affectation Hamming, centre = bit majoritaire du cluster"""
+    centers = points[rng.choice(len(points), size=k, replace=len(points) < k)].copy()
+    for _ in range(KMAJORITY_ITERATIONS):
+        assign = _nearest_center(points, centers)
+        for j in range(k):
+            members = points[assign == j]
+            if len(members):
+                bits = np.unpackbits(members, axis=1)
+                centers[j] = np.packbits(bits.sum(axis=0) * 2 > len(members))
+    return centers, _nearest_center(points, centers)
+
+
+class VocabTree:
+    """Arbre de vocabulaire et fichier inversé d'un store"""
+
+    def __init__(self, branching, depth, centers, word_offsets, inv_cards, inv_tf, idf, card_norms):
+        self.branching = branching
+        self.depth = depth
+        self.centers = centers
+        self.word_offsets = word_offsets
+        self.inv_cards = inv_cards
+        self.inv_tf = inv_tf
+        self.idf = idf
+        self.card_norms = card_norms
+        self.n_words = branching ** depth
+        self.first_leaf = (self.n_words - 1) // (branching - 1)
+
+    @classmethod
+    def build(cls, store, branching, depth, seed=0):
+        rng = np.random.default_rng(seed)
+        n_nodes = (branching ** (depth + 1) - 1) // (branching - 1)
+        centers = np.zeros((n_nodes, store.descriptors.shape[1]), dtype=np.uint8)
+
+        # 1. Apprentissage de l'arbre sur un échantillon
+        sample_rows = np.sort(rng.choice(store.n_rows, size=min(TRAIN_SAMPLE, store.n_rows), replace=False))
+        sample = np.asarray(store.descriptors[sample_rows])
+        pending = [(0, 0, np.arange(len(sample)))]
+        while pending:
+            node, level, members = pending.pop()
+            if level == depth:
+                continue
+            first_child = node * branching + 1
+            if len(members) == 0:
+                # Branche vide : les enfants héritent du centre du parent
+                centers[first_child:first_child + branching] = centers[node]
+                children_members = [members] * branching
+            else:
+                child_centers, assign = _k_majority(sample[members], branching, rng)
+                centers[first_child:first_child + branching] = child_centers
+                children_members = [members[assign == j] for j in range(branching)]
+            for j in range(branching):
+                pending.append((first_child + j, level + 1, children_members[j]))
+
+        tree = cls(branching, depth, centers, None, None, None, None, None)
+
+        # 2. Fichier inversé : (mot, carte) -> nombre d'occurrences
+        words = tree.quantize(store.descriptors)
+        pairs, tf = np.unique(words.astype(np.int64) * store.n_cards + store.card_of_row, return_counts=True)
+        pair_words = pairs // store.n_cards
+        tree.inv_cards = (pairs % store.n_cards).astype(np.int32)
+        tree.inv_tf = np.minimum(tf, np.iinfo(np.uint16).max).astype(np.uint16)
+        tree.word_offsets = np.zeros(tree.n_words + 1, dtype=np.int32)
+        np.cumsum(np.bincount(pair_words, minlength=tree.n_words), out=tree.word_offsets[1:])
+
+        document_frequency = np.diff(tree.word_offsets)
+        tree.idf = np.zeros(tree.n_words, dtype=np.float32)
+        seen = document_frequency > 0
+        tree.idf[seen] = np.log(store.n_cards / document_frequency[seen])
+
+        weights = tree.inv_tf * tree.idf[pair_words]
+        tree.card_norms = np.sqrt(np.bincount(tree.inv_cards, weights=weights ** 2,
+                                              minlength=store.n_cards)).astype(np.float32)
+        return tree
+
+    def save(self, store_dir, n_rows, n_cards):
+        """Écrit l'arbre dans <store_dir>/vocab (remplacement atomique)"""
+        vocab_dir = os.path.join(store_dir, VOCAB_DIR)
+        tmp_dir = f"{vocab_dir}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        self.centers.tofile(os.path.join(tmp_dir, "centers.u8"))
+        self.word_offsets.tofile(os.path.join(tmp_dir, "word_offsets.i32"))
+        self.inv_cards.tofile(os.path.join(tmp_dir, "inv_cards.i32"))
+        self.inv_tf.tofile(os.path.join(tmp_dir, "inv_tf.u16"))
+        self.idf.tofile(os.path.join(tmp_dir, "idf.f32"))
+        self.card_norms.tofile(os.path.join(tmp_dir, "card_norms.f32"))
+        header = {"version": VOCAB_VERSION, "branching": self.branching, "depth": self.depth,
+                  "n_rows": n_rows, "n_cards": n_cards}
+        with open(os.path.join(tmp_dir, "header.json"), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+        if os.path.exists(vocab_dir):
+            shutil.rmtree(vocab_dir)
+        os.replace(tmp_dir, vocab_dir)
+
+    @classmethod
+    def load(cls, store, branching, depth):
+        """Recharge l'arbre sauvegardé, ou None s'il est absent ou incompatible"""
+        vocab_dir = os.path.join(store.store_dir, VOCAB_DIR)
+        try:
+            with open(os.path.join(vocab_dir, "header.json"), 'r', encoding='utf-8') as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        expected = {"version": VOCAB_VERSION, "branching": branching, "depth": depth,
+                    "n_rows": store.n_rows, "n_cards": store.n_cards}
+        if any(header.get(key) != value for key, value in expected.items()):
+            return None
+
+        def read(name, dtype):
+            return np.fromfile(os.path.join(vocab_dir, name), dtype=dtype)
+
+        centers = read("centers.u8", np.uint8).reshape(-1, store.descriptors.shape[1])
+        return cls(branching, depth, centers, read("word_offsets.i32", np.int32),
+                   read("inv_cards.i32", np.int32), read("inv_tf.u16", np.uint16),
+                   read("idf.f32", np.float32), read("card_norms.f32", np.float32))
+
+    @classmethod
+    def load_or_build(cls, store, branching, depth):
+        """Arbre prêt à l'emploi : rechargé si possible, sinon reconstruit puis sauvegardé"""
+        tree = cls.load(store, branching, depth)
+        if tree is not None:
+            return tree
+
+        print("⚠️ Arbre de vocabulaire absent ou paramètres différents : reconstruction...")
+        tree = cls.build(store, branching, depth)
+        try:
+            tree.save(store.store_dir, store.n_rows, store.n_cards)
+        except OSError as e:
+            print(f"⚠️ Impossible de sauvegarder l'arbre de vocabulaire: {e}")
+        return tree
+
+    def quantize(self, descriptors):
+        """Mot visuel (feuille) de chaque descripteur, descente glouton dans l'arbre"""
+        words = np.empty(len(descriptors), dtype=np.int32)
+        offsets = np.arange(1, self.branching + 1)
+        for start in range(0, len(descriptors), QUANTIZE_CHUNK_ROWS):
+            chunk = np.asarray(descriptors[start:start + QUANTIZE_CHUNK_ROWS])
+            node = np.zeros(len(chunk), dtype=np.int64)
+            for _ in range(self.depth):
+                children = node[:, None] * self.branching + offsets
+                distances = POPCOUNT_TABLE[np.bitwise_xor(self.centers[children], chunk[:, None, :])]
+                best = np.argmin(distances.sum(axis=2, dtype=np.uint16), axis=1)
+                node = children[np.arange(len(chunk)), best]
+            words[start:start + len(chunk)] = node - self.first_leaf
+        return words
+
+    def score_cards(self, query):
+        """Similarité cosinus TF-IDF entre la photo et chaque carte (tableau n_cards)"""
+        words, tf = np.unique(self.quantize(query), return_counts=True)
+        query_weights = tf * self.idf[words]
+        norm = np.sqrt((query_weights ** 2).sum())
+        if norm == 0:
+            return np.zeros(len(self.card_norms), dtype=np.float32)
+
+        # Concaténation des listes inversées des mots de la photo
+        starts = self.word_offsets[words]
+        lengths = self.word_offsets[words + 1] - starts
+        positions = concat_ranges(starts, lengths)
+        cards = self.inv_cards[positions]
+        weights = self.inv_tf[positions] * np.repeat(query_weights * self.idf[words], lengths)
+
+        scores = np.bincount(cards, weights=weights, minlength=len(self.card_norms))
+        return scores / (np.maximum(self.card_norms, 1e-6) * norm)
+
+
+class CoarseToFineIndex:
+    """
+    Recherche en deux étapes derrière la même interface knn_search :
+    classement des cartes par l'arbre de vocabulaire, puis kNN exact
+    limité aux descripteurs des top_n cartes.
+
+    Les top_n cartes dépendent de toute la matrice reçue : un appelant qui
+    empile plusieurs photos (lot, micro-batching) passe leurs offsets pour
+    que chaque photo ait ses propres candidats (grouped = True).
+    """
+
+    grouped = True
+
+    def __init__(self, store, tree, top_n):
+        self.store = store
+        self.tree = tree
+        self.top_n = top_n
+        self._fine = BruteForceIndex(store.descriptors)
+
+    def candidate_rows(self, query):
+        """Lignes de la super_matrix des top_n cartes les plus similaires"""
+        scores = self.tree.score_cards(query)
+        top_n = min(self.top_n, len(scores))
+        cards = np.argpartition(scores, -top_n)[-top_n:]
+        return self.store.rows_of_cards(cards)
+
+    def knn_search(self, query, k=2, offsets=None):
+        """offsets : query[offsets[j]:offsets[j + 1]] = descripteurs de la photo j, classée seule"""
+        if offsets is None:
+            return self._fine.knn_search(query, k, rows=self.candidate_rows(query))
+        distances = np.full((len(query), k), -1, dtype=np.int32)
+        indices = distances.copy()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            if end > start:
+                part = query[start:end]
+                distances[start:end], indices[start:end] = self._fine.knn_search(
+                    part, k, rows=self.candidate_rows(part))
+        return distances, indices